@@ -0,0 +1,71 @@
+"""Fails if importing an entry point takes longer than its startup budget in import_time_budget.json
+
+Usage: python benchmarks/import_time.py [--repeat N] [--scale FACTOR]
+"""
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+REALPATH = os.path.dirname(os.path.realpath(__file__))
+SRC_PATH = os.path.join(os.path.dirname(REALPATH), 'src')
+BUDGET_PATH = os.path.join(REALPATH, 'import_time_budget.json')
+# Entry points and the directory they are run from
+ENTRY_POINTS = {
+    'assignment': SRC_PATH,
+    'ensemble_postprocess': os.path.join(SRC_PATH, 'apps'),
+}
+
+
+def parse_importtime(stderr):
+    """Returns (self_us, cumulative_us, indented name) of each import in `python -X importtime` output"""
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        imports.append((int(self_us), int(cumulative_us), name.rstrip()))
+    return imports
+
+
+def measure(module, path):
+    """Imports the module in a fresh interpreter, returns its cumulative import time in ms and the slowest imports it pulled in"""
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'], cwd=path,
+                            env={**os.environ, 'PYTHONPATH': path}, capture_output=True, text=True, check=True)
+    imports = parse_importtime(result.stderr)
+    # Imports are reported once finished, the module's own line closes its subtree
+    end = max(i for i, (_, _, name) in enumerate(imports) if name.strip() == module)
+    start = end
+    while start > 0 and imports[start - 1][2].startswith('  '):
+        start -= 1
+    slowest = sorted(imports[start:end], key=lambda x: x[0], reverse=True)[:5]
+    return imports[end][1] / 1000, [(name.strip(), self_us / 1000) for self_us, _, name in slowest]
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Checks the import time of the entry points against their budget')
+    parser.add_argument('--repeat', type=int, default=5, help='imports per entry point, the fastest is kept')
+    parser.add_argument('--scale', type=float, default=1.0, help='multiplies every budget, for slower machines')
+    args = parser.parse_args(argv)
+
+    with open(BUDGET_PATH) as f:
+        budgets = json.load(f)
+
+    over_budget = []
+    for module, path in ENTRY_POINTS.items():
+        runs = [measure(module, path) for _ in range(args.repeat)]
+        import_ms, slowest = min(runs, key=lambda run: run[0])
+        budget_ms = budgets[module] * args.scale
+        print(f'{module}: {import_ms:.1f} ms (budget {budget_ms:.0f} ms)')
+        for name, self_ms in slowest:
+            print(f'    {name}: {self_ms:.1f} ms')
+        if import_ms > budget_ms:
+            over_budget.append(module)
+
+    if over_budget:
+        sys.exit(f"Import time over budget: {', '.join(over_budget)}")
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,176 @@
+"""Times each stage of the workflow on synthetic cohorts of growing size and checks them against a baseline
+
+Every stage runs in its own process; its wall time, CPU time and peak RSS are read from the process
+(and the children it waited for) as it exits. Linux carries the peak RSS of the forking process over
+into the child, so this process never loads the cohort itself. Results are written as JSON and compared with
+scaling_baseline.json: a stage regresses when it is slower or larger than the baseline by more
+than the allowed factor.
+
+Usage: python benchmarks/scaling.py [--sizes N ...] [--stub-tools] [--output PATH] [--update-baseline]
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+
+REALPATH = os.path.dirname(os.path.realpath(__file__))
+APPS_PATH = os.path.join(os.path.dirname(REALPATH), 'src', 'apps')
+BASELINE_PATH = os.path.join(REALPATH, 'scaling_baseline.json')
+DEFAULT_REFERENCE_PATH = os.path.join(os.path.dirname(REALPATH), 'signature_reference', 'COSMICv3_SP-synthetic_GRCh37.txt')
+DEFAULT_SIZES = [10, 100, 1000, 10000, 100000]
+TOOL_SCRIPTS = {
+    'SigProfilerAssignment': 'SigProfiler.py',
+    'Sigminer': 'Sigminer.r',
+    'SignatureToolsLib': 'SignatureToolsLib.r',
+    'MutationalPatterns': 'MutationalPatterns.r',
+    'MutSignatures': 'MutSignatures.r',
+    'FastNNLS': 'FastNNLS.py',
+}
+# Tools without external dependencies are run even with --stub-tools
+BUILT_IN_TOOLS = ['FastNNLS']
+# Differences below these are noise, mostly interpreter startup
+TIME_TOLERANCE_SECONDS = 0.25
+MEMORY_TOLERANCE_MB = 16
+
+
+def get_tool_command(tool, stub_tools):
+    if stub_tools and tool not in BUILT_IN_TOOLS:
+        return [sys.executable, os.path.join(REALPATH, 'stub_tool.py')]
+    script = TOOL_SCRIPTS[tool]
+    return ['Rscript' if script.endswith('.r') else sys.executable, os.path.join(APPS_PATH, script)]
+
+
+def run_stage(command, env=None):
+    """Runs a stage to completion, returns its wall and CPU seconds and the peak RSS of its process tree in MB"""
+    start = time.time()
+    process = subprocess.Popen(command, cwd=APPS_PATH, env={**os.environ, **(env or {})},
+                               stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    # Drains stderr before waiting so a chatty stage cannot block on a full pipe
+    stderr = process.stderr.read()
+    _, status, rusage = os.wait4(process.pid, 0)
+    seconds = time.time() - start
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if process.returncode != 0:
+        raise RuntimeError(f"Stage failed with exit code {process.returncode}: {' '.join(command)}\n{stderr.decode()}")
+    # ru_maxrss is in KB on Linux
+    return {
+        'seconds': round(seconds, 3),
+        'cpu_seconds': round(rusage.ru_utime + rusage.ru_stime, 3),
+        'peak_rss_mb': round(rusage.ru_maxrss / 1024, 1),
+    }
+
+
+def get_stages(workdir, reference_path, tools, strategy, mean_mode, stub_tools):
+    """Lists (stage, command, env) in the order the workflow runs them"""
+    cohort_path = os.path.join(workdir, 'cohort')
+    output_path = os.path.join(workdir, 'output')
+    sample_path = os.path.join(output_path, 'samples.txt')
+    result_path = os.path.join(output_path, 'results')
+    validate = (
+        'import sys; from workflow_utils import load_matrix; load_matrix(*sys.argv[1:])'
+    )
+    stages = [('validation', [sys.executable, '-c', validate, os.path.join(cohort_path, 'samples.txt'), reference_path, sample_path], None)]
+    env = {'STUB_EXPOSURES_PATH': os.path.join(cohort_path, 'exposures.txt')}
+    for tool in tools:
+        stages.append((tool, get_tool_command(tool, stub_tools) + [sample_path, reference_path, os.path.join(output_path, tool), strategy], env))
+    stages.append(('ensemble_postprocess', [sys.executable, 'ensemble_postprocess.py', sample_path, reference_path, output_path,
+                                            result_path, strategy] + tools + [f'--mean-mode={mean_mode}'], None))
+    return stages
+
+
+def benchmark_size(n_samples, reference_path, tools, strategy, mean_mode, stub_tools, seed):
+    """Generates a cohort of n_samples and runs every stage on it in a scratch directory"""
+    workdir = tempfile.mkdtemp(prefix=f'ensemblefit-scaling-{n_samples}-')
+    try:
+        subprocess.run([sys.executable, os.path.join(REALPATH, 'synthetic_cohort.py'), reference_path, str(n_samples),
+                        os.path.join(workdir, 'cohort'), f'--seed={seed}'], check=True)
+        os.makedirs(os.path.join(workdir, 'output', 'results'))
+        results = {}
+        for stage, command, env in get_stages(workdir, reference_path, tools, strategy, mean_mode, stub_tools):
+            results[stage] = run_stage(command, env)
+            print(f'{n_samples} samples, {stage}: {results[stage]["seconds"]:.2f} s, {results[stage]["peak_rss_mb"]:.0f} MB')
+        return results
+    finally:
+        shutil.rmtree(workdir)
+
+
+def compare(results, baseline, max_slowdown, max_memory_growth, scale=1.0):
+    """Lists the stages slower or larger than the baseline by more than the allowed factor and tolerance"""
+    regressions = []
+    for size, stages in results['sizes'].items():
+        for stage, measured in stages.items():
+            expected = baseline['sizes'].get(size, {}).get(stage)
+            if expected is None:
+                continue
+            max_seconds = expected['seconds'] * scale * max_slowdown + TIME_TOLERANCE_SECONDS
+            max_rss_mb = expected['peak_rss_mb'] * max_memory_growth + MEMORY_TOLERANCE_MB
+            if measured['seconds'] > max_seconds:
+                regressions.append(f'{size} samples, {stage}: {measured["seconds"]:.2f} s (baseline {expected["seconds"] * scale:.2f} s)')
+            if measured['peak_rss_mb'] > max_rss_mb:
+                regressions.append(f'{size} samples, {stage}: {measured["peak_rss_mb"]:.0f} MB (baseline {expected["peak_rss_mb"]:.0f} MB)')
+    return regressions
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Benchmarks the workflow stages on synthetic cohorts of growing size')
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES, help='samples per cohort')
+    parser.add_argument('--reference', default=DEFAULT_REFERENCE_PATH, help='signatures the cohorts are drawn from and fitted to')
+    parser.add_argument('--tools', nargs='+', default=list(TOOL_SCRIPTS))
+    parser.add_argument('--strategy', default='refit')
+    parser.add_argument('--mean-mode', default='bootstrap')
+    parser.add_argument('--stub-tools', action='store_true', help='write the known exposures instead of running the external tools')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='scaling_results.json', help='results JSON')
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--update-baseline', action='store_true', help='store these results as the baseline')
+    parser.add_argument('--max-slowdown', type=float, default=1.5, help='allowed wall time over the baseline, as a factor')
+    parser.add_argument('--max-memory-growth', type=float, default=1.5, help='allowed peak RSS over the baseline, as a factor')
+    parser.add_argument('--scale', type=float, default=1.0, help='multiplies every baseline time, for slower machines')
+    args = parser.parse_args(argv)
+
+    results = {
+        'reference': os.path.basename(args.reference),
+        'tools': args.tools,
+        'strategy': args.strategy,
+        'mean_mode': args.mean_mode,
+        'stub_tools': args.stub_tools,
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'cpus': os.cpu_count(),
+        'sizes': {},
+    }
+    for n_samples in args.sizes:
+        results['sizes'][str(n_samples)] = benchmark_size(n_samples, args.reference, args.tools, args.strategy,
+                                                          args.mean_mode, args.stub_tools, args.seed)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=4)
+
+    if args.update_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=4)
+        return
+
+    if not os.path.exists(args.baseline):
+        print(f'No baseline at {args.baseline}, run with --update-baseline to store one')
+        return
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    # Stub and real tool timings are not comparable
+    if baseline['stub_tools'] != args.stub_tools:
+        print(f"Baseline was run {'with' if baseline['stub_tools'] else 'without'} --stub-tools, tool stages are not compared")
+        for stages in baseline['sizes'].values():
+            for tool in TOOL_SCRIPTS:
+                if tool not in BUILT_IN_TOOLS:
+                    stages.pop(tool, None)
+    regressions = compare(results, baseline, args.max_slowdown, args.max_memory_growth, args.scale)
+    if regressions:
+        sys.exit('Regressed against the baseline:\n' + '\n'.join(regressions))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
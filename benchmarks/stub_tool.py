@@ -0,0 +1,28 @@
+"""Stands in for a fitting tool: writes the known exposures of a synthetic cohort as the tool's activities
+
+Takes the tools' arguments, the tool is named by the last directory of tool_output_path and the
+exposures are read from $STUB_EXPOSURES_PATH, as written by synthetic_cohort.py.
+
+Usage: STUB_EXPOSURES_PATH=exposures.txt python benchmarks/stub_tool.py sample_path reference_path tool_output_path strategy
+"""
+import os
+import sys
+
+REALPATH = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(REALPATH), 'src', 'apps'))
+
+from workflow_utils import read_column_names, read_table
+
+
+def main(sample_path, tool_output_path, strategy, exposures_path):
+    tool = os.path.basename(os.path.normpath(tool_output_path))
+    os.makedirs(tool_output_path, exist_ok=True)
+    exposures = read_table(exposures_path).set_index('Samples')
+    activities = exposures.loc[read_column_names(sample_path)].rename_axis('Samples').reset_index()
+    activities.to_csv(os.path.join(tool_output_path, f'{tool}_{strategy}.txt'), sep='\t', index=False)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 5:
+        sys.exit("Need 4 arguments: sample_path reference_path tool_output_path strategy")
+    main(sys.argv[1], sys.argv[3], sys.argv[4], os.environ['STUB_EXPOSURES_PATH'])
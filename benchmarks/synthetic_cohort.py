@@ -0,0 +1,72 @@
+"""Generates a synthetic SBS96 cohort from a signature reference with known exposures
+
+Writes samples.txt, the catalogue in the reference's feature order, and exposures.txt, the mutations
+each signature contributes to each sample, in the layout of the tools' activities.
+
+Usage: python benchmarks/synthetic_cohort.py reference_path n_samples output_dir [--seed N]
+"""
+import os
+import sys
+import argparse
+
+REALPATH = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(REALPATH), 'src', 'apps'))
+
+from workflow_utils import lazy_import, write_catalogue, write_table
+
+pd = lazy_import('pandas')
+np = lazy_import('numpy')
+
+# Active signatures per sample are 1 plus a Poisson draw, total mutations log-normal around the median
+MEAN_EXTRA_SIGNATURES = 3
+MEDIAN_MUTATIONS = 2000
+MUTATIONS_SIGMA = 1.0
+MIN_MUTATIONS = 50
+
+
+def read_reference(reference_path):
+    """Returns the reference's features, signature names and column-normalized (features x signatures) matrix"""
+    reference = pd.read_csv(reference_path, sep='\t', index_col=0)
+    signatures = reference.to_numpy(dtype=float)
+    return reference.index.tolist(), reference.columns.tolist(), signatures / signatures.sum(axis=0)
+
+
+def generate_cohort(signatures, n_samples, seed=0):
+    """Draws each sample's exposures and its counts from them, returns (counts, exposures)
+
+    counts is (features x samples) int64, exposures is (samples x signatures) float.
+    """
+    rng = np.random.default_rng(seed)
+    n_features, n_signatures = signatures.shape
+    n_active = np.minimum(1 + rng.poisson(MEAN_EXTRA_SIGNATURES, n_samples), n_signatures)
+    # A random rank per signature picks n_active distinct signatures of each sample at once
+    ranks = rng.random((n_samples, n_signatures)).argsort(axis=1).argsort(axis=1)
+    weights = rng.gamma(1.0, size=(n_samples, n_signatures)) * (ranks < n_active[:, None])
+    weights /= weights.sum(axis=1, keepdims=True)
+    totals = np.maximum(rng.lognormal(np.log(MEDIAN_MUTATIONS), MUTATIONS_SIGMA, n_samples), MIN_MUTATIONS).astype(np.int64)
+
+    probs = weights @ signatures.T
+    probs /= probs.sum(axis=1, keepdims=True)
+    counts = rng.multinomial(totals, probs)
+    return counts.T.astype(np.int64), weights * totals[:, None]
+
+
+def main(reference_path, n_samples, output_dir, seed=0):
+    os.makedirs(output_dir, exist_ok=True)
+    features, signature_names, signatures = read_reference(reference_path)
+    counts, exposures = generate_cohort(signatures, n_samples, seed)
+    samples = [f'Synthetic::S.{i + 1}' for i in range(n_samples)]
+    write_catalogue(features, samples, counts, os.path.join(output_dir, 'samples.txt'))
+    exposures = pd.DataFrame(exposures, columns=signature_names)
+    exposures.insert(0, 'Samples', samples)
+    write_table(exposures, os.path.join(output_dir, 'exposures.txt'))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generates a synthetic SBS96 cohort with known exposures')
+    parser.add_argument('reference_path')
+    parser.add_argument('n_samples', type=int)
+    parser.add_argument('output_dir')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    main(args.reference_path, args.n_samples, args.output_dir, args.seed)
@@ -1,12 +1,10 @@
-import os
-import sys
-from datetime import datetime
 import math
-import pandas as pd
-import numpy as np
-import random
+import itertools
 
-from workflow_utils import as_frequency_rowwise
+from workflow_utils import lazy_import
+
+pd = lazy_import('pandas')
+np = lazy_import('numpy')
 
 
 def ensemble_qualitative(fit, all_sigs, all_samples):
@@ -23,61 +21,87 @@ def ensemble_qualitative(fit, all_sigs, all_samples):
     return ens_majority, ens_unanimous
 
 
-def ensemble_quantitative(fit, all_sigs, all_samples):
+def stack_activities(fit, all_sigs, all_samples):
+    """Stacks the tool activities into a (samples x signatures x tools) array"""
+    return np.stack([
+        fit[tool].set_index('Samples').reindex(index=all_samples, columns=all_sigs).to_numpy(dtype=float)
+        for tool in fit
+    ], axis=-1)
+
+
+def ensemble_quantitative(fit, all_sigs, all_samples, n_bootstrap=500, seed=37):
     print('Ensemble-Mean: Bootstrapping...')
-    def bootstrap(arr, k, size=500):
-        return np.mean([np.mean(random.choices(arr, k=k)) for _ in range(size)])
+    activities = stack_activities(fit, all_sigs, all_samples)
+    n_tools = activities.shape[-1]
+    rng = np.random.default_rng(seed)
+    # The mean of n_bootstrap resample means (each of n_tools draws) is the mean over all
+    # n_bootstrap * n_tools draws, so only the number of times each tool is drawn matters.
+    # Draw those counts for every sample and signature at once.
+    counts = rng.multinomial(n_bootstrap * n_tools,
+                             np.full(n_tools, 1 / n_tools),
+                             size=activities.shape[:-1])
+    bootstrap_means = (counts * activities).sum(axis=-1) / (n_bootstrap * n_tools)
+    # Only bootstrap if sum is not 0
+    bootstrap_means = np.where(activities.sum(axis=-1) == 0, 0, bootstrap_means)
 
-    random.seed(37)
-    ens_mean = pd.DataFrame({'Samples': all_samples})
-    tools = list(fit.keys())
-    for sig in all_sigs:
-        bootstrap_means = []
-        for sample in all_samples:
-            vals = [fit[tool].set_index('Samples').loc[sample, sig] for tool in tools]
-            # Only bootstrap if sum is not 0
-            val = 0 if sum(vals) == 0 else bootstrap(vals, len(tools), size=500)
-            bootstrap_means.append(val)
-        ens_mean[sig] = bootstrap_means
+    ens_mean = pd.DataFrame(bootstrap_means, columns=all_sigs)
+    ens_mean.insert(0, 'Samples', all_samples)
+    return ens_mean
+
+
+def bootstrap_multisets(n_tools):
+    """Enumerates every distinct bootstrap resample of n_tools draws as per-tool counts with its probability"""
+    counts = np.array([
+        np.bincount(draws, minlength=n_tools)
+        for draws in itertools.combinations_with_replacement(range(n_tools), n_tools)
+    ])
+    probs = np.array([
+        math.factorial(n_tools) / math.prod(math.factorial(c) for c in row) / n_tools ** n_tools
+        for row in counts
+    ])
+    return counts, probs
+
+
+def ensemble_exact(fit, all_sigs, all_samples, ci=0.95, chunk_size=256):
+    print('Ensemble-Mean: Enumerating bootstrap distribution...')
+    activities = stack_activities(fit, all_sigs, all_samples)
+    n_tools = activities.shape[-1]
+    counts, probs = bootstrap_multisets(n_tools)
+    quantiles = [(1 - ci) / 2, 1 - (1 - ci) / 2]
+
+    expected = activities.mean(axis=-1)
+    bounds = np.empty((len(quantiles),) + expected.shape)
+    # Chunk over samples to bound the (samples x signatures x resamples) intermediates
+    for start in range(0, activities.shape[0], chunk_size):
+        resample_means = activities[start:start + chunk_size] @ counts.T / n_tools
+        order = np.argsort(resample_means, axis=-1)
+        sorted_means = np.take_along_axis(resample_means, order, axis=-1)
+        cum_probs = np.cumsum(probs[order], axis=-1)
+        for i, q in enumerate(quantiles):
+            # Percentile is the first resample mean whose cumulative probability reaches q
+            idx = np.minimum((cum_probs < q - 1e-12).sum(axis=-1), len(probs) - 1)
+            bounds[i, start:start + chunk_size] = np.take_along_axis(sorted_means, idx[..., None], axis=-1)[..., 0]
+
+    # Interleave the bounds so each signature's lower/upper columns sit together
+    ci_columns = [f'{sig}_CI_{bound}' for sig in all_sigs for bound in ('lower', 'upper')]
+    ci = bounds.transpose(1, 2, 0).reshape(len(all_samples), -1)
+    ens_mean = pd.DataFrame(np.hstack([expected, ci]), columns=all_sigs + ci_columns)
+    ens_mean.insert(0, 'Samples', all_samples)
     return ens_mean
 
 
-def main(sample_path, reference_path, output_path, strategy, tools):
-    if not os.path.exists(os.path.join(output_path, 'EnsembleFit')):
-        os.makedirs(os.path.join(output_path, 'EnsembleFit'))
+MEAN_MODES = {
+    'bootstrap': ensemble_quantitative,
+    'exact': ensemble_exact,
+}
 
-    all_samples = pd.read_csv(sample_path, sep='\t').columns[1:].tolist()
-    all_sigs = pd.read_csv(reference_path, sep='\t').columns[1:].tolist()
-    fit = {}
-    for tool in tools:
-        df = pd.read_csv(os.path.join(output_path, tool, f'{tool}_{strategy}.txt'), sep='\t')
-        df['Samples']  = all_samples
-        for sig in all_sigs:
-            if sig not in df.columns:
-                df[sig] = 0
-        fit[tool] = as_frequency_rowwise(df)
 
+def run_ensemble(fit, all_sigs, all_samples, mean_mode='bootstrap'):
+    """Runs every ensemble on the tools' activities and returns them keyed by ensemble name"""
     ens_majority, ens_unanimous = ensemble_qualitative(fit, all_sigs, all_samples)
-    ens_mean = ensemble_quantitative(fit, all_sigs, all_samples)
-    ens_majority.to_csv(os.path.join(output_path, 'EnsembleFit', f'Ensemble-Majority_{strategy}.txt'), sep='\t', index=False)
-    ens_unanimous.to_csv(os.path.join(output_path, 'EnsembleFit', f'Ensemble-Unanimous_{strategy}.txt'), sep='\t', index=False)
-    ens_mean.to_csv(os.path.join(output_path, 'EnsembleFit', f'Ensemble-Mean_{strategy}.txt'), sep='\t', index=False)
-
-    
-if __name__ == '__main__':
-    if len(sys.argv) < 5:
-        sys.exit("Need at least 5 arguments: sample_path reference_path output_path strategy [tools]")
-    sample_path = sys.argv[1]
-    reference_path = sys.argv[2]
-    output_path = sys.argv[3]
-    strategy = sys.argv[4]
-    tools = sys.argv[5:]
-    
-    print(f'[{datetime.now().strftime("%Y-%m-%d %H:%M:%S")}] Start')
-    print(f'    - Sample Path: {sample_path}')
-    print(f'    - Reference Path: {reference_path}')
-    print(f'    - Output Path: {output_path}')
-    print(f'    - Strategy: {strategy}')
-    print(f'    - Tools: {", ".join(tools)}')
-
-    main(sample_path, reference_path, output_path, strategy, tools)
\ No newline at end of file
+    ens_mean = MEAN_MODES[mean_mode](fit, all_sigs, all_samples)
+    return {
+        'Ensemble-Majority': ens_majority,
+        'Ensemble-Unanimous': ens_unanimous,
+        'Ensemble-Mean': ens_mean,
+    }
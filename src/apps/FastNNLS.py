@@ -0,0 +1,137 @@
+import os
+import sys
+import multiprocessing
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+
+from workflow_utils import lazy_import, load_catalogue, load_reference, reorder_catalogue
+
+pd = lazy_import('pandas')
+np = lazy_import('numpy')
+
+# Signatures under this share of a sample's mutations are dropped by remove and refit, as in the other tools
+REMOVE_THRESHOLD = 0.05
+# Samples per chunk, each chunk is fitted by one worker process
+CHUNK_SIZE = 2000
+
+
+def read_inputs(sample_path, reference_path):
+    """Returns the samples, the reference's registry entry and the (features x samples) counts in its feature order"""
+    # Memory-mapped from its npy copy if it has one, else parsed row by row as pandas is slow on wide tables
+    features, samples, counts = load_catalogue(sample_path)
+    _, counts = reorder_catalogue(features, counts, reference_path)
+    return samples, load_reference(reference_path), counts.astype(float)
+
+
+def project(upper, signatures, counts):
+    """Projects every sample at once onto the reference, as d with |Sx - b|^2 = |Ux - d|^2 + constant
+
+    This holds for any subset of the signatures too, so restricted fits reuse the same factor.
+    """
+    from scipy.linalg import solve_triangular
+    return solve_triangular(upper, signatures.T @ counts, trans='T')
+
+
+def fit_chunk(upper, projected, masks=None):
+    """Solves the NNLS problem of each column of projected, over the signatures of its mask if given"""
+    from scipy.optimize import nnls
+    exposures = np.zeros((projected.shape[1], upper.shape[1]))
+    for i in range(projected.shape[1]):
+        if masks is None:
+            exposures[i] = nnls(upper, projected[:, i])[0]
+        elif masks[i].any():
+            exposures[i, masks[i]] = nnls(upper[:, masks[i]], projected[:, i])[0]
+    return exposures
+
+
+def load_numpy():
+    """Loads NumPy in a worker process before it unpickles any chunk, which fails while NumPy is lazily imported"""
+    np.ndarray
+
+
+def fit(reference, counts, masks=None, workers=None):
+    """Fits every sample's counts to the reference, returns (samples x signatures) exposures in mutations
+
+    The upper Cholesky factor U of the reference's Gram matrix, G = U^T U, is shared by every sample's fit.
+    """
+    if reference.upper is None:
+        raise ValueError('The signatures of the reference are linearly dependent, FastNNLS cannot fit them.')
+    upper = np.asarray(reference.upper)
+    projected = project(upper, reference.matrix, counts)
+    starts = range(0, counts.shape[1], CHUNK_SIZE)
+    chunks = [projected[:, start:start + CHUNK_SIZE] for start in starts]
+    chunk_masks = [None if masks is None else masks[start:start + CHUNK_SIZE] for start in starts]
+    workers = min(workers or len(os.sched_getaffinity(0)), len(chunks))
+    if workers <= 1:
+        return np.vstack([fit_chunk(upper, chunk, mask) for chunk, mask in zip(chunks, chunk_masks)])
+    # Spawned, not forked: the fit also runs inside the workflow's multi-threaded Parsl process
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'), initializer=load_numpy) as executor:
+        return np.vstack(list(executor.map(fit_chunk, [upper] * len(chunks), chunks, chunk_masks)))
+
+
+def write_activities(samples, sigs, exposures, path, unassigned=None):
+    activities = pd.DataFrame(exposures, columns=sigs)
+    activities.insert(0, 'Samples', samples)
+    if unassigned is not None:
+        activities['unassigned'] = unassigned
+    activities.to_csv(path, sep='\t', index=False)
+
+
+def regular_exposures(sample_path, reference_path, output_path, workers=None):
+    """Reads the regular fit if this run already wrote it, else fits and writes it"""
+    samples, reference, counts = read_inputs(sample_path, reference_path)
+    regular_path = os.path.join(output_path, 'FastNNLS_regular.txt')
+    if os.path.isfile(regular_path):
+        exposures = pd.read_csv(regular_path, sep='\t', index_col=0)[reference.signatures].to_numpy(dtype=float)
+    else:
+        exposures = fit(reference, counts, workers=workers)
+        write_activities(samples, reference.signatures, exposures, regular_path)
+    return samples, reference, counts, exposures
+
+
+def fastnnls_regular(sample_path, reference_path, output_path, workers=None):
+    regular_exposures(sample_path, reference_path, output_path, workers)
+
+
+def fastnnls_remove(sample_path, reference_path, output_path, workers=None):
+    samples, reference, counts, exposures = regular_exposures(sample_path, reference_path, output_path, workers)
+    total_mutations = counts.sum(axis=0)
+    exposures[exposures < total_mutations[:, None] * REMOVE_THRESHOLD] = 0
+    write_activities(samples, reference.signatures, exposures, os.path.join(output_path, 'FastNNLS_remove.txt'),
+                     unassigned=total_mutations - exposures.sum(axis=1))
+
+
+def fastnnls_refit(sample_path, reference_path, output_path, workers=None):
+    # Fits again on the signatures kept by remove, so their mutations are reassigned among them
+    samples, reference, counts, exposures = regular_exposures(sample_path, reference_path, output_path, workers)
+    masks = exposures >= counts.sum(axis=0)[:, None] * REMOVE_THRESHOLD
+    exposures = fit(reference, counts, masks, workers)
+    write_activities(samples, reference.signatures, exposures, os.path.join(output_path, 'FastNNLS_refit.txt'))
+
+
+def main(sample_path, reference_path, output_path, strategy, workers=None):
+    strategy_map = {
+        'regular': fastnnls_regular,
+        'remove': fastnnls_remove,
+        'refit': fastnnls_refit
+    }
+    os.makedirs(output_path, exist_ok=True)
+    strategy_map[strategy](sample_path, reference_path, output_path, workers)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 5:
+        sys.exit("Need at least 4 arguments: sample_path reference_path output_path strategy [workers]")
+    sample_path = sys.argv[1]
+    reference_path = sys.argv[2]
+    output_path = sys.argv[3]
+    strategy = sys.argv[4]
+    workers = int(sys.argv[5]) if len(sys.argv) > 5 else None
+
+    print(f'[{datetime.now().strftime("%Y-%m-%d %H:%M:%S")}] Start')
+    print(f'    - Sample Path: {sample_path}')
+    print(f'    - Reference Path: {reference_path}')
+    print(f'    - Output Path: {output_path}')
+    print(f'    - Strategy: {strategy}')
+    main(sample_path, reference_path, output_path, strategy, workers)
+    print(f'[{datetime.now().strftime("%Y-%m-%d %H:%M:%S")}] Completed')
@@ -1,13 +1,16 @@
 import sys
 import os
-import pandas as pd
-import numpy as np
 import shutil
 from datetime import datetime
-from SigProfilerAssignment import Analyzer as Analyze
+
+from workflow_utils import lazy_import
+
+pd = lazy_import('pandas')
+np = lazy_import('numpy')
 
 
 def sigprofiler_regular(sample_path, reference_path, output_path):
+    from SigProfilerAssignment import Analyzer as Analyze
     run_output_path = os.path.join(output_path, 'regular')
     Analyze.cosmic_fit(sample_path, 
                    run_output_path,
@@ -42,6 +45,7 @@ def sigprofiler_remove(sample_path, reference_path, output_path):
 
 
 def sigprofiler_refit(sample_path, reference_path, output_path):
+    from SigProfilerAssignment import Analyzer as Analyze
     run_output_path = os.path.join(output_path, 'refit')
     Analyze.cosmic_fit(sample_path, 
                    run_output_path,
@@ -0,0 +1,263 @@
+import os
+import sys
+import time
+import hashlib
+import sqlite3
+import importlib.util
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+
+from workflow_utils import file_digest, lazy_import, write_catalogue, SBS96_FEATURES
+
+np = lazy_import('numpy')
+
+# Base codes (ACGT and N as 0-4) of the bytes in SigProfilerMatrixGenerator's tsb chromosome files, each byte is
+# one position with its transcriptional strand: 0-3 ACGT, 4-7 transcribed, 8-11 untranscribed, 12-15 both, 16-19 N
+TSB_BASE_CODES = [0, 1, 2, 3] * 4 + [4] * 4
+BASE_CODES = {'A': 0, 'C': 1, 'G': 2, 'T': 3, 'N': 4}
+# Chromosome names from NCBI notation, as SigProfilerMatrixGenerator converts them
+NCBI_CHROMS = {
+    'NC_000067.6': '1', 'NC_000068.7': '2', 'NC_000069.6': '3', 'NC_000070.6': '4',
+    'NC_000071.6': '5', 'NC_000072.6': '6', 'NC_000073.6': '7', 'NC_000074.6': '8',
+    'NC_000075.6': '9', 'NC_000076.6': '10', 'NC_000077.6': '11', 'NC_000078.6': '12',
+    'NC_000079.6': '13', 'NC_000080.6': '14', 'NC_000081.6': '15', 'NC_000082.6': '16',
+    'NC_000083.6': '17', 'NC_000084.6': '18', 'NC_000085.6': '19', 'NC_000086.7': 'X',
+    'NC_000087.7': 'Y', '82503188|ref|NC_007605.1|': 'gi_82503188_ref_NC_007605',
+}
+FEATURES = sorted(SBS96_FEATURES)
+# Bump when counting changes so catalogues cached by earlier versions are not reused
+COUNTER_VERSION = '1'
+DEFAULT_MAX_ENTRIES = 100000
+
+
+def get_feature_table():
+    """Maps the base codes of (5' base, ref, alt, 3' base) to the row of their pyrimidine-centered SBS96 feature"""
+    complement = {'A': 'T', 'C': 'G', 'G': 'C', 'T': 'A'}
+    row = {feature: i for i, feature in enumerate(FEATURES)}
+    table = np.full((5, 5, 5, 5), -1, dtype=np.int64)
+    for b5, ref, alt, b3 in np.ndindex(4, 4, 4, 4):
+        bases = ['ACGT'[i] for i in (b5, ref, alt, b3)]
+        if bases[1] == bases[2]:
+            continue
+        if bases[1] in 'AG':
+            bases = [complement[b] for b in reversed(bases)]
+            bases[1], bases[2] = bases[2], bases[1]
+        table[b5, ref, alt, b3] = row[f'{bases[0]}[{bases[1]}>{bases[2]}]{bases[3]}']
+    return table
+
+
+def get_genome_path(genome):
+    """The tsb chromosome files of a genome installed by setup/install_genome.py, or the directory genome names"""
+    if os.sep in genome:
+        if not os.path.isdir(genome):
+            raise ValueError(f'The reference genome directory {genome} does not exist.')
+        return genome
+    spec = importlib.util.find_spec('SigProfilerMatrixGenerator')
+    if spec is None:
+        raise ValueError('SigProfilerMatrixGenerator is not installed, run setup/install_genome.py first.')
+    genome_path = os.path.join(os.path.dirname(spec.origin), 'references', 'chromosomes', 'tsb', genome)
+    if not os.path.isdir(genome_path):
+        raise ValueError(f'The reference genome {genome} is not installed, run setup/install_genome.py {genome} first.')
+    return genome_path
+
+
+def get_chromosomes(genome_path):
+    """Chromosomes SigProfilerMatrixGenerator counts: those with both a transcript and a tsb file"""
+    transcripts_path = os.path.join(os.path.dirname(os.path.dirname(genome_path)), 'transcripts', os.path.basename(genome_path))
+    return {
+        file_name.replace('_transcripts.txt', '')
+        for file_name in os.listdir(transcripts_path)
+        if not file_name.startswith('.')
+    } & {
+        os.path.splitext(file_name)[0]
+        for file_name in os.listdir(genome_path)
+        if file_name.endswith('.txt')
+    }
+
+
+def normalize_chrom(chrom):
+    if len(chrom) > 2:
+        chrom = chrom[3:]
+    chrom = NCBI_CHROMS.get(chrom, chrom)
+    if chrom.upper() == 'M' or chrom == 'mt':
+        chrom = 'MT'
+    return chrom
+
+
+def read_snvs(vcf_path, chromosomes):
+    """Reads a VCF's single base substitutions as {chrom: (positions, refs, alts)}
+
+    Filters like SigProfilerMatrixGenerator: doublet substitutions count as two SNVs, unrecognized
+    bases and repeated lines are skipped and a malformed line ends the file.
+    """
+    snvs = {}
+    prev_fields = None
+    with open(vcf_path) as f:
+        for line in f:
+            if line[0] == '#':
+                continue
+            fields = line.split()
+            if not fields:
+                continue
+            try:
+                chrom = normalize_chrom(fields[0])
+                pos, ref, alt = int(fields[1]), fields[3], fields[4]
+            except (IndexError, ValueError):
+                print(f'The given input file does not appear to be in the correct vcf format. Skipping the rest of: {vcf_path}')
+                break
+            if len(ref) == len(alt) and len(ref) in (1, 2) and '-' not in ref and '-' not in alt:
+                if any(r not in 'ACGT' or a not in 'ACGT' or r == a for r, a in zip(ref, alt)) or fields == prev_fields:
+                    continue
+                if chrom in chromosomes:
+                    positions, refs, alts = snvs.setdefault(chrom, ([], [], []))
+                    for i in range(len(ref)):
+                        positions.append(pos + i)
+                        refs.append(BASE_CODES[ref[i]])
+                        alts.append(BASE_CODES[alt[i]])
+            prev_fields = fields
+    return snvs
+
+
+def count_vcf(vcf_path, genome_path, chromosomes):
+    """Counts a VCF's SNVs into SBS96 features, looking up their contexts in the memory-mapped genome"""
+    feature_table = get_feature_table()
+    tsb_base_codes = np.array(TSB_BASE_CODES, dtype=np.int64)
+    counts = np.zeros(len(FEATURES), dtype=np.int64)
+    skipped = 0
+    for chrom, (positions, refs, alts) in read_snvs(vcf_path, chromosomes).items():
+        genome = np.memmap(os.path.join(genome_path, f'{chrom}.txt'), dtype=np.uint8, mode='r')
+        positions = np.array(positions, dtype=np.int64)
+        refs = np.array(refs, dtype=np.int64)
+        alts = np.array(alts, dtype=np.int64)
+        # The pentanucleotide around each position must lie on the chromosome and hold no N
+        in_range = (positions >= 3) & (positions + 1 < len(genome))
+        skipped += int((~in_range).sum())
+        positions, refs, alts = positions[in_range], refs[in_range], alts[in_range]
+        window = genome[positions[:, None] + np.arange(-3, 2)]
+        bases = tsb_base_codes[window]
+        valid = (bases[:, 2] == refs) & (bases < 4).all(axis=1)
+        skipped += int((~valid).sum())
+        rows = feature_table[bases[valid, 1], refs[valid], alts[valid], bases[valid, 3]]
+        counts += np.bincount(rows, minlength=len(FEATURES))
+    return counts, skipped
+
+
+class CatalogueCache:
+    """Persistent per-VCF SBS96 counts keyed by the file's content digest and the genome, with LRU eviction, stored in SQLite"""
+
+    def __init__(self, db_path, max_entries=DEFAULT_MAX_ENTRIES):
+        if os.path.dirname(db_path):
+            os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self.max_entries = max_entries
+        self.connection = sqlite3.connect(db_path)
+        with self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS catalogues '
+                '(key TEXT PRIMARY KEY, counts BLOB NOT NULL, skipped INTEGER NOT NULL, last_used REAL NOT NULL)'
+            )
+            self.connection.execute(
+                'CREATE INDEX IF NOT EXISTS catalogues_last_used ON catalogues (last_used)'
+            )
+
+    @staticmethod
+    def make_key(digest, genome):
+        return hashlib.sha256('\0'.join([digest, genome, COUNTER_VERSION]).encode()).hexdigest()
+
+    def get_many(self, keys):
+        """Returns {key: (counts, skipped)} of the cached keys"""
+        found = {}
+        with self.connection:
+            for key in set(keys):
+                row = self.connection.execute('SELECT counts, skipped FROM catalogues WHERE key = ?', (key,)).fetchone()
+                if row:
+                    found[key] = (np.frombuffer(row[0], dtype=np.int64), row[1])
+            self.connection.executemany('UPDATE catalogues SET last_used = ? WHERE key = ?', [(time.time(), key) for key in found])
+        return found
+
+    def put_many(self, items):
+        """Stores {key: (counts, skipped)} and evicts the least recently used beyond max_entries"""
+        now = time.time()
+        with self.connection:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO catalogues (key, counts, skipped, last_used) VALUES (?, ?, ?, ?)',
+                [(key, counts.astype(np.int64).tobytes(), skipped, now) for key, (counts, skipped) in items.items()]
+            )
+            excess = self.connection.execute('SELECT COUNT(*) FROM catalogues').fetchone()[0] - self.max_entries
+            if excess > 0:
+                self.connection.execute(
+                    'DELETE FROM catalogues WHERE key IN '
+                    '(SELECT key FROM catalogues ORDER BY last_used LIMIT ?)', (excess,)
+                )
+                print(f'Evicted {excess} least recently used catalogue(s) from the cache')
+
+    def close(self):
+        self.connection.close()
+
+
+def get_sample_name(vcf_file):
+    return vcf_file.split('.')[0]
+
+
+def main(vcf_dir, genome, output_path, workers=None, cache_path=None, cache_max_entries=DEFAULT_MAX_ENTRIES):
+    """Writes the SBS96 catalogue of every VCF in vcf_dir, counting one file per worker process
+
+    With a cache, only VCFs whose content was not counted before for this genome are counted.
+    """
+    genome_path = get_genome_path(genome)
+    chromosomes = get_chromosomes(genome_path)
+    vcf_files = sorted(f for f in os.listdir(vcf_dir) if f.endswith('.vcf') and not f.startswith('.'))
+    vcf_paths = [os.path.join(vcf_dir, vcf_file) for vcf_file in vcf_files]
+    samples = sorted({get_sample_name(f) for f in vcf_files})
+    cache = CatalogueCache(cache_path, cache_max_entries) if cache_path else None
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        # Without a cache every file is its own key, with one identical files are counted once
+        keys = [CatalogueCache.make_key(digest, genome) for digest in executor.map(file_digest, vcf_paths)] if cache else vcf_paths
+        results = cache.get_many(keys) if cache else {}
+        futures = {
+            key: executor.submit(count_vcf, vcf_path, genome_path, chromosomes)
+            for key, vcf_path in zip(keys, vcf_paths)
+            if key not in results
+        }
+        print(f'Counting {len(futures)} distinct uncached VCF(s) of {len(vcf_files)}')
+        counted = {key: future.result() for key, future in futures.items()}
+    if cache:
+        cache.put_many(counted)
+        cache.close()
+    results.update(counted)
+
+    counts = np.zeros((len(FEATURES), len(samples)), dtype=np.int64)
+    columns = {sample: i for i, sample in enumerate(samples)}
+    skipped = 0
+    for vcf_file, key in zip(vcf_files, keys):
+        vcf_counts, vcf_skipped = results[key]
+        # Files sharing a sample name before the first '.' are one sample
+        counts[:, columns[get_sample_name(vcf_file)]] += vcf_counts
+        skipped += vcf_skipped
+    print(f'Counted {int(counts.sum())} SNVs of {len(samples)} sample(s) from {len(vcf_files)} VCF(s), skipped {skipped}')
+    write_catalogue(FEATURES, samples, counts, output_path)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 4:
+        sys.exit("Need at least 3 arguments: vcf_dir genome output_path [workers] [--cache=PATH] [--cache-max-entries=N]")
+    vcf_dir = sys.argv[1]
+    genome = sys.argv[2]
+    output_path = sys.argv[3]
+    workers = None
+    cache_path = None
+    cache_max_entries = DEFAULT_MAX_ENTRIES
+    for arg in sys.argv[4:]:
+        if arg.startswith('--cache='):
+            cache_path = arg.split('=', 1)[1]
+        elif arg.startswith('--cache-max-entries='):
+            cache_max_entries = int(arg.split('=', 1)[1])
+        else:
+            workers = int(arg)
+
+    print(f'[{datetime.now().strftime("%Y-%m-%d %H:%M:%S")}] Start')
+    print(f'    - VCF Path: {vcf_dir}')
+    print(f'    - Genome: {genome}')
+    print(f'    - Output Path: {output_path}')
+    print(f'    - Cache Path: {cache_path}')
+    main(vcf_dir, genome, output_path, workers, cache_path, cache_max_entries)
+    print(f'[{datetime.now().strftime("%Y-%m-%d %H:%M:%S")}] Completed')
@@ -0,0 +1,75 @@
+import sys
+import os
+from datetime import datetime
+
+from workflow_utils import as_frequency_rowwise, load_reference, read_activities
+from EnsembleFit import run_ensemble
+from postprocess import QUALITATIVE_ENSEMBLES, write_results
+from fit_metrics import evaluate, read_observed, write_fit_metrics
+
+
+def main(sample_path,
+        reference_path,
+        output_path,
+        result_path,
+        strategy,
+        tools,
+        mean_mode='bootstrap',
+        tool_results_written=False):
+    """Runs EnsembleFit, post-processing and fit metrics in one pass, parsing each tool's output only once
+
+    With tool_results_written, the tools' results are already in result_path and only the ensembles are written.
+    Returns the per-tool summary of the fit metrics.
+    """
+    print(f'[{datetime.now().strftime("%Y-%m-%d %H:%M:%S")}] Reading results...')
+    # The samples are read once, for their names and for the fit metrics
+    all_samples, observed, signatures = read_observed(sample_path, reference_path)
+    all_sigs = load_reference(reference_path).signatures
+    fit = {}
+    for tool in tools:
+        df = read_activities(os.path.join(output_path, tool, f'{tool}_{strategy}.txt'), all_samples, all_sigs)
+        fit[tool] = as_frequency_rowwise(df)
+
+    ensembles = run_ensemble(fit, all_sigs, all_samples, mean_mode)
+    ensembles = {
+        # Qualitative Ensemble no need to convert to frequency
+        ensemble: df if ensemble in QUALITATIVE_ENSEMBLES else as_frequency_rowwise(df, sum_columns=all_sigs)
+        for ensemble, df in ensembles.items()
+    }
+    results = {**fit, **ensembles}
+
+    write_results(ensembles if tool_results_written else results, result_path, strategy)
+
+    print(f'[{datetime.now().strftime("%Y-%m-%d %H:%M:%S")}] Computing fit metrics...')
+    summary = write_fit_metrics(evaluate(all_samples, observed, signatures, all_sigs, results), result_path, strategy)
+
+    print(f'[{datetime.now().strftime("%Y-%m-%d %H:%M:%S")}] Completed')
+    return summary
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 6:
+        sys.exit("Need at least 6 arguments: sample_path reference_path output_path result_path strategy [tools] [--mean-mode=bootstrap|exact]")
+    sample_path = sys.argv[1]
+    reference_path = sys.argv[2]
+    output_path = sys.argv[3]
+    result_path = sys.argv[4]
+    strategy = sys.argv[5]
+    mean_mode = 'bootstrap'
+    tools = []
+    for arg in sys.argv[6:]:
+        if arg.startswith('--mean-mode='):
+            mean_mode = arg.split('=', 1)[1]
+        else:
+            tools.append(arg)
+
+    print(f'[{datetime.now().strftime("%Y-%m-%d %H:%M:%S")}] Start')
+    print(f'    - Sample Path: {sample_path}')
+    print(f'    - Reference Path: {reference_path}')
+    print(f'    - Output Path: {output_path}')
+    print(f'    - Result Path: {result_path}')
+    print(f'    - Strategy: {strategy}')
+    print(f'    - Tools: {", ".join(tools)}')
+    print(f'    - Ensemble-Mean Mode: {mean_mode}')
+
+    main(sample_path, reference_path, output_path, result_path, strategy, tools, mean_mode)
@@ -0,0 +1,108 @@
+import os
+import sys
+from datetime import datetime
+
+from workflow_utils import lazy_import, load_catalogue, load_reference, read_activities, reorder_catalogue
+from postprocess import QUALITATIVE_ENSEMBLES, get_tool_dir
+
+pd = lazy_import('pandas')
+np = lazy_import('numpy')
+
+
+def read_observed(sample_path, reference_path):
+    """Returns the samples, their (samples x features) counts and the column-normalized (features x signatures) reference"""
+    features, samples, counts = load_catalogue(sample_path)
+    _, counts = reorder_catalogue(features, counts, reference_path)
+    return samples, counts.T.astype(float), load_reference(reference_path).matrix
+
+
+def fit_quality(observed, signatures, frequencies):
+    """Compares every sample's counts with their reconstruction from its signature frequencies
+
+    frequencies is (samples x signatures), each row a share of the sample's mutations, so the
+    reconstruction of all samples is one matrix product. The L1 error is relative to the sample's
+    mutations, the L2 error to the norm of its counts.
+    """
+    totals = observed.sum(axis=1)
+    reconstructed = (frequencies * totals[:, None]) @ signatures.T
+    observed_norms = np.linalg.norm(observed, axis=1)
+    reconstructed_norms = np.linalg.norm(reconstructed, axis=1)
+    norms = observed_norms * reconstructed_norms
+    residuals = observed - reconstructed
+    return {
+        # A sample with nothing assigned has no direction, its similarity is 0
+        'cosine_similarity': np.divide(np.einsum('ij,ij->i', observed, reconstructed), norms,
+                                       out=np.zeros_like(norms), where=norms > 0),
+        'l1_error': np.abs(residuals).sum(axis=1) / totals,
+        'l2_error': np.linalg.norm(residuals, axis=1) / observed_norms,
+        'active_signatures': (frequencies > 0).sum(axis=1),
+    }
+
+
+def evaluate(samples, observed, signatures, all_sigs, fit):
+    """Fit quality of every sample under each tool's and quantitative ensemble's activities, one row per sample and tool"""
+    tables = []
+    for tool, df in fit.items():
+        # Qualitative ensembles mark signatures as present, they do not reconstruct the catalogue
+        if tool in QUALITATIVE_ENSEMBLES:
+            continue
+        frequencies = df.set_index('Samples').reindex(index=samples, columns=all_sigs).fillna(0).to_numpy(dtype=float)
+        table = pd.DataFrame(fit_quality(observed, signatures, frequencies))
+        table.insert(0, 'Tool', tool)
+        table.insert(0, 'Samples', samples)
+        tables.append(table)
+    return pd.concat(tables, ignore_index=True)
+
+
+def summarize(metrics):
+    """Per tool: samples, mean and minimum cosine similarity, mean errors and mean active signatures"""
+    grouped = metrics.groupby('Tool', sort=False)
+    return {
+        tool: {
+            'samples': len(table),
+            'cosine_similarity': float(table['cosine_similarity'].mean()),
+            'min_cosine_similarity': float(table['cosine_similarity'].min()),
+            'l1_error': float(table['l1_error'].mean()),
+            'l2_error': float(table['l2_error'].mean()),
+            'active_signatures': float(table['active_signatures'].mean()),
+        }
+        for tool, table in grouped
+    }
+
+
+def write_fit_metrics(metrics, result_path, strategy):
+    """Writes the per-sample fit quality next to the strategy's results, returns its per-tool summary"""
+    os.makedirs(result_path, exist_ok=True)
+    metrics.to_csv(os.path.join(result_path, f'fit_metrics_{strategy}.txt'), sep='\t', index=False, float_format='%.6g')
+    return summarize(metrics)
+
+
+def main(sample_path, reference_path, result_path, strategy, tools):
+    """Computes the fit quality of tools' results already written to result_path"""
+    all_sigs = load_reference(reference_path).signatures
+    samples, observed, signatures = read_observed(sample_path, reference_path)
+    # Results are written as frequencies of each sample's mutations
+    fit = {
+        tool: read_activities(os.path.join(result_path, get_tool_dir(tool), f'{tool}_{strategy}.txt'), samples, all_sigs)
+        for tool in tools
+    }
+    return write_fit_metrics(evaluate(samples, observed, signatures, all_sigs, fit), result_path, strategy)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 6:
+        sys.exit("Need at least 5 arguments: sample_path reference_path result_path strategy tools")
+    sample_path = sys.argv[1]
+    reference_path = sys.argv[2]
+    result_path = sys.argv[3]
+    strategy = sys.argv[4]
+    tools = sys.argv[5:]
+
+    print(f'[{datetime.now().strftime("%Y-%m-%d %H:%M:%S")}] Start')
+    print(f'    - Sample Path: {sample_path}')
+    print(f'    - Reference Path: {reference_path}')
+    print(f'    - Result Path: {result_path}')
+    print(f'    - Strategy: {strategy}')
+    print(f'    - Tools: {", ".join(tools)}')
+    main(sample_path, reference_path, result_path, strategy, tools)
+    print(f'[{datetime.now().strftime("%Y-%m-%d %H:%M:%S")}] Completed')
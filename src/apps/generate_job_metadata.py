@@ -2,7 +2,6 @@ import json
 import textwrap
 import os
 import sys
-import pandas as pd
 import datetime
 
 
@@ -12,6 +11,7 @@ tool_string = {
     'SignatureToolsLib': 'SignatureToolsLib (2.1.2)',
     'MutationalPatterns': 'MutationalPatterns (3.4.1)',
     'MutSignatures': 'MutSignatures (2.1.1)',
+    'FastNNLS': 'FastNNLS (built-in 1)',
 }
 
 analysis_description_string = {
@@ -21,16 +21,26 @@ analysis_description_string = {
 }
 
 
+def as_text(value):
+    return ', '.join(value) if isinstance(value, list) else value
+
+
 def main(config_path, matrix_path, output_path):
+    # Imported here so that importing tool_string stays cheap
+    import pandas as pd
+
     with open(config_path) as f:
         config = json.load(f)
 
-    genome = config['reference_build']
-    signature_reference = config['signature_reference']
-    analysis = config['analysis']
+    # Job manifests name these reference_build/analysis, assignment configs genome_reference/strategy
+    genome = config.get('reference_build', config.get('genome_reference'))
+    signature_reference = as_text(config['signature_reference'])
+    analysis = as_text(config.get('analysis', config.get('strategy')))
     mat = pd.read_csv(matrix_path, sep='\t')
     nsamples = mat.shape[1] - 1
     tools = config['tools']
+    if isinstance(tools, dict):
+        tools = [tool for tool, is_run in tools.items() if is_run]
 
 
     res = f'{"INPUT INFO".center(50, "=")}\n'
@@ -1,10 +1,10 @@
 import os
 import sys
 import shutil
-from SigProfilerMatrixGenerator.scripts import SigProfilerMatrixGeneratorFunc as matGen
 
 
 def main(vcf_dir, genome, project='mutsig'):
+    from SigProfilerMatrixGenerator.scripts import SigProfilerMatrixGeneratorFunc as matGen
     assert genome in ('GRCh37', 'GRCh38', 'mm39', 'mm10', 'mm9')
     matrices = matGen.SigProfilerMatrixGeneratorFunc(project,
                                                     genome,
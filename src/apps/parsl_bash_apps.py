@@ -1,25 +1,51 @@
 import os
+import shlex
 import parsl
-from parsl.app.app import bash_app
+from parsl.app.app import bash_app, python_app, join_app
+
+from common.parsl_common import LOCAL_EXECUTOR_LABEL, DEFAULT_EXECUTOR_LABEL, HEAVY_EXECUTOR_LABEL
+from apps.task_metrics import METRICS_DIR_ENV, measured
 
 
 REALPATH = os.path.dirname(os.path.realpath(__file__))
 TOOLS_PATHS = {
     'generate_matrix': os.path.join(REALPATH, 'generate_matrix.py'),
+    'count_sbs96': os.path.join(REALPATH, 'count_sbs96.py'),
     'SigProfilerAssignment': os.path.join(REALPATH, 'SigProfiler.py'),
     'Sigminer': os.path.join(REALPATH, 'Sigminer.r'),
     'SignatureToolsLib': os.path.join(REALPATH, 'SignatureToolsLib.r'),
     'MutationalPatterns': os.path.join(REALPATH, 'MutationalPatterns.r'),
     'MutSignatures': os.path.join(REALPATH, 'MutSignatures.r'),
-    'EnsembleFit': os.path.join(REALPATH, 'EnsembleFit.py'),
-    'postprocess': os.path.join(REALPATH, 'postprocess.py'),
-    'generate_job_metadata': os.path.join(REALPATH, 'generate_job_metadata.py')
+    'FastNNLS': os.path.join(REALPATH, 'FastNNLS.py'),
+    'ensemble_postprocess': os.path.join(REALPATH, 'ensemble_postprocess.py'),
+    'generate_job_metadata': os.path.join(REALPATH, 'generate_job_metadata.py'),
+    'tool_worker': os.path.join(REALPATH, 'tool_worker.py'),
+    'task_metrics': os.path.join(REALPATH, 'task_metrics.py')
 }
 
 
-@bash_app
+def metered(cmd, app, name, task_log=None):
+    """Runs the command through task_metrics.py to record its resource usage, if the job collects metrics
+
+    task_log is the task's stdout, which Parsl resolves per task before the app builds its command.
+    """
+    metrics_dir = os.environ.get(METRICS_DIR_ENV)
+    if not metrics_dir:
+        return cmd
+    return "python {metrics_path} {metrics_dir} {app} {name} {cmd} {task_log}".format(
+        metrics_path=TOOLS_PATHS['task_metrics'],
+        metrics_dir=shlex.quote(metrics_dir),
+        app=app,
+        name=shlex.quote(name),
+        cmd=shlex.quote(cmd),
+        task_log=shlex.quote(task_log) if isinstance(task_log, str) else ''
+    )
+
+
+@bash_app(cache=True, executors=[DEFAULT_EXECUTOR_LABEL])
 def generate_matrix(vcf_path,
                     reference_build,
+                    outputs=[],
                     stdout=parsl.AUTO_LOGNAME,
                     stderr=parsl.AUTO_LOGNAME):
     tool_path = TOOLS_PATHS['generate_matrix']
@@ -30,14 +56,41 @@ def generate_matrix(vcf_path,
         vcf_path=vcf_path,
         reference_build=reference_build
     )
-    return cmd
+    return metered(cmd, 'generate_matrix', f'generate_matrix {vcf_path}', stdout)
+
 
+@bash_app(cache=True, executors=[HEAVY_EXECUTOR_LABEL])
+def count_sbs96(vcf_path,
+                reference_build,
+                output_path,
+                cache_path=None,
+                cache_max_entries=None,
+                outputs=[],
+                stdout=parsl.AUTO_LOGNAME,
+                stderr=parsl.AUTO_LOGNAME):
+    tool_path = TOOLS_PATHS['count_sbs96']
+    cache_str = f'--cache={cache_path}' if cache_path else ''
+    if cache_path and cache_max_entries:
+        cache_str += f' --cache-max-entries={cache_max_entries}'
+    cmd = """
+    python {tool_path} {vcf_path} {reference_build} {output_path} {cache_str}
+    """.format(
+        tool_path=tool_path,
+        vcf_path=vcf_path,
+        reference_build=reference_build,
+        output_path=output_path,
+        cache_str=cache_str
+    )
+    return metered(cmd, 'count_sbs96', f'count_sbs96 {vcf_path}', stdout)
 
-@bash_app
+
+@bash_app(cache=True, executors=[HEAVY_EXECUTOR_LABEL])
 def SigProfilerAssignment(sample_path,
                           reference_path,
                           output_path,
                           strategy,
+                          inputs=[],
+                          outputs=[],
                           stdout=parsl.AUTO_LOGNAME,
                           stderr=parsl.AUTO_LOGNAME):
     tool_path = TOOLS_PATHS['SigProfilerAssignment']
@@ -51,14 +104,16 @@ def SigProfilerAssignment(sample_path,
         tool_output_path=tool_output_path,
         strategy=strategy
     )
-    return cmd
+    return metered(cmd, 'SigProfilerAssignment', f'SigProfilerAssignment {strategy} {output_path}', stdout)
 
 
-@bash_app
+@bash_app(cache=True, executors=[DEFAULT_EXECUTOR_LABEL])
 def Sigminer(sample_path,
              reference_path,
              output_path,
              strategy,
+             inputs=[],
+             outputs=[],
              stdout=parsl.AUTO_LOGNAME,
              stderr=parsl.AUTO_LOGNAME):
     tool_path = TOOLS_PATHS['Sigminer']
@@ -72,14 +127,16 @@ def Sigminer(sample_path,
         tool_output_path=tool_output_path,
         strategy=strategy
     )
-    return cmd
+    return metered(cmd, 'Sigminer', f'Sigminer {strategy} {output_path}', stdout)
 
 
-@bash_app
+@bash_app(cache=True, executors=[HEAVY_EXECUTOR_LABEL])
 def SignatureToolsLib(sample_path,
                       reference_path,
                       output_path,
                       strategy,
+                      inputs=[],
+                      outputs=[],
                       stdout=parsl.AUTO_LOGNAME,
                       stderr=parsl.AUTO_LOGNAME):
     tool_path = TOOLS_PATHS['SignatureToolsLib']
@@ -93,14 +150,16 @@ def SignatureToolsLib(sample_path,
         tool_output_path=tool_output_path,
         strategy=strategy
     )
-    return cmd
+    return metered(cmd, 'SignatureToolsLib', f'SignatureToolsLib {strategy} {output_path}', stdout)
 
 
-@bash_app
+@bash_app(cache=True, executors=[DEFAULT_EXECUTOR_LABEL])
 def MutationalPatterns(sample_path,
                        reference_path,
                        output_path,
                        strategy,
+                       inputs=[],
+                       outputs=[],
                        stdout=parsl.AUTO_LOGNAME,
                        stderr=parsl.AUTO_LOGNAME):
     tool_path = TOOLS_PATHS['MutationalPatterns']
@@ -114,14 +173,16 @@ def MutationalPatterns(sample_path,
         tool_output_path=tool_output_path,
         strategy=strategy
     )
-    return cmd
+    return metered(cmd, 'MutationalPatterns', f'MutationalPatterns {strategy} {output_path}', stdout)
 
 
-@bash_app
+@bash_app(cache=True, executors=[DEFAULT_EXECUTOR_LABEL])
 def MutSignatures(sample_path,
                   reference_path,
                   output_path,
                   strategy,
+                  inputs=[],
+                  outputs=[],
                   stdout=parsl.AUTO_LOGNAME,
                   stderr=parsl.AUTO_LOGNAME):
     tool_path = TOOLS_PATHS['MutSignatures']
@@ -135,94 +196,181 @@ def MutSignatures(sample_path,
         tool_output_path=tool_output_path,
         strategy=strategy
     )
-    return cmd
+    return metered(cmd, 'MutSignatures', f'MutSignatures {strategy} {output_path}', stdout)
 
 
-@bash_app
-def EnsembleFit(sample_path,
-                reference_path,
-                output_path,
-                strategy,
-                tools,
-                stdout=parsl.AUTO_LOGNAME,
-                stderr=parsl.AUTO_LOGNAME):
-    tool_path = TOOLS_PATHS['EnsembleFit']
-    tools_str = " ".join(tools)
-    cmd = """
-    python {tool_path} {sample_path} {reference_path} {output_path} {strategy} {tools_str}
-    """.format(
-        tool_path=tool_path,
-        sample_path=sample_path,
-        reference_path=reference_path,
-        output_path=output_path,
-        strategy=strategy,
-        tools_str=tools_str
-    )
-    return cmd
+@python_app(cache=True, executors=[LOCAL_EXECUTOR_LABEL])
+def FastNNLS(sample_path,
+             reference_path,
+             output_path,
+             strategy,
+             inputs=[],
+             outputs=[]):
+    # Runs in-process: no interpreter or R to start, the fit spreads its chunks over worker processes itself
+    import sys
+    if REALPATH not in sys.path:
+        sys.path.append(REALPATH)
+    from FastNNLS import main
+    # Recorded like the bash apps' runs, which go through task_metrics.py
+    with measured(os.environ.get(METRICS_DIR_ENV), 'FastNNLS', f'FastNNLS {strategy} {output_path}'):
+        main(str(sample_path), str(reference_path), os.path.join(output_path, 'FastNNLS'), strategy)
 
 
-@bash_app
-def postprocess(sample_path,
-                reference_path,
-                output_path,
-                result_path,
-                strategy,
-                tools,
-                stdout=parsl.AUTO_LOGNAME,
-                stderr=parsl.AUTO_LOGNAME):
-    tool_path = TOOLS_PATHS['postprocess']
-    tools_str = " ".join(tools)
-    cmd = """
-    python {tool_path} {sample_path} {reference_path} {output_path} {result_path} {strategy} {tools_str}
-    """.format(
-        tool_path=tool_path,
-        sample_path=sample_path,
-        reference_path=reference_path,
-        output_path=output_path,
-        result_path=result_path,
-        tools_str=tools_str,
-        strategy=strategy
-    )
-    return cmd
+@python_app(executors=[LOCAL_EXECUTOR_LABEL])
+def ensemble_postprocess(sample_path,
+                         reference_path,
+                         output_path,
+                         result_path,
+                         strategy,
+                         tools,
+                         mean_mode='bootstrap',
+                         inputs=[]):
+    # Runs in-process: the app scripts import each other as top-level modules
+    import sys
+    if REALPATH not in sys.path:
+        sys.path.append(REALPATH)
+    from ensemble_postprocess import main
+    # collect_activities wrote each tool's results
+    return main(sample_path, reference_path, output_path, result_path, strategy, tools, mean_mode, tool_results_written=True)
+
+
+@python_app(executors=[LOCAL_EXECUTOR_LABEL])
+def collect_activities(reference,
+                       tool,
+                       strategy,
+                       result_path,
+                       shard_paths=None,
+                       cache=None,
+                       intermediate_format='tsv',
+                       inputs=[]):
+    """Copies a tool's activities of one strategy out once its runs are done, without waiting for the other tools
 
+    Shard activities are merged back in the original sample order, and with a cache the fitted misses are
+    stored and every sample is filled in from it. The activities go to the reference's working directory for
+    EnsembleFit and, as frequencies, to the results directory.
+    """
+    import sys
+    if REALPATH not in sys.path:
+        sys.path.append(REALPATH)
+    import apps.workflow_utils as utils
+    from postprocess import write_results
+    tool_path = reference['tool_paths'].get(tool)
+    if shard_paths and tool_path:
+        utils.merge_activities(shard_paths, tool, strategy, tool_path, reference['all_sigs'], intermediate_format)
+    activities_path = os.path.join(reference['workdir'], tool, f'{tool}_{strategy}.txt')
+    if cache:
+        activities = dict(reference['cached'][tool][strategy])
+        if tool_path:
+            fitted = utils.read_activity_rows(
+                os.path.join(tool_path, tool, f'{tool}_{strategy}.txt'), reference['miss_digests'][tool])
+            cache.store(fitted, reference['reference_digest'], tool, strategy, reference['tool_versions'][tool])
+            activities.update(fitted)
+        utils.assemble_activities(reference['matrix'].columns[1:].tolist(), reference['digests'], activities,
+                                  reference['all_sigs'], activities_path, intermediate_format)
+    df = utils.read_activities(activities_path, utils.read_column_names(reference['sample_path']), reference['all_sigs'])
+    write_results({tool: utils.as_frequency_rowwise(df)}, result_path, strategy)
 
-@bash_app
+
+def warm_tool_app(tool, executor_label):
+    """Makes a bash app that runs the tool on its warm worker, spawning the tool when no worker is up"""
+    def app(sample_path,
+            reference_path,
+            output_path,
+            strategy,
+            inputs=[],
+            outputs=[],
+            stdout=parsl.AUTO_LOGNAME,
+            stderr=parsl.AUTO_LOGNAME):
+        # The node's worker runs in the working directory of whichever job started it
+        tool_output_path = os.path.abspath(os.path.join(output_path, tool))
+        cmd = """
+        python {worker_path} run {tool_path} {sample_path} {reference_path} {tool_output_path} {strategy}
+        """.format(
+            worker_path=TOOLS_PATHS['tool_worker'],
+            tool_path=TOOLS_PATHS[tool],
+            sample_path=os.path.abspath(str(sample_path)),
+            reference_path=os.path.abspath(str(reference_path)),
+            tool_output_path=tool_output_path,
+            strategy=strategy
+        )
+        return metered(cmd, f'{tool}_warm', f'{tool}_warm {strategy} {output_path}', stdout)
+    # Parsl names tasks and memoizes results by function name
+    app.__name__ = app.__qualname__ = f'{tool}_warm'
+    return bash_app(cache=True, executors=[executor_label])(app)
+
+
+@bash_app(executors=[DEFAULT_EXECUTOR_LABEL])
 def generate_job_metadata(config_path,
                           sample_path,
                           output_path,
+                          inputs=[],
                           stdout=parsl.AUTO_LOGNAME,
                           stderr=parsl.AUTO_LOGNAME):
     tool_path = TOOLS_PATHS['generate_job_metadata']
     cmd = """
-    source {conda_source_path}
-    conda activate {conda_env_name}
     python {tool_path} {config_path} {sample_path} {output_path}
     """.format(
-        conda_source_path=CONDA_SOURCE_PATH,
-        conda_env_name=ENSEMBLEFIT_CONDA_ENV,
         tool_path=tool_path,
         config_path=config_path,
         sample_path=sample_path,
         output_path=output_path
     )
-    return cmd
+    return metered(cmd, 'generate_job_metadata', f'generate_job_metadata {output_path}', stdout)
+
+
+@python_app(executors=[LOCAL_EXECUTOR_LABEL])
+def move_generated_matrix(vcf_path,
+                          working_path,
+                          inputs=[]):
+    """Moves SigProfilerMatrixGenerator's catalogue, inputs and logs out of the VCF directory into the working directory"""
+    import shutil
+    shutil.move(os.path.join(vcf_path, 'output/SBS/mutsig.SBS96.all'), os.path.join(working_path, 'mutsig.SBS96.all'))
+    os.makedirs(os.path.join(working_path, 'SigProfilerMatrixGenerator'), exist_ok=True)
+    shutil.move(os.path.join(vcf_path, 'input'), os.path.join(working_path, 'SigProfilerMatrixGenerator', 'input'))
+    shutil.move(os.path.join(vcf_path, 'logs'), os.path.join(working_path, 'SigProfilerMatrixGenerator', 'logs'))
+
+
+@python_app(executors=[LOCAL_EXECUTOR_LABEL])
+def validate_matrix(matrix_path,
+                    diagnostics_path,
+                    inputs=[]):
+    """Reads and validates the matrix in a single pass, writes its per-sample diagnostics
 
+    Returns (features, samples, counts) for every reference's runs.
+    """
+    import logging
+    import apps.workflow_utils as utils
+    features, samples, counts, diagnostics = utils.read_catalogue(matrix_path)
+    diagnostics.to_csv(diagnostics_path, sep='\t')
+    logging.getLogger('ensemblefit').info("Matrix: %d sample(s), %d to %d mutations per sample", len(samples),
+                                          diagnostics['total_mutations'].min(), diagnostics['total_mutations'].max())
+    return features, samples, counts
 
-@bash_app
+
+@join_app
+def submit_after(submit, *args):
+    """Calls submit with the results of the futures among args once they are done, submit returns a single future"""
+    return submit(*args)
+
+
+@python_app(executors=[LOCAL_EXECUTOR_LABEL])
+def gather(names, *results):
+    """Pairs each name with the result of its future"""
+    return dict(zip(names, results))
+
+
+@bash_app(executors=[DEFAULT_EXECUTOR_LABEL])
 def finalize_workflow(*futures,
-                      outputs=None,
                       stdout=parsl.AUTO_LOGNAME,
                       stderr=parsl.AUTO_LOGNAME):
+    # The job writes its complete file itself, once the metrics are written and the working directory is removed
     futures_str = ' '.join(['"{}"'.format(x) for x in futures])
     cmd = """
     printf "`date` futures: {futures_str} \\n"
-    printf `date` > {complete_filepath}
-    printf "`date` complete file created: {complete_filepath} \\n"
     """.format(
-        futures_str=futures_str,
-        complete_filepath=outputs[0]
+        futures_str=futures_str
     )
-    return cmd
+    return metered(cmd, 'finalize_workflow', 'finalize_workflow', stdout)
 
 
 TOOLS_APPS = {
@@ -231,8 +379,23 @@ TOOLS_APPS = {
     'SignatureToolsLib': SignatureToolsLib,
     'MutationalPatterns': MutationalPatterns,
     'MutSignatures': MutSignatures,
-    'EnsembleFit': EnsembleFit,
+    'FastNNLS': FastNNLS,
     'generate_matrix': generate_matrix,
-    'postprocess': postprocess,
-    'generate_job_metadata': generate_job_metadata
+    'count_sbs96': count_sbs96,
+    'ensemble_postprocess': ensemble_postprocess,
+    'collect_activities': collect_activities,
+    'generate_job_metadata': generate_job_metadata,
+    'move_generated_matrix': move_generated_matrix,
+    'validate_matrix': validate_matrix,
+    'submit_after': submit_after,
+    'gather': gather,
+    'finalize_workflow': finalize_workflow
+}
+
+WARM_TOOLS_APPS = {
+    'SigProfilerAssignment': warm_tool_app('SigProfilerAssignment', HEAVY_EXECUTOR_LABEL),
+    'Sigminer': warm_tool_app('Sigminer', DEFAULT_EXECUTOR_LABEL),
+    'SignatureToolsLib': warm_tool_app('SignatureToolsLib', HEAVY_EXECUTOR_LABEL),
+    'MutationalPatterns': warm_tool_app('MutationalPatterns', DEFAULT_EXECUTOR_LABEL),
+    'MutSignatures': warm_tool_app('MutSignatures', DEFAULT_EXECUTOR_LABEL)
 }
@@ -0,0 +1,218 @@
+import os
+import sys
+import json
+import time
+import uuid
+import socket
+import resource
+import subprocess
+import contextlib
+
+# Bash apps record their resource usage into this directory when it is set
+METRICS_DIR_ENV = 'ENSEMBLEFIT_METRICS_DIR'
+# A command whose work runs in another process, a warm worker's tool, writes that process's usage to this file
+TASK_USAGE_ENV = 'ENSEMBLEFIT_TASK_USAGE'
+PROC_IO_PATH = '/proc/self/io'
+THREAD_IO_PATH = '/proc/thread-self/io'
+IO_KEYS = ['read_bytes', 'write_bytes', 'rchar', 'wchar']
+MB = 1024 ** 2
+
+
+def read_io(path=PROC_IO_PATH):
+    """Bytes read and written by this process and its reaped children, or by this thread, as counted by Linux, else None"""
+    try:
+        with open(path) as f:
+            return {key: int(value) for key, value in (line.split(': ') for line in f)}
+    except OSError:
+        return None
+
+
+def run(metrics_dir, app, name, command, task_log=None):
+    """Runs command in bash, writes its resource usage to metrics_dir and returns its exit code
+
+    User/sys CPU and I/O cover the whole process tree, the peak RSS is that of its largest process.
+    The usage a warm worker reports for the tool it ran for the command is added, its peak RSS being that
+    of the worker's tool process so far. task_log, the Parsl task's stdout, tells apart the tasks and ties
+    every attempt to its task.
+    """
+    os.makedirs(metrics_dir, exist_ok=True)
+    usage_path = os.path.join(metrics_dir, f'{app}-{uuid.uuid4().hex}.usage')
+    io_before = read_io()
+    started = time.time()
+    process = subprocess.Popen(['bash', '-c', command], env={**os.environ, TASK_USAGE_ENV: usage_path})
+    _, status, rusage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    io_after = read_io()
+    record = {
+        'app': app,
+        'name': name,
+        'task_log': task_log,
+        'host': socket.gethostname(),
+        'started': started,
+        'wall_seconds': time.time() - started,
+        'user_seconds': rusage.ru_utime,
+        'sys_seconds': rusage.ru_stime,
+        # ru_maxrss is in KB on Linux
+        'peak_rss_mb': rusage.ru_maxrss / 1024,
+        'exit_code': process.returncode,
+    }
+    if io_before and io_after:
+        record.update({key: io_after[key] - io_before[key] for key in IO_KEYS})
+    else:
+        # Blocks of 512 bytes, without the reads and writes served by the page cache
+        record.update({'read_bytes': rusage.ru_inblock * 512, 'write_bytes': rusage.ru_oublock * 512, 'rchar': None, 'wchar': None})
+    if os.path.exists(usage_path):
+        with open(usage_path) as f:
+            record['worker_usage'] = json.load(f)
+        os.remove(usage_path)
+        for key, value in record['worker_usage'].items():
+            if key == 'peak_rss_mb':
+                record[key] = max(record[key], value)
+            elif record[key] is not None:
+                record[key] += value
+    write_record(metrics_dir, record)
+    return process.returncode
+
+
+def write_record(metrics_dir, record):
+    os.makedirs(metrics_dir, exist_ok=True)
+    # One file per run, retries and concurrent tasks never write to the same file
+    with open(os.path.join(metrics_dir, f'{record["app"]}-{uuid.uuid4().hex}.json'), 'w') as f:
+        json.dump(record, f)
+
+
+@contextlib.contextmanager
+def measured(metrics_dir, app, name):
+    """Records the resource usage of a Python app's code, run in this thread, like run does for a command
+
+    Nothing is recorded without metrics_dir. User/sys CPU is the thread's plus that of the child processes
+    reaped meanwhile, I/O is the thread's own. The peak RSS is the largest of the workflow process and any
+    of its children so far, as the thread shares its memory with the whole process.
+    """
+    if not metrics_dir:
+        yield
+        return
+    thread_usage = getattr(resource, 'RUSAGE_THREAD', resource.RUSAGE_SELF)
+    io_before = read_io(THREAD_IO_PATH)
+    usage_before = [resource.getrusage(who) for who in [thread_usage, resource.RUSAGE_CHILDREN]]
+    started = time.time()
+    exit_code = 1
+    try:
+        yield
+        exit_code = 0
+    finally:
+        wall_seconds = time.time() - started
+        usage_after = [resource.getrusage(who) for who in [thread_usage, resource.RUSAGE_CHILDREN]]
+        io_after = read_io(THREAD_IO_PATH)
+        record = {
+            'app': app,
+            'name': name,
+            'task_log': None,
+            'host': socket.gethostname(),
+            'started': started,
+            'wall_seconds': wall_seconds,
+            'user_seconds': sum(after.ru_utime - before.ru_utime for before, after in zip(usage_before, usage_after)),
+            'sys_seconds': sum(after.ru_stime - before.ru_stime for before, after in zip(usage_before, usage_after)),
+            # ru_maxrss is in KB on Linux
+            'peak_rss_mb': max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, usage_after[1].ru_maxrss) / 1024,
+            'exit_code': exit_code,
+        }
+        if io_before and io_after:
+            record.update({key: io_after[key] - io_before[key] for key in IO_KEYS})
+        else:
+            record.update({
+                'read_bytes': sum(after.ru_inblock - before.ru_inblock for before, after in zip(usage_before, usage_after)) * 512,
+                'write_bytes': sum(after.ru_oublock - before.ru_oublock for before, after in zip(usage_before, usage_after)) * 512,
+                'rchar': None, 'wchar': None,
+            })
+        write_record(metrics_dir, record)
+
+
+def read_metrics(metrics_dir):
+    """Reads every task's record in metrics_dir, in start order"""
+    if not os.path.isdir(metrics_dir):
+        return []
+    records = []
+    for file_name in os.listdir(metrics_dir):
+        if file_name.endswith('.json'):
+            with open(os.path.join(metrics_dir, file_name)) as f:
+                records.append(json.load(f))
+    return sorted(records, key=lambda record: record['started'])
+
+
+def summarize(records):
+    """Totals the tasks of each app, the app with the most wall time first"""
+    apps = {}
+    for record in records:
+        totals = apps.setdefault(record['app'], {
+            'tasks': 0, 'failed': 0, 'wall_seconds': 0.0, 'user_seconds': 0.0, 'sys_seconds': 0.0,
+            'peak_rss_mb': 0.0, 'read_bytes': 0, 'write_bytes': 0,
+        })
+        totals['tasks'] += 1
+        totals['failed'] += record['exit_code'] != 0
+        for key in ['wall_seconds', 'user_seconds', 'sys_seconds', 'read_bytes', 'write_bytes']:
+            totals[key] += record[key]
+        totals['peak_rss_mb'] = max(totals['peak_rss_mb'], record['peak_rss_mb'])
+    return dict(sorted(apps.items(), key=lambda item: item[1]['wall_seconds'], reverse=True))
+
+
+def format_row(values, name):
+    # Names vary in length and go last so the columns stay aligned
+    return ''.join(f'{value:>12}' for value in values) + f'  {name}\n'
+
+
+def format_summary(records, apps):
+    header = ['Tasks', 'Wall (s)', 'User (s)', 'Sys (s)', 'Peak (MB)', 'Read (MB)', 'Write (MB)']
+    res = f'{"TASK RESOURCES".center(50, "=")}\n'
+    res += format_row(header, 'App')
+    for app, totals in apps.items():
+        res += format_row([
+            totals['tasks'], f'{totals["wall_seconds"]:.1f}', f'{totals["user_seconds"]:.1f}', f'{totals["sys_seconds"]:.1f}',
+            f'{totals["peak_rss_mb"]:.0f}', f'{totals["read_bytes"] / MB:.1f}', f'{totals["write_bytes"] / MB:.1f}',
+        ], app)
+    res += '\n' + format_row(['Exit'] + header[1:], 'Task')
+    for record in records:
+        res += format_row([
+            record['exit_code'], f'{record["wall_seconds"]:.1f}', f'{record["user_seconds"]:.1f}', f'{record["sys_seconds"]:.1f}',
+            f'{record["peak_rss_mb"]:.0f}', f'{record["read_bytes"] / MB:.1f}', f'{record["write_bytes"] / MB:.1f}',
+        ], record['name'])
+    res += f'{"".center(50, "=")}\n'
+    return res
+
+
+def format_fit_quality(fit_quality):
+    header = ['Samples', 'Cosine', 'Min cosine', 'L1 error', 'L2 error', 'Active sigs']
+    res = f'{"FIT QUALITY".center(50, "=")}\n'
+    res += format_row(header, 'Results')
+    for name, tools in fit_quality.items():
+        for tool, summary in tools.items():
+            res += format_row([
+                summary['samples'], f'{summary["cosine_similarity"]:.4f}', f'{summary["min_cosine_similarity"]:.4f}',
+                f'{summary["l1_error"]:.4f}', f'{summary["l2_error"]:.4f}', f'{summary["active_signatures"]:.1f}',
+            ], f'{name} {tool}')
+    res += f'{"".center(50, "=")}\n'
+    return res
+
+
+def write_metrics(metrics_dir, json_path, text_path, fit_quality=None):
+    """Writes the job's task records and per-app totals as JSON and as a text summary
+
+    fit_quality, the per-tool summary of each result directory's fit metrics, is added to both.
+    """
+    records = read_metrics(metrics_dir)
+    apps = summarize(records)
+    with open(json_path, 'w') as f:
+        json.dump({'apps': apps, 'tasks': records, 'fit_quality': fit_quality or {}}, f, indent=4)
+    with open(text_path, 'w') as f:
+        f.write(format_summary(records, apps))
+        if fit_quality:
+            f.write('\n' + format_fit_quality(fit_quality))
+    return apps
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 5:
+        sys.exit("Need at least 4 arguments: metrics_dir app name command [task_log]")
+    exit_code = run(sys.argv[1], sys.argv[2], sys.argv[3], sys.argv[4], sys.argv[5] if len(sys.argv) > 5 else None)
+    # A command killed by a signal exits like it would from bash
+    sys.exit(exit_code if exit_code >= 0 else 128 - exit_code)
@@ -0,0 +1,289 @@
+import os
+import sys
+import json
+import time
+import queue
+import signal
+import socket
+import logging
+import threading
+import subprocess
+import traceback
+import socketserver
+import importlib.util
+
+logging.basicConfig()
+LOGGER = logging.getLogger(__name__)
+LOGGER.setLevel(logging.INFO)
+
+REALPATH = os.path.dirname(os.path.realpath(__file__))
+R_WORKER_PATH = os.path.join(REALPATH, 'tool_worker.r')
+# Private to the user: whoever can reach a worker's socket runs the tools as that user
+WORKER_DIR = os.environ.get('ENSEMBLEFIT_WORKER_DIR', f'/tmp/ensemblefit-{os.getuid()}/workers')
+# Marks the child's replies on stdout, any other line is the tool's own output. On stderr, a line of it alone
+# ends the request's errors
+RESPONSE_PREFIX = 'ENSEMBLEFIT_WORKER\t'
+START_TIMEOUT = 10
+
+
+def get_worker_name(tool_path):
+    return os.path.splitext(os.path.basename(tool_path))[0]
+
+
+def get_socket_path(tool_path):
+    return os.path.join(WORKER_DIR, f'{get_worker_name(tool_path)}.sock')
+
+
+def is_private(path):
+    """Whether path is owned by this user and neither readable nor writable by anyone else"""
+    stat_result = os.lstat(path)
+    return stat_result.st_uid == os.getuid() and not stat_result.st_mode & 0o077
+
+
+def make_worker_dir():
+    """Creates the worker directory private to this user, raises PermissionError if it is not"""
+    os.makedirs(WORKER_DIR, mode=0o700, exist_ok=True)
+    if not is_private(WORKER_DIR):
+        raise PermissionError(f'The worker directory {WORKER_DIR} must be owned by this user and not accessible by others.')
+
+
+def connect(tool_path):
+    """Connects to the tool's worker, only if the worker directory and socket are this user's"""
+    socket_path = get_socket_path(tool_path)
+    if not is_private(WORKER_DIR) or os.lstat(socket_path).st_uid != os.getuid():
+        raise PermissionError(f'The worker socket {socket_path} is not private to this user.')
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(socket_path)
+    except OSError:
+        client.close()
+        raise
+    return client
+
+
+def get_tool_command(tool_path):
+    if tool_path.endswith('.r'):
+        return ['Rscript', tool_path]
+    return ['python', tool_path]
+
+
+def get_child_command(tool_path):
+    if tool_path.endswith('.r'):
+        return ['Rscript', R_WORKER_PATH, tool_path]
+    return ['python', os.path.realpath(__file__), 'child', tool_path]
+
+
+def read_process_usage(pid):
+    """CPU seconds of a process and its reaped children, its peak RSS so far and its I/O, from /proc, else None"""
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            # Fields after the command name, which may hold spaces: utime, stime, cutime and cstime are the 12th to 15th
+            fields = f.read().rsplit(')', 1)[1].split()
+        with open(f'/proc/{pid}/status') as f:
+            peak_rss_kb = next(int(line.split()[1]) for line in f if line.startswith('VmHWM:'))
+        with open(f'/proc/{pid}/io') as f:
+            io = {key: int(value) for key, value in (line.split(': ') for line in f)}
+    except (OSError, StopIteration):
+        return None
+    ticks = os.sysconf('SC_CLK_TCK')
+    return {
+        'user_seconds': (int(fields[11]) + int(fields[13])) / ticks,
+        'sys_seconds': (int(fields[12]) + int(fields[14])) / ticks,
+        'peak_rss_mb': peak_rss_kb / 1024,
+        **{key: io[key] for key in ['read_bytes', 'write_bytes', 'rchar', 'wchar']},
+    }
+
+
+def usage_delta(before, after):
+    """A request's usage: the difference of every counter, the process's peak RSS so far"""
+    if before is None or after is None:
+        return None
+    return {key: after[key] if key == 'peak_rss_mb' else after[key] - before[key] for key in after}
+
+
+class ToolProcess:
+    """A tool child process that runs one request at a time over its stdin/stdout"""
+
+    def __init__(self, tool_path):
+        self.tool_path = tool_path
+        self.process = None
+        self.errors = None
+
+    def start(self):
+        self.process = subprocess.Popen(get_child_command(self.tool_path), stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                        stderr=subprocess.PIPE, text=True)
+        # Read as it is written, a child blocked on a full stderr pipe would never reply on stdout
+        self.errors = queue.Queue()
+        threading.Thread(target=self.read_errors, args=(self.process.stderr, self.errors), daemon=True).start()
+
+    @staticmethod
+    def read_errors(stream, errors):
+        for line in stream:
+            errors.put(line)
+        errors.put(None)
+
+    def get_errors(self):
+        """Returns the child's stderr of the current request, up to its end marker or the child's exit"""
+        lines = []
+        while (line := self.errors.get()) is not None and line.rstrip('\n') != RESPONSE_PREFIX:
+            lines.append(line)
+        return ''.join(lines)
+
+    def run(self, args):
+        """Runs the tool with the given arguments, returns its status, message, output, errors and resource usage"""
+        if self.process is None or self.process.poll() is not None:
+            self.start()
+        usage = read_process_usage(self.process.pid)
+        self.process.stdin.write('\t'.join(args) + '\n')
+        self.process.stdin.flush()
+        output = []
+        for line in self.process.stdout:
+            if line.startswith(RESPONSE_PREFIX):
+                status, _, message = line[len(RESPONSE_PREFIX):].rstrip('\n').partition(' ')
+                return {'status': status, 'message': message, 'output': ''.join(output), 'errors': self.get_errors(),
+                        'usage': usage_delta(usage, read_process_usage(self.process.pid))}
+            output.append(line)
+        # The child exited mid-request, it is restarted on the next one
+        self.process.wait()
+        self.process = None
+        return {'status': 'error', 'message': f'{get_worker_name(self.tool_path)} worker exited', 'output': ''.join(output),
+                'errors': self.get_errors(), 'usage': None}
+
+
+class ToolRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        line = self.rfile.readline()
+        # Liveness probes connect without sending a request
+        if not line:
+            return
+        request = json.loads(line)
+        tool_process = self.server.tool_processes.get()
+        try:
+            response = tool_process.run(request['args'])
+        finally:
+            self.server.tool_processes.put(tool_process)
+        self.wfile.write((json.dumps(response) + '\n').encode())
+
+
+class ToolServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, tool_path, runners):
+        self.tool_processes = queue.Queue()
+        for _ in range(runners):
+            tool_process = ToolProcess(tool_path)
+            tool_process.start()
+            self.tool_processes.put(tool_process)
+        super().__init__(get_socket_path(tool_path), ToolRequestHandler)
+
+
+def is_worker_up(tool_path):
+    try:
+        with connect(tool_path):
+            return True
+    except OSError:
+        return False
+
+
+def serve(tool_path, runners=1):
+    """Serves tool requests on the tool's socket until terminated"""
+    socket_path = get_socket_path(tool_path)
+    make_worker_dir()
+    if is_worker_up(tool_path):
+        LOGGER.info("%s worker is already up", get_worker_name(tool_path))
+        return
+    # Left behind by a worker that did not shut down cleanly
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    with ToolServer(tool_path, runners) as server:
+        LOGGER.info("%s worker serving on %s with %d runner(s)", get_worker_name(tool_path), socket_path, runners)
+        try:
+            server.serve_forever()
+        finally:
+            os.remove(socket_path)
+
+
+def start_worker(tool_path, runners=1):
+    """Starts a detached worker for the tool unless one is already up on this node"""
+    if is_worker_up(tool_path):
+        return
+    try:
+        make_worker_dir()
+    except PermissionError as e:
+        LOGGER.warning("Not starting a %s worker, its runs spawn the tool | %s", get_worker_name(tool_path), e)
+        return
+    with open(os.path.join(WORKER_DIR, f'{get_worker_name(tool_path)}.log'), 'a') as log:
+        subprocess.Popen(['python', os.path.realpath(__file__), 'serve', tool_path, str(runners)],
+                         stdout=log, stderr=log, start_new_session=True)
+    # Runs submitted before the socket is up spawn the tool instead
+    deadline = time.time() + START_TIMEOUT
+    while not is_worker_up(tool_path) and time.time() < deadline:
+        time.sleep(0.1)
+
+
+def dispatch(tool_path, args):
+    """Sends a run to the tool's worker, returns its response or None when no worker is up"""
+    try:
+        client = connect(tool_path)
+    except PermissionError as e:
+        LOGGER.warning("%s", e)
+        return None
+    except OSError:
+        return None
+    with client, client.makefile('rwb') as stream:
+        stream.write((json.dumps({'args': args}) + '\n').encode())
+        stream.flush()
+        return json.loads(stream.readline())
+
+
+def run(tool_path, args):
+    # Runs as a script, next to task_metrics.py
+    from task_metrics import TASK_USAGE_ENV
+    response = dispatch(tool_path, args)
+    if response is None:
+        LOGGER.info("No %s worker is up, spawning the tool", get_worker_name(tool_path))
+        return subprocess.call(get_tool_command(tool_path) + args)
+    # The tool ran in the worker, task_metrics.py adds its usage to this client's
+    if os.environ.get(TASK_USAGE_ENV) and response.get('usage'):
+        with open(os.environ[TASK_USAGE_ENV], 'w') as f:
+            json.dump(response['usage'], f)
+    print(response['output'], end='')
+    # The tool's errors go to this task's stderr, as they would from a spawned tool
+    print(response['errors'], end='', file=sys.stderr)
+    if response['status'] != 'ok':
+        sys.exit(f"{get_worker_name(tool_path)} failed: {response['message']}")
+    return 0
+
+
+def child(tool_path):
+    """Runs requests of a Python tool in this process, with its imports loaded once"""
+    spec = importlib.util.spec_from_file_location(get_worker_name(tool_path), tool_path)
+    tool = importlib.util.module_from_spec(spec)
+    sys.path.insert(0, os.path.dirname(tool_path))
+    spec.loader.exec_module(tool)
+    for line in sys.stdin:
+        try:
+            tool.main(*line.rstrip('\n').split('\t'))
+            status = 'ok'
+        except Exception as e:
+            status = 'error ' + str(e).replace('\n', ' ')
+            traceback.print_exc()
+        print(RESPONSE_PREFIX, file=sys.stderr, flush=True)
+        print(RESPONSE_PREFIX + status, flush=True)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        sys.exit("Need at least 2 arguments: {serve,run,child} tool_path [runners | tool arguments]")
+    command = sys.argv[1]
+    tool_path = sys.argv[2]
+
+    if command == 'serve':
+        serve(tool_path, int(sys.argv[3]) if len(sys.argv) > 3 else 1)
+    elif command == 'run':
+        sys.exit(run(tool_path, sys.argv[3:]))
+    elif command == 'child':
+        child(tool_path)
+    else:
+        sys.exit(f"Unknown command: {command}. Must be one of: serve, run, child.")
@@ -0,0 +1,29 @@
+args <- commandArgs(trailingOnly=TRUE)
+if (length(args) < 1) {
+    stop("Need 1 argument: tool_path", call.=FALSE)
+}
+tool_path <- args[1]
+response_prefix <- "ENSEMBLEFIT_WORKER\t"
+
+##############################
+# MAIN
+##############################
+# Each request is one line of tab-separated tool arguments. The tool script is sourced
+# with those arguments as its commandArgs, so its libraries stay loaded between requests.
+input <- file("stdin", "r")
+while (length(line <- readLines(input, n=1)) > 0) {
+    request_args <- strsplit(line, "\t", fixed=TRUE)[[1]]
+    env <- new.env(parent=globalenv())
+    env$commandArgs <- function(trailingOnly=FALSE) { request_args }
+    status <- tryCatch({
+        source(tool_path, local=env)
+        "ok"
+    }, error=function(e) {
+        paste("error", gsub("\n", " ", conditionMessage(e)))
+    })
+    # Ends the request's errors on stderr, then replies on stdout
+    cat(response_prefix, "\n", sep="", file=stderr())
+    cat(paste0(response_prefix, status), "\n", sep="")
+    flush(stdout())
+}
+close(input)
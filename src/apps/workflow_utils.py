@@ -1,62 +1,374 @@
-import pandas as pd
 import os
+import sys
+import json
+import shutil
+import tempfile
+import functools
+import collections
+import importlib.util
 
+# The app scripts also run as top-level modules, with only their own directory on sys.path
+SRC_PATH = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+if SRC_PATH not in sys.path:
+    sys.path.append(SRC_PATH)
 
-def is_valid_matrix(matrix_path):
-    """Check if the matrix is a valid SBS96 catalogue/matrix"""
-    matrix = pd.read_csv(matrix_path, sep='\t')
-    # Check if matrix is 96xN where N is the number of samples + 1
-    if matrix.shape[0] != 96 or matrix.shape[1] < 2:
-        return False
-    sbs96_features = [f'{b3}[{sub}]{b5}' \
-                        for b3 in 'ACGT' \
-                        for sub in ['C>A', 'C>G', 'C>T', 'T>A', 'T>C', 'T>G'] \
-                        for b5 in 'ACGT']
-    # Check if all 96 features are present
-    if set(matrix.iloc[:, 0]) != set(sbs96_features):
-        return False
-    # Check if all values are integers
-    if all(matrix.iloc[:, 1:].dtypes != int):
-        return False
-    # Check if all values are non-negative
-    if any(matrix.iloc[:, 1:].min(axis=0) < 0):
-        return False
-    # Check if all samples have more than 0 mutations
-    if any(matrix.iloc[:, 1:].sum(axis=0) == 0):
-        return False
-    return True
-    
-
-def throw_invalid_matrix_error(matrix_path):
-    """Throws the relevant error message for an INVALID matrix"""
-    matrix = pd.read_csv(matrix_path, sep='\t')
-    if matrix.shape[0] != 96 or matrix.shape[1] < 2:
-        raise ValueError(f'Matrix shape {matrix.shape} is invalid. Must be (96, N+1) where N is the number of samples.')
-    sbs96_features = [f'{b3}[{sub}]{b5}' \
-                        for b3 in 'ACGT' \
-                        for sub in ['C>A', 'C>G', 'C>T', 'T>A', 'T>C', 'T>G'] \
-                        for b5 in 'ACGT']
-    if set(matrix.iloc[:, 0]) != set(sbs96_features):
+from common.utils import file_digest
+
+
+def lazy_import(name):
+    """Returns the module, loaded on first attribute access unless it is already imported"""
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+
+pd = lazy_import('pandas')
+np = lazy_import('numpy')
+
+# Formats of the tables passed between internal stages, results/ is always TSV
+INTERMEDIATE_FORMATS = ('tsv', 'npy')
+
+# Signature references parsed once per content, shared by every stage and job of the user on the node
+REFERENCE_REGISTRY_PATH = os.environ.get('ENSEMBLEFIT_REFERENCE_REGISTRY', f'/tmp/ensemblefit-{os.getuid()}/references')
+# Bump when the artifacts change so entries built by earlier versions are not reused
+REFERENCE_REGISTRY_VERSION = '1'
+
+
+SBS96_FEATURES = [f'{b3}[{sub}]{b5}'
+                  for b3 in 'ACGT'
+                  for sub in ['C>A', 'C>G', 'C>T', 'T>A', 'T>C', 'T>G']
+                  for b5 in 'ACGT']
+
+
+def parse_counts(fields):
+    """Parses one feature's counts, returns them with a mask of the fields that are integers"""
+    try:
+        return np.array(fields, dtype=np.int64), np.ones(len(fields), dtype=bool)
+    except ValueError:
+        counts = np.zeros(len(fields), dtype=np.int64)
+        is_integer = np.zeros(len(fields), dtype=bool)
+        for i, field in enumerate(fields):
+            try:
+                counts[i] = int(field)
+                is_integer[i] = True
+            except ValueError:
+                pass
+        return counts, is_integer
+
+
+def read_catalogue(matrix_path):
+    """Reads and validates an SBS96 catalogue in one pass over its feature rows
+
+    Returns the features, samples, a (96, N) count array and per-sample diagnostics, and raises
+    the relevant error message for an INVALID matrix.
+    """
+    with open(matrix_path) as f:
+        samples = f.readline().rstrip('\r\n').split('\t')[1:]
+        features = []
+        rows = []
+        is_integer = np.ones(len(samples), dtype=bool)
+        for line in f:
+            fields = line.rstrip('\r\n').split('\t')
+            if fields == ['']:
+                continue
+            if len(fields) != len(samples) + 1 or len(rows) == 96:
+                rows.append(None)
+                continue
+            counts, row_is_integer = parse_counts(fields[1:])
+            features.append(fields[0])
+            rows.append(counts)
+            is_integer &= row_is_integer
+    if len(rows) != 96 or any(row is None for row in rows) or not samples:
+        raise ValueError(f'Matrix shape {(len(rows), len(samples) + 1)} is invalid. Must be (96, N+1) where N is the number of samples.')
+    if set(features) != set(SBS96_FEATURES):
         raise ValueError('Matrix does not contain all 96 SBS96 features.')
-    
-    invalid_samples = []
-    for sample in matrix.columns[1:]:
-        if matrix[sample].dtypes != int or matrix[sample].min() < 0 or matrix[sample].sum() == 0:
-            invalid_samples.append(sample)
+    duplicate_samples = [sample for sample, count in collections.Counter(samples).items() if count > 1]
+    if duplicate_samples:
+        raise ValueError(f'Duplicate sample(s): {", ".join(duplicate_samples)}. Every sample must have its own name.')
+
+    counts = np.vstack(rows)
+    diagnostics = pd.DataFrame({
+        'total_mutations': counts.sum(axis=0),
+        'min_count': counts.min(axis=0),
+        'is_integer': is_integer,
+    }, index=pd.Index(samples, name='Samples'))
+    diagnostics['is_valid'] = diagnostics['is_integer'] & (diagnostics['min_count'] >= 0) & (diagnostics['total_mutations'] > 0)
+    invalid_samples = diagnostics.index[~diagnostics['is_valid']].tolist()
     if invalid_samples:
         invalid_samples_string = ', '.join(invalid_samples)
         raise ValueError(f'Invalid sample(s): {invalid_samples_string}. All samples must have non-negative integers and sum to greater than 0.')
+    return features, samples, counts, diagnostics
+
+
+class SignatureReference:
+    """A signature reference's registry entry, its arrays memory-mapped read-only or, when built in memory, in memory
+
+    features is the validated SBS96 feature order of the file, signatures the signature names, matrix
+    the column-normalized (features x signatures) matrix, gram its Gram matrix and upper the upper
+    Cholesky factor of the Gram matrix, or None when the signatures are linearly dependent.
+    """
+
+    def __init__(self, labels, matrix, gram, upper=None):
+        self.labels = labels
+        self.digest = labels['digest']
+        self.features = labels['features']
+        self.signatures = labels['signatures']
+        self.matrix = matrix
+        self.gram = gram
+        self.upper = upper
+
+    @classmethod
+    def load(cls, entry_path):
+        with open(os.path.join(entry_path, 'labels.json')) as f:
+            labels = json.load(f)
+        upper_path = os.path.join(entry_path, 'upper.npy')
+        return cls(labels,
+                   np.load(os.path.join(entry_path, 'matrix.npy'), mmap_mode='r'),
+                   np.load(os.path.join(entry_path, 'gram.npy'), mmap_mode='r'),
+                   np.load(upper_path, mmap_mode='r') if os.path.exists(upper_path) else None)
+
+    def save(self, entry_path):
+        os.makedirs(entry_path, exist_ok=True)
+        np.save(os.path.join(entry_path, 'matrix.npy'), self.matrix)
+        np.save(os.path.join(entry_path, 'gram.npy'), self.gram)
+        if self.upper is not None:
+            np.save(os.path.join(entry_path, 'upper.npy'), self.upper)
+        with open(os.path.join(entry_path, 'labels.json'), 'w') as f:
+            json.dump(self.labels, f)
+
+
+def build_reference(reference_path, digest):
+    """Parses and validates a signature reference, returns its entry in memory"""
+    reference = pd.read_csv(reference_path, sep='\t', index_col=0)
+    features = reference.index.tolist()
+    if len(features) != 96 or set(features) != set(SBS96_FEATURES):
+        raise ValueError(f'Signature reference {reference_path} does not contain the 96 SBS96 features.')
+    values = reference.to_numpy(dtype=np.float64)
+    matrix = values / values.sum(axis=0)
+    gram = matrix.T @ matrix
+    try:
+        upper = np.linalg.cholesky(gram).T
+    except np.linalg.LinAlgError:
+        upper = None
+    labels = {'digest': digest, 'path': reference_path, 'features': features, 'signatures': reference.columns.tolist()}
+    return SignatureReference(labels, matrix, gram, upper)
+
+
+@functools.lru_cache(maxsize=None)
+def load_registered_reference(reference_path, stat_key, registry_path):
+    digest = file_digest(reference_path)
+    entry_path = os.path.join(registry_path, f'{digest}-v{REFERENCE_REGISTRY_VERSION}')
+    if os.path.exists(os.path.join(entry_path, 'labels.json')):
+        return SignatureReference.load(entry_path)
+    reference = build_reference(reference_path, digest)
+    build_path = None
+    try:
+        # Private to this user, as is the build directory mkdtemp creates
+        os.makedirs(registry_path, mode=0o700, exist_ok=True)
+        build_path = tempfile.mkdtemp(prefix='.build-', dir=registry_path)
+        reference.save(build_path)
+        # Renaming is atomic: readers never see a partial entry, a concurrent build that lost the race is dropped
+        os.rename(build_path, entry_path)
+    except OSError as e:
+        if not os.path.exists(os.path.join(entry_path, 'labels.json')):
+            # E.g. a registry created by another user: this process keeps its own entry
+            print(f'Signature reference registry {registry_path} is not writable ({e}), keeping {reference_path} in memory', file=sys.stderr)
+            return reference
+    finally:
+        if build_path:
+            shutil.rmtree(build_path, ignore_errors=True)
+    return SignatureReference.load(entry_path)
+
+
+def load_reference(reference_path, registry_path=None):
+    """Returns the registry entry of a signature reference, building it on first use of the file's content
+
+    Entries are keyed by the SHA-256 of the file, and looked up once per process while the file is unchanged.
+    """
+    stat_result = os.stat(reference_path)
+    stat_key = (stat_result.st_dev, stat_result.st_ino, stat_result.st_mtime_ns, stat_result.st_size)
+    return load_registered_reference(os.path.abspath(reference_path), stat_key, registry_path or REFERENCE_REGISTRY_PATH)
+
+
+def reorder_catalogue(features, counts, reference_path):
+    """Reorders a catalogue's rows to the reference's feature order"""
+    reference_features = load_reference(reference_path).features
+    if set(reference_features) != set(features):
+        raise ValueError(f'Signature reference {reference_path} does not contain the 96 SBS96 features.')
+    row_index = {feature: i for i, feature in enumerate(features)}
+    return reference_features, counts[[row_index[feature] for feature in reference_features]]
+
+
+def write_catalogue(features, samples, counts, output_path, intermediate_format='tsv'):
+    """Writes a catalogue as the workflow's standardized SBS96 samples.txt
 
+    The tools always read the TSV. With the npy format, a copy is written next to it as write_table would,
+    which the Python stages memory-map through load_catalogue instead of parsing the TSV.
+    """
+    with open(output_path, 'w') as f:
+        f.write('\t'.join(['MutationType'] + samples) + '\n')
+        for feature, row in zip(features, counts):
+            f.write(feature + '\t' + '\t'.join(row.astype(str)) + '\n')
+    npy_path, labels_path = get_npy_paths(output_path)
+    if intermediate_format == 'npy':
+        np.save(npy_path, counts)
+        with open(labels_path, 'w') as f:
+            json.dump({'columns': ['MutationType'] + list(samples), 'rows': list(features), 'int_columns': []}, f)
+        return
+    for stale_path in [npy_path, labels_path]:
+        if os.path.exists(stale_path):
+            os.remove(stale_path)
 
 
-def format_matrix(matrix_path, reference_path, output_path):
-    """Formats a VALID matrix to standardized SBS96 for the workflow"""
-    matrix = pd.read_csv(matrix_path, sep='\t')
-    reference = pd.read_csv(reference_path, sep='\t')
-    sbs96_features = reference.iloc[:, 0].tolist()
-    matrix.columns = ['MutationType'] + list(matrix.columns[1:])
-    matrix = matrix.set_index('MutationType').reindex(sbs96_features).reset_index()
-    matrix.to_csv(output_path, sep='\t', index=False)
+def load_catalogue(matrix_path):
+    """Reads a catalogue written by write_catalogue, from its npy copy if it has one
+
+    Returns the features, samples and (features x samples) counts. The matrix was validated when it was
+    written, so its npy copy is memory-mapped as it is.
+    """
+    npy_path, labels_path = get_npy_paths(matrix_path)
+    if not os.path.exists(npy_path):
+        features, samples, counts, _ = read_catalogue(matrix_path)
+        return features, samples, counts
+    with open(labels_path) as f:
+        labels = json.load(f)
+    return labels['rows'], labels['columns'][1:], np.load(npy_path, mmap_mode='r')
+
+
+def catalogue_frame(features, samples, counts):
+    """The catalogue as the DataFrame pd.read_csv would read from its samples.txt"""
+    matrix = pd.DataFrame(counts, columns=samples)
+    matrix.insert(0, 'MutationType', features)
+    return matrix
+
+
+def load_matrix(matrix_path, reference_path, output_path):
+    """Validates a matrix, writes it in the reference's feature order and returns its per-sample diagnostics"""
+    features, samples, counts, diagnostics = read_catalogue(matrix_path)
+    features, counts = reorder_catalogue(features, counts, reference_path)
+    write_catalogue(features, samples, counts, output_path)
+    return diagnostics
+
+
+def read_column_names(matrix_path):
+    """Reads the column names after the first from a matrix header without parsing its body"""
+    return pd.read_csv(matrix_path, sep='\t', nrows=0).columns[1:].tolist()
+
+
+def get_npy_paths(path):
+    root = os.path.splitext(path)[0]
+    return root + '.npy', root + '.labels.json'
+
+
+def write_table(df, path, intermediate_format='tsv'):
+    """Writes a table whose first column labels its rows, as TSV or as .npy values with a .labels.json sidecar
+
+    The .npy and .labels.json files sit next to path, with its extension replaced, and any copy of
+    the table in the other format is removed so readers never see a stale one.
+    """
+    if intermediate_format not in INTERMEDIATE_FORMATS:
+        raise ValueError(f'Unknown intermediate format: {intermediate_format}. Must be one of: {", ".join(INTERMEDIATE_FORMATS)}.')
+    npy_path, labels_path = get_npy_paths(path)
+    for stale_path in ([npy_path, labels_path] if intermediate_format == 'tsv' else [path]):
+        if os.path.exists(stale_path):
+            os.remove(stale_path)
+    if intermediate_format == 'tsv':
+        df.to_csv(path, sep='\t', index=False)
+        return
+
+    values = df.iloc[:, 1:]
+    dtype = np.result_type(*values.dtypes) if values.shape[1] else np.dtype(np.float64)
+    np.save(npy_path, values.to_numpy(dtype=dtype))
+    labels = {
+        'columns': df.columns.tolist(),
+        'rows': df.iloc[:, 0].tolist(),
+        # Integer columns stored among floats, cast back so they are written as integers again
+        'int_columns': [c for c in values.columns if pd.api.types.is_integer_dtype(values[c])] if dtype.kind == 'f' else [],
+    }
+    with open(labels_path, 'w') as f:
+        json.dump(labels, f)
+
+
+def read_table(path):
+    """Reads a table written by write_table, memory-mapping its values if it was stored as .npy"""
+    npy_path, labels_path = get_npy_paths(path)
+    if not os.path.exists(npy_path):
+        return pd.read_csv(path, sep='\t')
+    with open(labels_path) as f:
+        labels = json.load(f)
+    df = pd.DataFrame(np.load(npy_path, mmap_mode='r'), columns=labels['columns'][1:], copy=False)
+    for c in labels['int_columns']:
+        df[c] = df[c].astype('int64')
+    df.insert(0, labels['columns'][0], labels['rows'])
+    return df
+
+
+def read_activities(activities_path, all_samples, all_sigs):
+    """Reads a tool's activities and pads missing signature columns with 0"""
+    df = read_table(activities_path)
+    df['Samples'] = all_samples
+    for sig in all_sigs:
+        if sig not in df.columns:
+            df[sig] = 0
+    return df
+
+
+def split_matrix(matrix_path, shard_size, shards_path, intermediate_format='tsv'):
+    """Splits a matrix column-wise into shards of at most shard_size samples, returns each shard's directory"""
+    features, samples, counts = load_catalogue(matrix_path)
+    shard_paths = []
+    for i, start in enumerate(range(0, len(samples), shard_size)):
+        shard_path = os.path.join(shards_path, f'shard_{i}')
+        os.makedirs(shard_path, exist_ok=True)
+        write_catalogue(features, samples[start:start + shard_size], counts[:, start:start + shard_size],
+                        os.path.join(shard_path, 'samples.txt'), intermediate_format)
+        shard_paths.append(shard_path)
+    return shard_paths
+
+
+def union_columns(column_lists, all_sigs):
+    """Keeps a column order shared by every list, otherwise takes the union in reference order"""
+    column_lists = [list(columns) for columns in column_lists]
+    if all(columns == column_lists[0] for columns in column_lists):
+        return column_lists[0]
+    present = set().union(*column_lists)
+    columns = [sig for sig in all_sigs if sig in present]
+    # Anything else (e.g. unassigned) after the signatures
+    for column_list in column_lists:
+        columns += [c for c in column_list if c not in columns]
+    return columns
+
+
+def merge_activities(shard_paths, tool, strategy, output_path, all_sigs, intermediate_format='tsv'):
+    """Concatenates a tool's per-shard activities, in shard order, into the tool's output directory"""
+    shards = [read_table(os.path.join(shard_path, tool, f'{tool}_{strategy}.txt')) for shard_path in shard_paths]
+    columns = [shards[0].columns[0]] + union_columns([shard.columns[1:] for shard in shards], all_sigs)
+    activities = pd.concat([shard.reindex(columns=columns, fill_value=0) for shard in shards], ignore_index=True)
+
+    os.makedirs(os.path.join(output_path, tool), exist_ok=True)
+    write_table(activities, os.path.join(output_path, tool, f'{tool}_{strategy}.txt'), intermediate_format)
+
+
+def read_activity_rows(activities_path, digests):
+    """Reads a tool's activities as {digest: {column: value}} for the result cache, one row per digest in order"""
+    df = read_table(activities_path)
+    return dict(zip(digests, df.iloc[:, 1:].to_dict('records')))
+
+
+def assemble_activities(samples, digests, activities, all_sigs, output_path, intermediate_format='tsv'):
+    """Writes the activities of every sample, looked up by digest, as a tool output file"""
+    rows = [activities[digest] for digest in digests]
+    df = pd.DataFrame(rows)
+    df = df[union_columns([row.keys() for row in rows], all_sigs)].fillna(0)
+    df.insert(0, 'Samples', samples)
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    write_table(df, output_path, intermediate_format)
 
 
 def as_frequency_colwise(df, skipfirst=True):
@@ -69,11 +381,13 @@ def as_frequency_colwise(df, skipfirst=True):
     return df
 
 
-def as_frequency_rowwise(df, skipfirst=True):
+def as_frequency_rowwise(df, skipfirst=True, sum_columns=None):
+    """Divides each row by its sum, taken over sum_columns if given or all columns otherwise"""
     df = df.copy()
     if skipfirst:
         df = df.set_index(df.columns[0])
-        df = df.div(df.sum(axis=1), axis=0).reset_index()
-    else:
-        df = df.div(df.sum(axis=1), axis=0)
+    totals = df.sum(axis=1) if sum_columns is None else df[sum_columns].sum(axis=1)
+    df = df.div(totals, axis=0)
+    if skipfirst:
+        df = df.reset_index()
     return df
\ No newline at end of file
@@ -1,41 +1,221 @@
+import os
 import sys
 import logging
 import json
 import shutil
+from datetime import datetime
 
-from parsl.executors import ThreadPoolExecutor
-from parsl.config import Config
-
-from apps.parsl_bash_apps import *
 import apps.workflow_utils as utils
+import apps.task_metrics as task_metrics
+import common.result_cache as result_cache
+from apps.workflow_utils import lazy_import
+from apps.generate_job_metadata import tool_string
+from apps.tool_worker import start_worker
+from common.utils import file_digest, path_digest
+from common import tracing
+
+# Parsl and the Parsl apps load on first use to keep startup fast
+parsl = lazy_import('parsl')
+# Registers content-hash memoization of File inputs once loaded, before parsl.load
+parsl_common = lazy_import('common.parsl_common')
+bash_apps = lazy_import('apps.parsl_bash_apps')
 
 LOGS_PATH = 'logs'
 LOGGER = logging.getLogger('ensemblefit')
+# Tools whose remove and refit read the activities of their regular run, {tool}_regular.txt, instead of fitting again
+REGULAR_DERIVED_TOOLS = {'FastNNLS'}
 
 
-def get_parsl_config_local():
-    return Config(
+def get_parsl_config_local(executor_config):
+    return parsl.Config(
         run_dir=LOGS_PATH,
-        executors=[ThreadPoolExecutor()],
+        executors=parsl_common.get_executors(executor_config),
         retries=3,
         app_cache=True,
-        checkpoint_mode='task_exit'
+        checkpoint_mode='task_exit',
+        # Results of earlier attempts of the job, reused only while the outputs they declare exist
+        checkpoint_files=parsl.utils.get_all_checkpoints(LOGS_PATH)
     )
 
 
+def as_list(value):
+    return value if isinstance(value, list) else [value]
+
+
+def get_reference_name(reference_path):
+    return os.path.splitext(os.path.basename(reference_path))[0]
+
+
+def get_reference_names(reference_paths):
+    """Names each reference by its file name, followed by a short digest of its content where file names collide"""
+    file_names = [get_reference_name(reference_path) for reference_path in reference_paths]
+    names = [
+        f'{name}_{file_digest(reference_path)[:8]}' if file_names.count(name) > 1 else name
+        for reference_path, name in zip(reference_paths, file_names)
+    ]
+    duplicates = sorted({name for name in names if names.count(name) > 1})
+    if duplicates:
+        raise ValueError(f'signature_reference lists the same reference more than once: {", ".join(duplicates)}.')
+    return dict(zip(reference_paths, names))
+
+
+def activities_file(tool_path, tool, strategy):
+    return parsl.File(os.path.join(tool_path, tool, f'{tool}_{strategy}.txt'))
+
+
+def submit_tool_runs(tool, tool_app, shard_paths, reference_path, strategies):
+    """Submits a tool's runs of every strategy on every shard
+
+    With more than one strategy, a tool of REGULAR_DERIVED_TOOLS derives the others from one shared regular
+    run, submitted whether or not regular is among them. Other tools run each strategy on its own.
+    Returns the runs of each strategy as {strategy: [futures]}.
+    """
+    runs = {strategy: [] for strategy in strategies}
+    derived = tool in REGULAR_DERIVED_TOOLS and len(strategies) > 1
+    for shard_path in shard_paths:
+        sample_file = parsl.File(os.path.join(shard_path, 'samples.txt'))
+        regular = None
+        if derived:
+            regular = tool_app(sample_file, parsl.File(reference_path), shard_path, 'regular',
+                               outputs=[activities_file(shard_path, tool, 'regular')])
+        for strategy in strategies:
+            if strategy == 'regular' and regular:
+                runs[strategy].append(regular)
+            else:
+                runs[strategy].append(tool_app(sample_file, parsl.File(reference_path), shard_path, strategy,
+                                               inputs=[regular] if regular else [],
+                                               outputs=[activities_file(shard_path, tool, strategy)]))
+    return runs
+
+
+def get_tool_version(tool):
+    """The tool's released version and the digest of the script that runs it, so changing either invalidates cached results"""
+    return f'{tool_string.get(tool, tool)} {path_digest(bash_apps.TOOLS_PATHS[tool])}'
+
+
+def submit_reference(job, reference_path, reference_name, matrix):
+    """Submits a reference's runs once the matrix is validated, each stage as soon as the stages it reads from are done
+
+    The samples are written in the reference's feature order, looked up in the result cache and sharded
+    first, which decides the runs. Returns a future of each strategy's fit metrics, by result directory.
+    """
+    features, samples, counts = matrix
+    strategies, tools, cache, shard_size, intermediate_format = (
+        job['strategies'], job['tools'], job['cache'], job['shard_size'], job['intermediate_format'])
+    workdir = os.path.join(job['workdir'], reference_name) if job['is_fan_out'] else job['workdir']
+    os.makedirs(workdir, exist_ok=True)
+    sample_path = os.path.join(workdir, 'samples.txt')
+
+    # Format matrix's SBS96 order to match the signature reference and save to working directory
+    reference_features, reference_counts = utils.reorder_catalogue(features, counts, reference_path)
+    utils.write_catalogue(reference_features, samples, reference_counts, sample_path, intermediate_format)
+
+    reference = {
+        'name': reference_name,
+        'path': reference_path,
+        'workdir': workdir,
+        'sample_path': sample_path,
+        'all_sigs': utils.load_reference(reference_path).signatures,
+        'tool_paths': {},
+        'shard_paths': {},
+    }
+    runs = {}
+    collected = {strategy: [] for strategy in strategies}
+
+    # Look up every sample in the cross-job result cache, only distinct misses are fitted
+    if cache:
+        reference['matrix'] = utils.catalogue_frame(reference_features, samples, reference_counts)
+        reference['digests'] = result_cache.sample_digests(reference['matrix'])
+        reference['reference_digest'] = file_digest(reference_path)
+        reference['tool_versions'] = {tool: get_tool_version(tool) for tool in tools}
+        reference['cached'] = {}
+        reference['miss_digests'] = {}
+
+    for tool in tools:
+        tool_path = workdir
+        if cache:
+            cached = {
+                strategy: cache.lookup(reference['digests'], reference['reference_digest'], tool, strategy, reference['tool_versions'][tool])
+                for strategy in strategies
+            }
+            # A sample is fitted if any strategy misses, so every strategy derives from the same run
+            fully_cached = set.intersection(*[set(c) for c in cached.values()])
+            tool_path = os.path.join(workdir, 'cache_misses', tool)
+            miss_indices, miss_digests = result_cache.find_cache_misses(reference['digests'], fully_cached)
+            if miss_digests:
+                os.makedirs(tool_path, exist_ok=True)
+                utils.write_catalogue(reference_features, [samples[i] for i in miss_indices], reference_counts[:, miss_indices],
+                                      os.path.join(tool_path, 'samples.txt'), intermediate_format)
+            reference['cached'][tool] = cached
+            reference['miss_digests'][tool] = miss_digests
+            LOGGER.info("%s %s: %d cached, %d to fit", reference_name, tool, len(reference['digests']) - len(miss_digests), len(miss_digests))
+            if not miss_digests:
+                continue
+        reference['tool_paths'][tool] = tool_path
+
+        # Split samples into shards so that each tool fits them in parallel
+        if tool_path not in reference['shard_paths']:
+            if shard_size:
+                reference['shard_paths'][tool_path] = utils.split_matrix(
+                    os.path.join(tool_path, 'samples.txt'), shard_size, os.path.join(tool_path, 'shards'), intermediate_format)
+            else:
+                reference['shard_paths'][tool_path] = [tool_path]
+        runs[tool] = submit_tool_runs(tool, job['tool_apps'][tool], reference['shard_paths'][tool_path], reference_path, strategies)
+
+    result_paths = {
+        strategy: os.path.join(job['resultdir'], reference_name, strategy) if job['is_fan_out'] else job['resultdir']
+        for strategy in strategies
+    }
+    # Copy each tool's activities out as soon as its runs of the strategy are done
+    for tool in tools:
+        tool_path = reference['tool_paths'].get(tool)
+        shard_paths = reference['shard_paths'][tool_path] if shard_size and tool_path else None
+        for strategy in strategies:
+            collected[strategy].append(bash_apps.TOOLS_APPS['collect_activities'](
+                reference, tool, strategy, result_paths[strategy], shard_paths, cache, intermediate_format,
+                inputs=runs[tool][strategy] if tool in runs else []))
+
+    # EnsembleFit and post-processing of a strategy once every tool's activities of it are in place
+    fit_quality = {
+        f"{reference_name}/{strategy}" if job['is_fan_out'] else strategy: bash_apps.TOOLS_APPS['ensemble_postprocess'](
+            sample_path, reference_path, workdir, result_paths[strategy], strategy, tools, job['mean_mode'],
+            inputs=collected[strategy])
+        for strategy in strategies
+    }
+    return bash_apps.TOOLS_APPS['gather'](list(fit_quality), *fit_quality.values())
+
+
+@tracing.traced('assignment')
 def main(config_path):
     if not os.path.isdir(LOGS_PATH):
         os.mkdir(LOGS_PATH)
-    parsl.set_stream_logger("parsl", logging.INFO)
-    parsl.load(get_parsl_config_local())
 
     # Read config file
     with open(config_path) as f:
         assignment_config = json.load(f)
 
-    reference_path = assignment_config['signature_reference']
+    # Lists of strategies or references fan out into results/{reference}/{strategy} subtrees
+    is_fan_out = isinstance(assignment_config['strategy'], list) or isinstance(assignment_config['signature_reference'], list)
+    strategies = as_list(assignment_config['strategy'])
+    reference_paths = as_list(assignment_config['signature_reference'])
+    # Checked before any work starts, references with the same file name get their own subtrees
+    reference_names = get_reference_names(reference_paths)
     output_path = assignment_config['output']
-    strategy = assignment_config['strategy']
+    mean_mode = assignment_config.get('ensemble_mean_mode', 'bootstrap')
+    shard_size = assignment_config.get('shard_size')
+    intermediate_format = assignment_config.get('intermediate_format', 'tsv')
+    if intermediate_format not in utils.INTERMEDIATE_FORMATS:
+        raise ValueError(f'Unknown intermediate_format: {intermediate_format}. Must be one of: {", ".join(utils.INTERMEDIATE_FORMATS)}.')
+    tools = [tool for tool, is_run in assignment_config['tools'].items() if is_run]
+
+    # Warm workers keep each tool's libraries loaded across runs and jobs on this node
+    tool_apps = bash_apps.TOOLS_APPS
+    warm_workers = assignment_config.get('warm_workers')
+    if warm_workers:
+        tool_apps = {**bash_apps.TOOLS_APPS, **bash_apps.WARM_TOOLS_APPS}
+        # Built-in tools run in-process and have no worker
+        for tool in [tool for tool in tools if tool in bash_apps.WARM_TOOLS_APPS]:
+            start_worker(bash_apps.TOOLS_PATHS[tool], 1 if warm_workers is True else warm_workers)
 
     # Create output directory
     os.makedirs(output_path, exist_ok=True)
@@ -46,51 +226,94 @@ def main(config_path):
     os.makedirs(WORKINGDIR, exist_ok=True)
     os.makedirs(RESULTDIR, exist_ok=True)
 
-    # Copy of input samples matrix
-    sample_path = os.path.join(WORKINGDIR, 'samples.txt')
+    # Every bash app records its resource usage here, set before the executors start so their workers inherit it
+    metrics_dir = os.path.abspath(os.path.join(WORKINGDIR, 'metrics'))
+    shutil.rmtree(metrics_dir, ignore_errors=True)
+    os.environ[task_metrics.METRICS_DIR_ENV] = metrics_dir
 
-    # Matrix generation if needed
-    if assignment_config['file_type'] == 'vcf':
+    parsl.set_stream_logger("parsl", logging.INFO)
+    parsl_common.load_config(get_parsl_config_local(assignment_config.get('executor', {})))
+
+    # Matrix generation if needed, once for all references. Everything after depends on its content
+    matrix_futures = []
+    if assignment_config['file_type'] == 'vcf' and assignment_config.get('matrix_generator') == 'native':
+        # Counts SBS96 only, without writing into the VCF directory
+        matrix_path = os.path.join(WORKINGDIR, 'mutsig.SBS96.all')
+        matrix_futures.append(bash_apps.TOOLS_APPS['count_sbs96'](
+            parsl.File(assignment_config['samples']), assignment_config['genome_reference'], matrix_path,
+            assignment_config.get('matrix_cache'), assignment_config.get('matrix_cache_max_entries'),
+            outputs=[parsl.File(matrix_path)]))
+    elif assignment_config['file_type'] == 'vcf':
         vcf_path = assignment_config['samples']
-        genome_reference = assignment_config['genome_reference']
-        TOOLS_APPS['generate_matrix'](vcf_path, genome_reference).result()
-        # Move all output files to working directory
-        shutil.move(os.path.join(vcf_path, 'output/SBS/mutsig.SBS96.all'), sample_path)
-        os.makedirs(os.path.join(WORKINGDIR, 'SigProfilerMatrixGenerator'), exist_ok=True)
-        shutil.move(os.path.join(vcf_path, 'input'), os.path.join(WORKINGDIR, 'SigProfilerMatrixGenerator', 'input'))
-        shutil.move(os.path.join(vcf_path, 'logs'), os.path.join(WORKINGDIR, 'SigProfilerMatrixGenerator', 'logs'))
+        matrix_path = os.path.join(WORKINGDIR, 'mutsig.SBS96.all')
+        # Moved out of the VCF directory once generated, so a cached run is reused only if it was not moved yet
+        generated = bash_apps.TOOLS_APPS['generate_matrix'](
+            parsl.File(vcf_path), assignment_config['genome_reference'],
+            outputs=[parsl.File(os.path.join(vcf_path, 'output/SBS/mutsig.SBS96.all'))])
+        matrix_futures.append(bash_apps.TOOLS_APPS['move_generated_matrix'](vcf_path, WORKINGDIR, inputs=[generated]))
     else:
-        # Format matrix's SBS96 order to match the signature reference and save to working directory
-        utils.format_matrix(assignment_config['samples'], reference_path, sample_path)
-
-    # Check if matrix is valid
-    if not utils.is_valid_matrix(sample_path):
-        throw_invalid_matrix_error(sample_path)
-
-    # Start runs in parallel
-    runs = []
-    tools = []
-    for tool, is_run in assignment_config['tools'].items():
-        if not is_run:
-            continue
-        tools.append(tool)
-        runs.append(TOOLS_APPS[tool](sample_path, reference_path, WORKINGDIR, strategy))
+        matrix_path = assignment_config['samples']
 
-    LOGGER.info("Waiting for Parsl tasks to complete...")
-    parsl.wait_for_current_tasks()
+    # Job metadata only needs the matrix, it runs alongside the assignment
+    futures = [bash_apps.TOOLS_APPS['generate_job_metadata'](config_path, parsl.File(matrix_path), RESULTDIR, inputs=matrix_futures)]
+
+    # Validate the matrix once, in a single pass, for all references
+    matrix = bash_apps.TOOLS_APPS['validate_matrix'](matrix_path, os.path.join(RESULTDIR, 'matrix_diagnostics.txt'),
+                                                      inputs=matrix_futures)
 
-    [r.result() for r in runs]
+    cache = None
+    if assignment_config.get('result_cache'):
+        cache = result_cache.AssignmentCache(
+            assignment_config['result_cache'],
+            assignment_config.get('result_cache_max_entries', result_cache.DEFAULT_MAX_ENTRIES)
+        )
+    job = {
+        'workdir': WORKINGDIR,
+        'resultdir': RESULTDIR,
+        'is_fan_out': is_fan_out,
+        'strategies': strategies,
+        'tools': tools,
+        'tool_apps': tool_apps,
+        'cache': cache,
+        'shard_size': shard_size,
+        'intermediate_format': intermediate_format,
+        'mean_mode': mean_mode,
+    }
 
-    # EnsembleFit
-    TOOLS_APPS['EnsembleFit'](sample_path, reference_path, WORKINGDIR, strategy, tools).result()
+    # Each reference's runs are submitted as soon as the matrix is validated, every reference in parallel.
+    # Each one's future gives its strategies' fit metrics, by result directory
+    with tracing.span('submission'):
+        fit_quality = [
+            bash_apps.TOOLS_APPS['submit_after'](submit_reference, job, reference_path, reference_name, matrix)
+            for reference_path, reference_name in reference_names.items()
+        ]
 
-    # Post-processing after all runs are done
-    all_tools = tools + ['Ensemble-Majority', 'Ensemble-Unanimous', 'Ensemble-Mean']
-    TOOLS_APPS['postprocess'](sample_path, reference_path, WORKINGDIR, RESULTDIR, strategy, all_tools).result()
+    # The only wait of the workflow, on every stage
+    LOGGER.info("Waiting for Parsl tasks to complete...")
+    finalize = bash_apps.TOOLS_APPS['finalize_workflow'](*futures, *fit_quality)
+    try:
+        with tracing.span('finalize wait', barrier=True):
+            finalize.result()
+    finally:
+        # Every task's waits and attempts, also when the job failed
+        tracing.add_task_spans(tracing.get_tracer(), [finalize], task_metrics.read_metrics(metrics_dir))
+
+    if cache:
+        LOGGER.info("Result cache: %s", cache.stats())
+        cache.close()
+
+    apps = task_metrics.write_metrics(metrics_dir, os.path.join(RESULTDIR, 'assignment_metrics.json'),
+                                      os.path.join(RESULTDIR, 'assignment_metrics.txt'),
+                                      {name: summary for future in fit_quality for name, summary in future.result().items()})
+    LOGGER.info("Task wall time by app: %s", {app: round(totals['wall_seconds'], 1) for app, totals in apps.items()})
 
     # Clean up working directory
     shutil.rmtree(WORKINGDIR)
 
+    # Last, so whoever waits for it finds the whole results tree
+    with open(os.path.join(output_path, 'complete'), 'w') as f:
+        f.write(f'{datetime.now()}\n')
+
 
 if __name__ == '__main__':
     if len(sys.argv) < 2:
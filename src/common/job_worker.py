@@ -0,0 +1,154 @@
+import json
+import time
+import signal
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+logging.basicConfig()
+LOGGER = logging.getLogger(__name__)
+LOGGER.setLevel(logging.INFO)
+
+# SQS limits for a single receive and for batch requests
+MAX_RECEIVE_MESSAGES = 10
+MAX_BATCH_ENTRIES = 10
+DEFAULT_WAIT_TIME_SECONDS = 20
+DEFAULT_VISIBILITY_TIMEOUT = 300
+METRICS_INTERVAL = 60
+
+
+class JobWorker:
+    """Consumes job manifests from an SQS queue, running up to max_concurrency of them at once
+
+    handler(job_config, message_id) runs one job and raises if it failed. Messages of jobs that
+    fail are left on the queue to become visible again once their visibility timeout expires.
+    """
+
+    def __init__(self, sqs_client, queue_url, handler, max_concurrency=4, visibility_timeout=DEFAULT_VISIBILITY_TIMEOUT,
+                 wait_time_seconds=DEFAULT_WAIT_TIME_SECONDS):
+        self.sqs_client = sqs_client
+        self.queue_url = queue_url
+        self.handler = handler
+        self.max_concurrency = max_concurrency
+        self.visibility_timeout = visibility_timeout
+        self.wait_time_seconds = wait_time_seconds
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix='job')
+        self.lock = threading.Lock()
+        # In-flight receipt handles by message id, and those of finished jobs waiting to be deleted
+        self.receipts = {}
+        self.deletes = []
+        self.draining = threading.Event()
+        self.stopped = threading.Event()
+        self.started = time.time()
+        self.last_metrics = self.started
+        self.metrics = {'received': 0, 'succeeded': 0, 'failed': 0, 'lag_seconds_total': 0.0, 'lag_seconds_max': 0.0}
+
+    def drain(self, signum=None, frame=None):
+        """Stops receiving, running jobs still finish and their messages get deleted"""
+        LOGGER.info("Draining: waiting for %d running job(s)", len(self.receipts))
+        self.draining.set()
+
+    def receive(self, max_messages):
+        response = self.sqs_client.receive_message(
+            QueueUrl=self.queue_url,
+            MaxNumberOfMessages=min(max_messages, MAX_RECEIVE_MESSAGES),
+            WaitTimeSeconds=self.wait_time_seconds,
+            VisibilityTimeout=self.visibility_timeout,
+            AttributeNames=['SentTimestamp'],
+        )
+        messages = response.get('Messages', [])
+        now = time.time()
+        for message in messages:
+            lag = now - int(message['Attributes']['SentTimestamp']) / 1000
+            self.metrics['received'] += 1
+            self.metrics['lag_seconds_total'] += lag
+            self.metrics['lag_seconds_max'] = max(self.metrics['lag_seconds_max'], lag)
+        return messages
+
+    def run_job(self, message):
+        message_id = message['MessageId']
+        start = time.time()
+        try:
+            self.handler(json.loads(message['Body']), message_id)
+        except Exception:
+            LOGGER.exception("Job of message_id: %s failed after %.1fs", message_id, time.time() - start)
+            with self.lock:
+                self.receipts.pop(message_id)
+                self.metrics['failed'] += 1
+            return
+        LOGGER.info("Job of message_id: %s succeeded in %.1fs", message_id, time.time() - start)
+        with self.lock:
+            self.deletes.append({'Id': message_id, 'ReceiptHandle': self.receipts.pop(message_id)})
+            self.metrics['succeeded'] += 1
+
+    def flush_deletes(self):
+        """Deletes the messages of every job that finished since the last flush, 10 per request"""
+        with self.lock:
+            deletes, self.deletes = self.deletes, []
+        for start in range(0, len(deletes), MAX_BATCH_ENTRIES):
+            response = self.sqs_client.delete_message_batch(QueueUrl=self.queue_url, Entries=deletes[start:start + MAX_BATCH_ENTRIES])
+            for failed in response.get('Failed', []):
+                LOGGER.error("Could not delete message_id: %s | %s", failed['Id'], failed.get('Message'))
+
+    def heartbeat(self):
+        """Extends the visibility timeout of running jobs' messages, at a third of the timeout"""
+        from botocore.exceptions import BotoCoreError, ClientError
+        while not self.stopped.wait(self.visibility_timeout / 3):
+            with self.lock:
+                entries = [
+                    {'Id': message_id, 'ReceiptHandle': receipt, 'VisibilityTimeout': self.visibility_timeout}
+                    for message_id, receipt in self.receipts.items()
+                ]
+            for start in range(0, len(entries), MAX_BATCH_ENTRIES):
+                try:
+                    response = self.sqs_client.change_message_visibility_batch(QueueUrl=self.queue_url, Entries=entries[start:start + MAX_BATCH_ENTRIES])
+                except (BotoCoreError, ClientError) as e:
+                    # The next beat retries, well before the messages become visible again
+                    LOGGER.error("Could not extend visibility of %d message(s) | %s", len(entries[start:start + MAX_BATCH_ENTRIES]), e)
+                    continue
+                for failed in response.get('Failed', []):
+                    LOGGER.warning("Could not extend visibility of message_id: %s | %s", failed['Id'], failed.get('Message'))
+
+    def log_metrics(self, force=False):
+        now = time.time()
+        if not force and now - self.last_metrics < METRICS_INTERVAL:
+            return
+        self.last_metrics = now
+        finished = self.metrics['succeeded'] + self.metrics['failed']
+        LOGGER.info("Jobs: %d running, %d succeeded, %d failed, %.1f jobs/hour | queue lag: %.1fs mean, %.1fs max",
+                    len(self.receipts), self.metrics['succeeded'], self.metrics['failed'],
+                    finished / (now - self.started) * 3600,
+                    self.metrics['lag_seconds_total'] / max(self.metrics['received'], 1), self.metrics['lag_seconds_max'])
+
+    def run(self, max_jobs=None):
+        """Runs jobs until drained, or until max_jobs messages were received"""
+        heartbeat = threading.Thread(target=self.heartbeat, name='visibility-heartbeat', daemon=True)
+        heartbeat.start()
+        running = set()
+        while not self.draining.is_set():
+            if max_jobs is not None and self.metrics['received'] >= max_jobs:
+                break
+            free = self.max_concurrency - len(running)
+            if max_jobs is not None:
+                free = min(free, max_jobs - self.metrics['received'])
+            if free > 0:
+                for message in self.receive(free):
+                    with self.lock:
+                        self.receipts[message['MessageId']] = message['ReceiptHandle']
+                    running.add(self.executor.submit(self.run_job, message))
+            else:
+                _, running = wait(running, return_when=FIRST_COMPLETED)
+            running = {future for future in running if not future.done()}
+            self.flush_deletes()
+            self.log_metrics()
+        wait(running)
+        self.stopped.set()
+        heartbeat.join()
+        self.executor.shutdown()
+        self.flush_deletes()
+        self.log_metrics(force=True)
+        return self.metrics
+
+    def install_signal_handlers(self):
+        signal.signal(signal.SIGTERM, self.drain)
+        signal.signal(signal.SIGINT, self.drain)
@@ -1,35 +1,152 @@
 import os
 import logging
 
-from parsl.executors import ThreadPoolExecutor
-from parsl.config import Config
+import parsl
+from parsl.executors import HighThroughputExecutor, ThreadPoolExecutor
+from parsl.providers import LocalProvider
+from parsl.channels import LocalChannel
 from parsl.data_provider.files import File
-from parsl.dataflow.memoization import id_for_memo
+from parsl.dataflow.memoization import Memoizer, id_for_memo
+
+from common.utils import path_digest
 
 logging.basicConfig()
 LOGGER = logging.getLogger(__name__)
 LOGGER.setLevel(logging.INFO)
 
+SRC_PATH = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+# In-process python apps always run on threads of the submitting process
+LOCAL_EXECUTOR_LABEL = "ensemblefit-local-executor"
+DEFAULT_EXECUTOR_LABEL = "ensemblefit-job-executor"
+HEAVY_EXECUTOR_LABEL = "ensemblefit-heavy-executor"
+
+# Per-worker resources of each pool, overridable under executor.pools.{default,heavy} in the job config
+EXECUTOR_POOLS = {
+    'heavy': {
+        'label': HEAVY_EXECUTOR_LABEL,
+        'cores_per_worker': 2,
+        'mem_per_worker_gb': 8,
+        'max_workers': 2,
+    },
+    'default': {
+        'label': DEFAULT_EXECUTOR_LABEL,
+        'cores_per_worker': 1,
+        'mem_per_worker_gb': 2,
+        'max_workers': None,
+    },
+}
+LOCAL_EXECUTOR_THREADS = 2
+
+
+def get_node_cores():
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def get_node_memory_gb():
+    """Returns the node's physical memory, capped by the container's cgroup limit if any"""
+    memory = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    for limit_path in ['/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory/memory.limit_in_bytes']:
+        try:
+            with open(limit_path) as f:
+                limit = f.read().strip()
+        except OSError:
+            continue
+        if limit.isdigit():
+            memory = min(memory, int(limit))
+    return memory / 1024 ** 3
+
+
+def get_worker_count(cores, mem_gb, pool):
+    workers = min(cores // pool['cores_per_worker'], mem_gb // pool['mem_per_worker_gb'])
+    if pool['max_workers']:
+        workers = min(workers, pool['max_workers'])
+    return max(1, int(workers))
+
 
-def get_parsl_config_local(job_config, logs_path):
-    if not os.path.isdir(logs_path):
-        os.makedirs(logs_path, exist_ok=True)
-    return Config(
-        run_dir=logs_path,
-        executors=[
-            ThreadPoolExecutor(
-                label="ensemblefit-job-executor",
-                thread_name_prefix=f"job-{job_config['job_id']}",
-                max_threads=4
+def get_executors(executor_config, thread_name_prefix=''):
+    """Builds the local, default and heavy executors, sizing the pools from this job's share of the node"""
+    profile = executor_config.get('profile', 'threads')
+    jobs_per_node = executor_config.get('jobs_per_node', 1)
+    cores = get_node_cores() / jobs_per_node
+    mem_gb = get_node_memory_gb() / jobs_per_node
+
+    executors = [
+        ThreadPoolExecutor(
+            label=LOCAL_EXECUTOR_LABEL,
+            thread_name_prefix=thread_name_prefix,
+            max_threads=LOCAL_EXECUTOR_THREADS
+        )
+    ]
+    # The heavy pool is sized first, the default pool gets what is left
+    for name in ['heavy', 'default']:
+        pool = {**EXECUTOR_POOLS[name], **executor_config.get('pools', {}).get(name, {})}
+        workers = get_worker_count(cores, mem_gb, pool)
+        if cores < pool['cores_per_worker'] or mem_gb < pool['mem_per_worker_gb']:
+            LOGGER.warning("Executor pool %s: only %.1f core(s) and %.1f GB left, running 1 worker that needs %s core(s) and %s GB",
+                           pool['label'], cores, mem_gb, pool['cores_per_worker'], pool['mem_per_worker_gb'])
+        # What the pool takes is not left to the next one, which gets its single worker at least
+        cores = max(cores - workers * pool['cores_per_worker'], 0)
+        mem_gb = max(mem_gb - workers * pool['mem_per_worker_gb'], 0)
+        LOGGER.info("Executor pool %s (%s): %d worker(s)", pool['label'], profile, workers)
+        if profile == 'htex':
+            executors.append(
+                HighThroughputExecutor(
+                    label=pool['label'],
+                    address='127.0.0.1',
+                    # Sized here rather than through cores_per_worker/mem_per_worker, which the worker pool
+                    # checks against the whole node and rounds down to zero workers on small nodes
+                    max_workers=workers,
+                    provider=LocalProvider(
+                        # LocalProvider's default channel copies the environment once, when Parsl is imported,
+                        # a channel of its own passes the workers the environment of the job
+                        channel=LocalChannel(),
+                        init_blocks=1,
+                        min_blocks=1,
+                        max_blocks=1,
+                        # Workers import the apps by module path
+                        worker_init=f'export PYTHONPATH={SRC_PATH}:$PYTHONPATH'
+                    )
+                )
+            )
+        elif profile == 'threads':
+            executors.append(
+                ThreadPoolExecutor(
+                    label=pool['label'],
+                    thread_name_prefix=thread_name_prefix,
+                    max_threads=workers
+                )
             )
-        ],
-        retries=3,
-        app_cache=False,
-        checkpoint_mode='task_exit'
-    )
+        else:
+            raise ValueError(f'Unknown executor profile: {profile}. Must be one of: threads, htex.')
+    return executors
+
+
+class OutputCheckingMemoizer(Memoizer):
+    """Reuses a memoized or checkpointed result only while every output file its task declares exists
+
+    Parsl memoizes an app's return value, an exit code for bash apps, and not the files the app wrote.
+    """
+
+    def check_memo(self, task):
+        result = super().check_memo(task)
+        missing = [output.filepath for output in task['kwargs'].get('outputs', []) if not os.path.exists(output.filepath)]
+        if result is not None and missing:
+            LOGGER.info("Task %s: cached result not reused, missing outputs %s", task['id'], missing)
+            return None
+        return result
+
+
+def load_config(config):
+    """Loads the config, with cached results reused only while their declared outputs exist"""
+    dfk = parsl.load(config)
+    dfk.memoizer = OutputCheckingMemoizer(dfk, memoize=config.app_cache, checkpoint=dfk.memoizer.memo_lookup_table)
+    return dfk
 
 
-# checkpoints based on file attributes
+# checkpoints based on file content
 # Refer to https://github.com/Parsl/parsl/issues/1603
 @id_for_memo.register(File)
 def id_for_memo_file(file, output_ref=False):
@@ -38,9 +155,8 @@ def id_for_memo_file(file, output_ref=False):
         return file.url
     else:
         assert file.scheme == "file"
-        if os.path.exists(file):
-            stat_result = os.stat(file.filepath)
-            memo_result = [file.url, stat_result.st_size]
+        if os.path.exists(file.filepath):
+            memo_result = [file.url, path_digest(file.filepath)]
             LOGGER.info(f"[id_for_memo_file] Hashed memo_result: {memo_result}, file: {file}, output_ref: {output_ref}")
             return memo_result
         else:
@@ -0,0 +1,119 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import sqlite3
+import threading
+
+logging.basicConfig()
+LOGGER = logging.getLogger(__name__)
+LOGGER.setLevel(logging.INFO)
+
+DEFAULT_MAX_ENTRIES = 1000000
+# SQLite limits the number of bound parameters per statement
+QUERY_BATCH_SIZE = 500
+
+
+def sample_digests(matrix):
+    """Digests each sample's SBS96 counts in a DataFrame, independent of the feature order"""
+    matrix = matrix.set_index(matrix.columns[0]).sort_index()
+    features = '\n'.join(matrix.index).encode()
+    return [
+        hashlib.sha256(features + matrix[sample].to_numpy(dtype='int64').tobytes()).hexdigest()
+        for sample in matrix.columns
+    ]
+
+
+class AssignmentCache:
+    """Persistent per-sample tool activities with LRU eviction, stored in SQLite"""
+
+    def __init__(self, db_path, max_entries=DEFAULT_MAX_ENTRIES):
+        if os.path.dirname(db_path):
+            os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(db_path, check_same_thread=False)
+        with self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS assignments '
+                '(key TEXT PRIMARY KEY, activities TEXT NOT NULL, last_used REAL NOT NULL)'
+            )
+            self.connection.execute(
+                'CREATE INDEX IF NOT EXISTS assignments_last_used ON assignments (last_used)'
+            )
+
+    @staticmethod
+    def make_key(sample_digest, reference_digest, tool, strategy, tool_version):
+        return hashlib.sha256('\0'.join([sample_digest, reference_digest, tool, strategy, tool_version]).encode()).hexdigest()
+
+    def get_many(self, keys):
+        """Returns the cached activities of the given keys as {key: {column: value}}, refreshing their recency"""
+        keys = list(dict.fromkeys(keys))
+        found = {}
+        with self.lock, self.connection:
+            for start in range(0, len(keys), QUERY_BATCH_SIZE):
+                batch = keys[start:start + QUERY_BATCH_SIZE]
+                placeholders = ','.join('?' * len(batch))
+                rows = self.connection.execute(
+                    f'SELECT key, activities FROM assignments WHERE key IN ({placeholders})', batch
+                ).fetchall()
+                found.update({key: json.loads(activities) for key, activities in rows})
+                self.connection.execute(
+                    f'UPDATE assignments SET last_used = ? WHERE key IN ({placeholders})', [time.time()] + batch
+                )
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+        return found
+
+    def put_many(self, items):
+        """Stores {key: {column: value}} activities and evicts the least recently used beyond max_entries"""
+        now = time.time()
+        with self.lock, self.connection:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO assignments (key, activities, last_used) VALUES (?, ?, ?)',
+                [(key, json.dumps(activities, default=lambda x: x.item()), now) for key, activities in items.items()]
+            )
+            excess = self.connection.execute('SELECT COUNT(*) FROM assignments').fetchone()[0] - self.max_entries
+            if excess > 0:
+                self.connection.execute(
+                    'DELETE FROM assignments WHERE key IN '
+                    '(SELECT key FROM assignments ORDER BY last_used LIMIT ?)', (excess,)
+                )
+                LOGGER.info("Evicted %d least recently used assignment(s) from the cache", excess)
+
+    def lookup(self, digests, reference_digest, tool, strategy, tool_version):
+        """Returns the cached activities of the given sample digests as {digest: {column: value}}"""
+        keys = {self.make_key(digest, reference_digest, tool, strategy, tool_version): digest for digest in digests}
+        return {keys[key]: activities for key, activities in self.get_many(keys).items()}
+
+    def store(self, activities, reference_digest, tool, strategy, tool_version):
+        """Stores {digest: {column: value}} activities fitted by a tool"""
+        self.put_many({
+            self.make_key(digest, reference_digest, tool, strategy, tool_version): row
+            for digest, row in activities.items()
+        })
+
+    def stats(self):
+        with self.lock:
+            entries = self.connection.execute('SELECT COUNT(*) FROM assignments').fetchone()[0]
+            return {'hits': self.hits, 'misses': self.misses, 'entries': entries}
+
+    def close(self):
+        self.connection.close()
+
+
+def find_cache_misses(digests, cached):
+    """Returns the column indices and digests of the first sample of every distinct uncached digest, in column order"""
+    indices = []
+    miss_digests = []
+    seen = set(cached)
+    for i, digest in enumerate(digests):
+        if digest in seen:
+            continue
+        seen.add(digest)
+        indices.append(i)
+        miss_digests.append(digest)
+    return indices, miss_digests
@@ -0,0 +1,254 @@
+import os
+import time
+import zlib
+import struct
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from common.s3_transfer import MB, DEFAULT_MULTIPART_CHUNKSIZE_MB, DEFAULT_MAX_CONCURRENCY
+
+logging.basicConfig()
+LOGGER = logging.getLogger(__name__)
+LOGGER.setLevel(logging.INFO)
+
+DEFAULT_COMPRESSION_LEVEL = 6
+READ_SIZE = MB
+# Entries larger than this are compressed while streaming instead of ahead in memory
+MAX_PARALLEL_ENTRY_SIZE = 64 * MB
+# Stored as is at any compression level, deflating them again only costs CPU
+STORED_EXTENSIONS = ('.gz', '.bgz', '.bz2', '.xz', '.zip', '.png', '.jpg', '.pdf')
+# S3 rejects parts smaller than this, except the last
+MIN_PART_SIZE_MB = 5
+
+ZIP64_LIMIT = (1 << 31) - 1
+ZIP_MAX = 0xFFFFFFFF
+ZIP_FILECOUNT_LIMIT = 0xFFFF
+FLAG_DATA_DESCRIPTOR = 0x08
+FLAG_UTF8 = 0x800
+ZIP_STORED = 0
+ZIP_DEFLATED = 8
+
+
+class MultipartUploadWriter:
+    """Write-only stream that uploads everything written to it as the parts of one S3 multipart upload"""
+
+    def __init__(self, client, bucket, key, part_size_mb=DEFAULT_MULTIPART_CHUNKSIZE_MB, max_concurrency=DEFAULT_MAX_CONCURRENCY):
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        if part_size_mb < MIN_PART_SIZE_MB:
+            # Raised like boto3's transfer manager does, rather than failing the upload at its second part
+            LOGGER.warning("Part size of %s MB is below the S3 minimum, using %d MB", part_size_mb, MIN_PART_SIZE_MB)
+            part_size_mb = MIN_PART_SIZE_MB
+        self.part_size = int(part_size_mb * MB)
+        self.upload_id = client.create_multipart_upload(Bucket=bucket, Key=key)['UploadId']
+        self.buffer = bytearray()
+        self.futures = []
+        self.size = 0
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix='s3-part')
+        # Bounds the parts held in memory while they upload
+        self.slots = threading.BoundedSemaphore(max_concurrency * 2)
+
+    def write(self, data):
+        self.buffer += data
+        self.size += len(data)
+        while len(self.buffer) >= self.part_size:
+            self.submit_part(bytes(self.buffer[:self.part_size]))
+            del self.buffer[:self.part_size]
+        return len(data)
+
+    def submit_part(self, body):
+        self.slots.acquire()
+        self.futures.append(self.executor.submit(self.upload_part, len(self.futures) + 1, body))
+
+    def upload_part(self, part_number, body):
+        try:
+            response = self.client.upload_part(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                                               PartNumber=part_number, Body=body)
+            return {'PartNumber': part_number, 'ETag': response['ETag']}
+        finally:
+            self.slots.release()
+
+    def close(self):
+        # The last part may be smaller than the part size
+        if self.buffer or not self.futures:
+            self.submit_part(bytes(self.buffer))
+            self.buffer = bytearray()
+        parts = [future.result() for future in self.futures]
+        self.executor.shutdown()
+        self.client.complete_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                                              MultipartUpload={'Parts': parts})
+
+    def abort(self):
+        self.executor.shutdown(cancel_futures=True)
+        self.client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+
+
+def get_compresslevel(path, compresslevel):
+    return 0 if path.lower().endswith(STORED_EXTENSIONS) else compresslevel
+
+
+def iter_compressed(path, compresslevel, info):
+    """Yields the file's raw deflate chunks, or its bytes if compresslevel is 0, and fills info with its CRC and sizes"""
+    crc = 0
+    file_size = 0
+    compress_size = 0
+    compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, -15) if compresslevel else None
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(READ_SIZE), b''):
+            crc = zlib.crc32(chunk, crc)
+            file_size += len(chunk)
+            if compressor:
+                chunk = compressor.compress(chunk)
+            compress_size += len(chunk)
+            yield chunk
+    if compressor:
+        chunk = compressor.flush()
+        compress_size += len(chunk)
+        yield chunk
+    info.update(crc=crc, file_size=file_size, compress_size=compress_size)
+
+
+def compress_file(path, compresslevel):
+    """Compresses the whole file in memory, returns its chunks and info"""
+    info = {}
+    chunks = list(iter_compressed(path, compresslevel, info))
+    return chunks, info
+
+
+def dos_datetime(mtime):
+    t = time.localtime(max(mtime, 315532800))
+    return (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2), ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+
+
+class StreamingZipWriter:
+    """Writes a zip archive to an unseekable stream, with sizes and CRCs in data descriptors after each entry"""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.offset = 0
+        self.entries = []
+
+    def write(self, data):
+        self.stream.write(data)
+        self.offset += len(data)
+
+    def add_entry(self, arcname, st, compresslevel, chunks, info):
+        """Writes one file or directory entry, info is filled once chunks are exhausted"""
+        name = arcname.encode('utf-8')
+        is_zip64 = st.st_size > ZIP64_LIMIT
+        method = ZIP_DEFLATED if compresslevel else ZIP_STORED
+        version = 45 if is_zip64 else 20
+        dostime, dosdate = dos_datetime(st.st_mtime)
+        entry = {
+            'name': name,
+            'offset': self.offset,
+            'method': method,
+            'version': version,
+            'dostime': dostime,
+            'dosdate': dosdate,
+            'external_attr': (st.st_mode & 0xFFFF) << 16 | (0x10 if arcname.endswith('/') else 0),
+        }
+        extra = struct.pack('<HHQQ', 1, 16, 0, 0) if is_zip64 else b''
+        sizes = ZIP_MAX if is_zip64 else 0
+        self.write(struct.pack('<4s5H3L2H', b'PK\x03\x04', version, FLAG_DATA_DESCRIPTOR | FLAG_UTF8, method,
+                               dostime, dosdate, 0, sizes, sizes, len(name), len(extra)) + name + extra)
+        for chunk in chunks:
+            self.write(chunk)
+        entry.update(info)
+        if is_zip64:
+            self.write(struct.pack('<4sLQQ', b'PK\x07\x08', info['crc'], info['compress_size'], info['file_size']))
+        else:
+            self.write(struct.pack('<4s3L', b'PK\x07\x08', info['crc'], info['compress_size'], info['file_size']))
+        self.entries.append(entry)
+
+    def close(self):
+        """Writes the central directory"""
+        cd_offset = self.offset
+        for entry in self.entries:
+            extra = b''
+            file_size, compress_size, offset = entry['file_size'], entry['compress_size'], entry['offset']
+            version = entry['version']
+            if max(file_size, compress_size, offset) >= ZIP_MAX:
+                extra = struct.pack('<HHQQQ', 1, 24, file_size, compress_size, offset)
+                file_size = compress_size = offset = ZIP_MAX
+                version = 45
+            self.write(struct.pack('<4s6H3L5H2L', b'PK\x01\x02', 3 << 8 | version, version,
+                                   FLAG_DATA_DESCRIPTOR | FLAG_UTF8, entry['method'], entry['dostime'], entry['dosdate'],
+                                   entry['crc'], compress_size, file_size, len(entry['name']), len(extra), 0, 0, 0,
+                                   entry['external_attr'], offset) + entry['name'] + extra)
+        cd_size = self.offset - cd_offset
+        count = len(self.entries)
+        if count > ZIP_FILECOUNT_LIMIT or cd_offset >= ZIP_MAX or cd_size >= ZIP_MAX:
+            zip64_offset = self.offset
+            self.write(struct.pack('<4sQ2H2L4Q', b'PK\x06\x06', 44, 45, 45, 0, 0, count, count, cd_size, cd_offset))
+            self.write(struct.pack('<4sLQL', b'PK\x06\x07', 0, zip64_offset, 1))
+            # Readers take these from the zip64 records instead
+            count = 0xFFFF
+            cd_size = cd_offset = ZIP_MAX
+        self.write(struct.pack('<4s4H2LH', b'PK\x05\x06', 0, 0, count, count, cd_size, cd_offset, 0))
+
+
+def walk_archive_entries(root_dir, base_dir):
+    """Lists (path, arcname) of base_dir's directories and files like shutil.make_archive"""
+    base_path = os.path.normpath(os.path.join(root_dir, base_dir))
+    entries = []
+    for dirpath, dirnames, filenames in os.walk(base_path):
+        dirnames.sort()
+        arcdir = os.path.relpath(dirpath, root_dir)
+        entries.append((dirpath, arcdir.replace(os.sep, '/') + '/'))
+        for filename in sorted(filenames):
+            entries.append((os.path.join(dirpath, filename), os.path.join(arcdir, filename).replace(os.sep, '/')))
+    return entries
+
+
+def stream_archive(client, root_dir, base_dir, bucket, key, compresslevel=DEFAULT_COMPRESSION_LEVEL, max_workers=1,
+                   part_size_mb=DEFAULT_MULTIPART_CHUNKSIZE_MB, max_concurrency=DEFAULT_MAX_CONCURRENCY):
+    """Zips root_dir/base_dir straight into a multipart upload, compressing up to max_workers entries ahead in parallel"""
+    start = time.time()
+    entries = [(path, arcname, os.stat(path)) for path, arcname in walk_archive_entries(root_dir, base_dir)]
+    stream = MultipartUploadWriter(client, bucket, key, part_size_mb, max_concurrency)
+    archive = StreamingZipWriter(stream)
+    executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='zip') if max_workers > 1 else None
+    try:
+        pending = deque()
+
+        def submit(entry):
+            path, arcname, st = entry
+            level = get_compresslevel(path, compresslevel)
+            if executor and not arcname.endswith('/') and st.st_size <= MAX_PARALLEL_ENTRY_SIZE:
+                pending.append((entry, level, executor.submit(compress_file, path, level)))
+            else:
+                pending.append((entry, level, None))
+
+        upcoming = iter(entries)
+        for entry in upcoming:
+            submit(entry)
+            if len(pending) >= max_workers:
+                break
+        while pending:
+            (path, arcname, st), level, future = pending.popleft()
+            if arcname.endswith('/'):
+                archive.add_entry(arcname, st, 0, [], {'crc': 0, 'file_size': 0, 'compress_size': 0})
+            elif future:
+                archive.add_entry(arcname, st, level, *future.result())
+            else:
+                info = {}
+                archive.add_entry(arcname, st, level, iter_compressed(path, level, info), info)
+            entry = next(upcoming, None)
+            if entry:
+                submit(entry)
+        archive.close()
+        stream.close()
+    except BaseException:
+        stream.abort()
+        raise
+    finally:
+        if executor:
+            executor.shutdown(cancel_futures=True)
+    seconds = time.time() - start
+    LOGGER.info("Streamed %d archive entries, %.1f MB to s3://%s/%s in %.1fs (%.1f MB/s)", len(entries), stream.size / MB,
+                bucket, key, seconds, stream.size / MB / seconds if seconds > 0 else 0)
+    return stream.size
@@ -0,0 +1,80 @@
+import os
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+logging.basicConfig()
+LOGGER = logging.getLogger(__name__)
+LOGGER.setLevel(logging.INFO)
+
+MB = 1024 ** 2
+DEFAULT_MAX_WORKERS = 16
+DEFAULT_MULTIPART_CHUNKSIZE_MB = 16
+DEFAULT_MAX_CONCURRENCY = 4
+
+
+def get_transfer_config(multipart_chunksize_mb=DEFAULT_MULTIPART_CHUNKSIZE_MB, max_concurrency=DEFAULT_MAX_CONCURRENCY):
+    """Multipart settings of each file transfer, parts are sent by max_concurrency threads"""
+    from boto3.s3.transfer import TransferConfig
+    return TransferConfig(
+        multipart_threshold=multipart_chunksize_mb * MB,
+        multipart_chunksize=multipart_chunksize_mb * MB,
+        max_concurrency=max_concurrency,
+        use_threads=max_concurrency > 1
+    )
+
+
+def get_client_config(max_workers=DEFAULT_MAX_WORKERS, max_concurrency=DEFAULT_MAX_CONCURRENCY):
+    """Sizes the client's connection pool for every file and part in flight at once"""
+    from botocore.config import Config
+    return Config(max_pool_connections=max_workers * max_concurrency)
+
+
+def run_transfers(transfer, items, max_workers, direction):
+    """Runs transfer(*item) for every item on a bounded thread pool, logs and returns the throughput
+
+    A failed transfer does not stop the others. Every failure is logged with its item once all are done,
+    then the first one is raised.
+    """
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=f's3-{direction}') as executor:
+        futures = [executor.submit(transfer, *item) for item in items]
+    total_bytes = 0
+    errors = []
+    for item, future in zip(items, futures):
+        if future.exception():
+            LOGGER.error("S3 %s failed: %s: %s", direction, item, future.exception())
+            errors.append(future.exception())
+        else:
+            total_bytes += future.result()
+    if errors:
+        LOGGER.error("S3 %s: %d of %d file(s) failed", direction, len(errors), len(items))
+        raise errors[0]
+    seconds = time.time() - start
+    stats = {
+        'files': len(items),
+        'bytes': total_bytes,
+        'seconds': seconds,
+        'bytes_per_second': total_bytes / seconds if seconds > 0 else 0,
+    }
+    LOGGER.info("S3 %s: %d file(s), %.1f MB in %.1fs (%.1f MB/s)", direction, stats['files'],
+                total_bytes / MB, seconds, stats['bytes_per_second'] / MB)
+    return stats
+
+
+def download_files(client, items, transfer_config, max_workers=DEFAULT_MAX_WORKERS):
+    """Downloads (bucket, key, path) items concurrently with a low-level S3 client"""
+    def download(bucket, key, path):
+        LOGGER.info("Downloading s3_key: %s from s3_bucket: %s to %s", key, bucket, path)
+        client.download_file(bucket, key, path, Config=transfer_config)
+        return os.path.getsize(path)
+    return run_transfers(download, items, max_workers, 'download')
+
+
+def upload_files(client, items, transfer_config, max_workers=DEFAULT_MAX_WORKERS):
+    """Uploads (path, bucket, key) items concurrently with a low-level S3 client"""
+    def upload(path, bucket, key):
+        LOGGER.info("Uploading %s, s3_key: %s to s3_bucket: %s", path, key, bucket)
+        client.upload_file(path, bucket, key, Config=transfer_config)
+        return os.path.getsize(path)
+    return run_transfers(upload, items, max_workers, 'upload')
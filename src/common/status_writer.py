@@ -0,0 +1,143 @@
+import time
+import uuid
+import logging
+import threading
+from datetime import datetime
+
+logging.basicConfig()
+LOGGER = logging.getLogger(__name__)
+LOGGER.setLevel(logging.INFO)
+
+TERMINAL_STATUSES = ('complete', 'failed')
+THROTTLING_ERROR_CODES = ('ProvisionedThroughputExceededException', 'ThrottlingException', 'RequestLimitExceeded')
+DEFAULT_FLUSH_INTERVAL = 1.0
+MAX_RETRY_DELAY = 30.0
+
+
+def make_status_item(job_config, message_id, status, workflow, message=None):
+    """A job status record, each transition is a new item keyed by the job id and a fresh uuid"""
+    time_now = datetime.now()
+    return {
+        "user_id": job_config["user_id"],
+        "job_id": f"{job_config['job_id']}_{str(uuid.uuid4())}",
+        "message_id": message_id,
+        "timestamp": int(time_now.timestamp() * 1000),
+        "timestamp_iso": time_now.isoformat(),
+        "job_status": status,
+        "workflow": workflow,
+        "message": message or "",
+    }
+
+
+class JobStatusWriter:
+    """Writes job status transitions to DynamoDB from a background thread in batches
+
+    Pending transitions of the same job and workflow are coalesced into the latest one. Terminal
+    statuses are written synchronously, replacing whatever was still pending for the job. A batch
+    that fails goes back to pending, except where a newer status arrived meanwhile, and is retried
+    with exponential backoff.
+    """
+
+    def __init__(self, ddb_client, ddb_table_name, flush_interval=DEFAULT_FLUSH_INTERVAL):
+        self.table = ddb_client.Table(ddb_table_name)
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        # Serializes writes so a flush never lands after a newer synchronous terminal write
+        self.write_lock = threading.Lock()
+        self.pending = {}
+        # The newest status of each job and workflow until it is written, so a failed batch never overrides it
+        self.latest = {}
+        self.retry_delay = 0.0
+        self.stopped = threading.Event()
+        self.counters = {'writes': 0, 'batches': 0, 'coalesced': 0, 'sync_writes': 0, 'throttled_items': 0,
+                         'throttle_errors': 0, 'errors': 0, 'retried_items': 0, 'latency_seconds_total': 0.0, 'latency_seconds_max': 0.0}
+        # batch_writer resends unprocessed items by itself, count them as they come back
+        self.table.meta.client.meta.events.register('after-call.dynamodb.BatchWriteItem', self.count_unprocessed)
+        self.thread = threading.Thread(target=self.run, name='job-status-writer', daemon=True)
+        self.thread.start()
+
+    def count_unprocessed(self, parsed, **kwargs):
+        unprocessed = sum(len(requests) for requests in parsed.get('UnprocessedItems', {}).values())
+        if unprocessed:
+            with self.lock:
+                self.counters['throttled_items'] += unprocessed
+
+    def update(self, job_config, message_id, status, workflow, message=None):
+        item = make_status_item(job_config, message_id, status, workflow, message)
+        key = (job_config['job_id'], workflow)
+        with self.lock:
+            if self.pending.pop(key, None):
+                self.counters['coalesced'] += 1
+            if status not in TERMINAL_STATUSES:
+                self.pending[key] = item
+                self.latest[key] = item
+                return
+            self.latest.pop(key, None)
+        with self.write_lock:
+            self.write([item], sync=True)
+
+    def write(self, items, sync=False):
+        """Writes items, returns whether they were written. A failed synchronous write raises"""
+        from botocore.exceptions import BotoCoreError, ClientError
+        start = time.time()
+        try:
+            if sync:
+                self.table.put_item(Item=items[0])
+            else:
+                with self.table.batch_writer() as batch:
+                    for item in items:
+                        batch.put_item(Item=item)
+        except (BotoCoreError, ClientError) as e:
+            with self.lock:
+                self.counters['errors'] += 1
+                if isinstance(e, ClientError) and e.response['Error']['Code'] in THROTTLING_ERROR_CODES:
+                    self.counters['throttle_errors'] += 1
+            LOGGER.error("Could not write %d job status(es) to DynamoDB table: %s | %s", len(items), self.table.name, e)
+            if sync:
+                raise
+            return False
+        latency = time.time() - start
+        with self.lock:
+            self.counters['writes'] += len(items)
+            self.counters['sync_writes' if sync else 'batches'] += 1
+            self.counters['latency_seconds_total'] += latency
+            self.counters['latency_seconds_max'] = max(self.counters['latency_seconds_max'], latency)
+        return True
+
+    def flush(self):
+        with self.write_lock:
+            with self.lock:
+                pending, self.pending = self.pending, {}
+            if not pending:
+                return
+            written = self.write(list(pending.values()))
+            with self.lock:
+                for key, item in pending.items():
+                    if self.latest.get(key) is not item:
+                        continue
+                    if written:
+                        del self.latest[key]
+                    else:
+                        self.pending.setdefault(key, item)
+                        self.counters['retried_items'] += 1
+            self.retry_delay = 0.0 if written else min(max(2 * self.retry_delay, self.flush_interval), MAX_RETRY_DELAY)
+
+    def run(self):
+        while not self.stopped.wait(self.flush_interval + self.retry_delay):
+            self.flush()
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+        calls = stats['batches'] + stats['sync_writes']
+        stats['latency_seconds_mean'] = stats.pop('latency_seconds_total') / calls if calls else 0.0
+        return stats
+
+    def close(self):
+        """Stops the background thread and writes what is still pending"""
+        self.stopped.set()
+        self.thread.join()
+        self.flush()
+        if self.pending:
+            LOGGER.error("Could not write the last status of %d job(s)", len(self.pending))
+        LOGGER.info("Job status writer: %s", self.stats())
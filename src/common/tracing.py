@@ -0,0 +1,203 @@
+import os
+import json
+import time
+import uuid
+import functools
+import threading
+import contextlib
+import contextvars
+
+# A job's processes append their spans to one trace file, children continue the parent's trace
+TRACE_PATH_ENV = 'ENSEMBLEFIT_TRACE_PATH'
+TRACE_ID_ENV = 'ENSEMBLEFIT_TRACE_ID'
+TRACE_PARENT_ENV = 'ENSEMBLEFIT_TRACE_PARENT'
+# Parsl tasks are drawn on lanes of their own, above any thread id
+TASK_LANE_OFFSET = 1000000
+
+current_span_id = contextvars.ContextVar('current_span_id', default=None)
+current_tracer = contextvars.ContextVar('current_tracer', default=None)
+
+
+def new_span_id():
+    return uuid.uuid4().hex[:16]
+
+
+class Tracer:
+    """Writes spans as complete events of the Chrome trace event format, viewable in Perfetto or chrome://tracing
+
+    The file is a JSON array whose closing bracket is left out, as the format allows, so that concurrent
+    processes can append one event per line. Each event's args carry its trace, span and parent span ids.
+    """
+
+    def __init__(self, path=None, trace_id=None, parent_id=None):
+        self.path = path
+        self.trace_id = trace_id or uuid.uuid4().hex
+        self.parent_id = parent_id
+        self.pid = os.getpid()
+
+    @property
+    def enabled(self):
+        return self.path is not None
+
+    def write(self, event):
+        if not self.enabled:
+            return
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        try:
+            fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+            os.write(fd, b'[\n')
+            os.close(fd)
+        except FileExistsError:
+            pass
+        # A single write to a file opened for appending lands whole, even with other writers
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND)
+        try:
+            os.write(fd, (json.dumps(event, default=str) + ',\n').encode())
+        finally:
+            os.close(fd)
+
+    def add_span(self, name, start, end, parent_id=None, span_id=None, tid=None, **attributes):
+        """Writes a span that has already ended, from epoch seconds, and returns its id"""
+        span_id = span_id or new_span_id()
+        self.write({
+            'name': name,
+            'cat': 'ensemblefit',
+            'ph': 'X',
+            'ts': start * 1e6,
+            'dur': max(end - start, 0) * 1e6,
+            'pid': self.pid,
+            'tid': tid if tid is not None else threading.get_native_id(),
+            'args': {
+                'trace_id': self.trace_id,
+                'span_id': span_id,
+                'parent_id': parent_id if parent_id is not None else (current_span_id.get() or self.parent_id),
+                **attributes,
+            },
+        })
+        return span_id
+
+    def name_lane(self, tid, name):
+        self.write({'name': 'thread_name', 'ph': 'M', 'pid': self.pid, 'tid': tid, 'args': {'name': name}})
+
+    @contextlib.contextmanager
+    def span(self, name, **attributes):
+        """Times the block as a child of the current span, recording the error it raised if any"""
+        span_id = new_span_id()
+        parent_id = current_span_id.get() or self.parent_id
+        token = current_span_id.set(span_id)
+        tracer_token = current_tracer.set(self)
+        start = time.time()
+        try:
+            yield span_id
+        except BaseException as e:
+            attributes['error'] = repr(e)
+            raise
+        finally:
+            current_tracer.reset(tracer_token)
+            current_span_id.reset(token)
+            self.add_span(name, start, time.time(), parent_id=parent_id, span_id=span_id, **attributes)
+
+    def child_env(self):
+        """Environment variables that make a child process continue this trace under the current span"""
+        if not self.enabled:
+            return {}
+        return {
+            TRACE_PATH_ENV: self.path,
+            TRACE_ID_ENV: self.trace_id,
+            TRACE_PARENT_ENV: current_span_id.get() or self.parent_id or '',
+        }
+
+
+@functools.lru_cache(maxsize=None)
+def get_process_tracer():
+    """The process's tracer, writing to $ENSEMBLEFIT_TRACE_PATH, or doing nothing if it is not set"""
+    return Tracer(os.environ.get(TRACE_PATH_ENV), os.environ.get(TRACE_ID_ENV), os.environ.get(TRACE_PARENT_ENV) or None)
+
+
+def get_tracer():
+    """The tracer of the span being run, so a worker's concurrent jobs keep their own traces, else the process's"""
+    return current_tracer.get() or get_process_tracer()
+
+
+def span(name, **attributes):
+    return get_tracer().span(name, **attributes)
+
+
+def traced(name):
+    """Decorates a function so that every call is a span"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def collect_tasks(futures):
+    """Returns the task records of the futures and every task they depend on or join, by task id"""
+    tasks = {}
+    pending = list(futures)
+    while pending:
+        future = pending.pop()
+        task = getattr(future, 'task_def', None)
+        if task is None or task['id'] in tasks:
+            continue
+        tasks[task['id']] = task
+        pending += task['depends'] or []
+        # A join app's task waits on the future its body returned
+        if task.get('joins') is not None:
+            pending.append(task['joins'])
+    return tasks
+
+
+def add_task_spans(tracer, futures, metrics_records=(), parent_id=None):
+    """Writes a span for each Parsl task reachable from futures, with its waits and attempts as children
+
+    A task waits on its dependencies from submission until it is launched, then in the executor's queue
+    until its attempt starts. Attempts are taken from the task_metrics records of bash apps, matched
+    by the task's log file; other tasks have a single run span from launch to return.
+    """
+    if not tracer.enabled:
+        return
+    tasks = collect_tasks(futures)
+    attempts = {}
+    for record in metrics_records:
+        if record.get('task_log'):
+            attempts.setdefault(record['task_log'], []).append(record)
+    span_ids = {task_id: new_span_id() for task_id in tasks}
+    for task_id, task in sorted(tasks.items()):
+        if task['time_returned'] is None:
+            continue
+        tid = TASK_LANE_OFFSET + task_id
+        tracer.name_lane(tid, f"task {task_id} {task['func_name']}")
+        invoked = task['time_invoked'].timestamp()
+        returned = task['time_returned'].timestamp()
+        launched = task['try_time_launched'].timestamp() if task['try_time_launched'] else returned
+        depends = [span_ids[f.tid] for f in task['depends'] or [] if getattr(f, 'task_def', None) and f.tid in span_ids]
+        span_id = tracer.add_span(
+            task['func_name'], invoked, returned, parent_id=parent_id, span_id=span_ids[task_id], tid=tid,
+            task_id=task_id, executor=task['executor'], status=task['status'].name, retries=task['fail_count'],
+            from_memo=bool(task.get('from_memo')), depends=depends,
+        )
+        task_attempts = sorted(attempts.get(task['kwargs'].get('stdout'), []), key=lambda record: record['started'])
+        # Parsl keeps the launch time of the last try only, the waits of a retried task end at its first attempt
+        dependency_end = task_attempts[0]['started'] if task['fail_count'] and task_attempts else launched
+        tracer.add_span('dependency wait', invoked, dependency_end, parent_id=span_id, tid=tid, wait=True)
+        if task_attempts:
+            tracer.add_span('queue wait', launched, max(task_attempts[-1]['started'], launched), parent_id=span_id, tid=tid, wait=True)
+            for attempt, record in enumerate(task_attempts):
+                tracer.add_span('run', record['started'], record['started'] + record['wall_seconds'], parent_id=span_id,
+                                tid=tid, attempt=attempt, host=record['host'], exit_code=record['exit_code'])
+        elif not task.get('from_memo'):
+            tracer.add_span('run', launched, returned, parent_id=span_id, tid=tid, attempt=task['fail_count'])
+
+
+def read_trace(path):
+    """Reads the events of a trace file, whether or not its array was closed"""
+    with open(path) as f:
+        text = f.read().strip().rstrip(',')
+    if not text.endswith(']'):
+        text += ']'
+    return json.loads(text)
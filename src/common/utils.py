@@ -1,4 +1,7 @@
+import os
 import decimal
+import hashlib
+import threading
 
 
 def replace_decimals(obj):
@@ -12,3 +15,40 @@ def replace_decimals(obj):
     elif isinstance(obj, decimal.Decimal):
         return int(obj) if obj % 1 == 0 else obj
     return obj
+
+
+HASH_CHUNK_SIZE = 1024 * 1024
+# Digests keyed by (device, inode, mtime, size) so unchanged files are hashed only once
+DIGEST_CACHE = {}
+DIGEST_CACHE_LOCK = threading.Lock()
+
+
+def file_digest(path):
+    """Returns the SHA-256 digest of a file's content, reusing it while the file is unchanged"""
+    stat_result = os.stat(path)
+    key = (stat_result.st_dev, stat_result.st_ino, stat_result.st_mtime_ns, stat_result.st_size)
+    with DIGEST_CACHE_LOCK:
+        if key in DIGEST_CACHE:
+            return DIGEST_CACHE[key]
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            sha256.update(chunk)
+    digest = sha256.hexdigest()
+    with DIGEST_CACHE_LOCK:
+        DIGEST_CACHE[key] = digest
+    return digest
+
+
+def path_digest(path):
+    """Returns the digest of a file, or of a directory's relative file paths and their contents"""
+    if not os.path.isdir(path):
+        return file_digest(path)
+    sha256 = hashlib.sha256()
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for filename in sorted(files):
+            file_path = os.path.join(root, filename)
+            sha256.update(os.path.relpath(file_path, path).encode())
+            sha256.update(file_digest(file_path).encode())
+    return sha256.hexdigest()
@@ -1,11 +1,10 @@
 import os
 import json
 import logging
-import shutil
-import uuid
-from datetime import datetime
+import functools
 
-import boto3
+from common import s3_transfer, s3_archive, tracing
+from common.status_writer import make_status_item
 
 MUTSIG_WORKFLOW_NAME = 'mutsig'
 MATRIXGEN_WORKFLOW_NAME = 'matrixgen'
@@ -16,6 +15,7 @@ JOB_CONFIG_FILENAME = "manifest.json"
 DEFAULT_BASE_WORKDIR_PATH = "/tmp/ensemblefit"
 
 MUTSIG_OUTPUT_FILES = [
+    "assignment_metrics.json",
     "assignment_metrics.txt",
     "assignment_summary.json",
     "assignment_summary.txt",
@@ -26,37 +26,69 @@ MATRIXGEN_OUTPUT_FILES = [
     "mutsig.SBS96.all",
 ]
 
-SQS_CLIENT = boto3.client('sqs', region_name="ap-southeast-1")
-S3_CLIENT = boto3.resource('s3', region_name='ap-southeast-1')
-DYNAMODB_CLIENT = boto3.resource('dynamodb', region_name="ap-southeast-1")
+# Concurrent files and multipart settings of each file, shared by every transfer through one connection pool
+S3_TRANSFER_WORKERS = int(os.environ.get('S3_TRANSFER_WORKERS', s3_transfer.DEFAULT_MAX_WORKERS))
+S3_MULTIPART_CHUNKSIZE_MB = int(os.environ.get('S3_MULTIPART_CHUNKSIZE_MB', s3_transfer.DEFAULT_MULTIPART_CHUNKSIZE_MB))
+S3_MAX_CONCURRENCY = int(os.environ.get('S3_MAX_CONCURRENCY', s3_transfer.DEFAULT_MAX_CONCURRENCY))
+# Archives are zipped straight into S3, 0 stores entries uncompressed
+ARCHIVE_COMPRESSION_LEVEL = int(os.environ.get('ARCHIVE_COMPRESSION_LEVEL', s3_archive.DEFAULT_COMPRESSION_LEVEL))
+ARCHIVE_COMPRESSION_WORKERS = int(os.environ.get('ARCHIVE_COMPRESSION_WORKERS', 1))
 
-JOB_SUBMISSION_DDB_TABLE_NAME = os.environ['JOB_SUBMISSION_DYNAMODB_TABLE_NAME']
-JOB_STATUS_DDB_TABLE_NAME = os.environ['JOB_STATUS_DYNAMODB_TABLE_NAME']
-OUTPUT_S3_BUCKET = os.environ['ENSEMBLEFIT_OUTPUTS_S3_BUCKET']
+AWS_REGION = "ap-southeast-1"
 
 logging.basicConfig()
 LOGGER = logging.getLogger(__name__)
 LOGGER.setLevel(logging.INFO)
 
 
+@functools.lru_cache(maxsize=None)
+def get_s3_transfer_config():
+    return s3_transfer.get_transfer_config(S3_MULTIPART_CHUNKSIZE_MB, S3_MAX_CONCURRENCY)
+
+
+@functools.lru_cache(maxsize=None)
+def get_sqs_client():
+    import boto3
+    return boto3.client('sqs', region_name=AWS_REGION)
+
+
+@functools.lru_cache(maxsize=None)
+def get_s3_client():
+    import boto3
+    return boto3.resource('s3', region_name=AWS_REGION,
+                          config=s3_transfer.get_client_config(S3_TRANSFER_WORKERS, S3_MAX_CONCURRENCY))
+
+
+@functools.lru_cache(maxsize=None)
+def get_dynamodb_client():
+    import boto3
+    return boto3.resource('dynamodb', region_name=AWS_REGION)
+
+
+# AWS clients are created and required environment variables read on first use, so importing stays cheap
+LAZY_ATTRIBUTES = {
+    'SQS_CLIENT': get_sqs_client,
+    'S3_CLIENT': get_s3_client,
+    'DYNAMODB_CLIENT': get_dynamodb_client,
+    'JOB_SUBMISSION_DDB_TABLE_NAME': lambda: os.environ['JOB_SUBMISSION_DYNAMODB_TABLE_NAME'],
+    'JOB_STATUS_DDB_TABLE_NAME': lambda: os.environ['JOB_STATUS_DYNAMODB_TABLE_NAME'],
+    'OUTPUT_S3_BUCKET': lambda: os.environ['ENSEMBLEFIT_OUTPUTS_S3_BUCKET'],
+}
+
+
+def __getattr__(name):
+    if name in LAZY_ATTRIBUTES:
+        return LAZY_ATTRIBUTES[name]()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+@tracing.traced('status update')
 def update_job_status(ddb_client, ddb_table_name, job_config, message_id, status, workflow, message=None):
     """Update job status in DynamoDB"""
     job_status_table = ddb_client.Table(ddb_table_name)
     job_id = job_config["job_id"]
     LOGGER.info("Updating status in table: %s for job_id: %s, message_id: %s", job_status_table, job_id, message_id)
-    time_now = datetime.now()
-    response = job_status_table.put_item(
-        Item={
-            "user_id": job_config["user_id"],
-            "job_id": f"{job_id}_{str(uuid.uuid4())}",
-            "message_id": message_id,
-            "timestamp": int(time_now.timestamp() * 1000),
-            "timestamp_iso": time_now.isoformat(),
-            "job_status": status,
-            "workflow": workflow,
-            "message": message or "",
-        }
-    )
+    response = job_status_table.put_item(Item=make_status_item(job_config, message_id, status, workflow, message))
     LOGGER.info("Put item to DynamoDB table: %s", response)
 
 
@@ -75,55 +107,59 @@ def find_s3_bucket_key(file_item):
     return s3_bucket, s3_key
 
 
+@tracing.traced('s3 download')
 def download_input_files(s3_client, job_config, input_path, workflow_name):
     if job_config['file_type'] == 'vcf' and workflow_name == MUTSIG_WORKFLOW_NAME:
         upload_files = job_config['upload_matrixgen_files']
     else:
         upload_files = job_config['upload_files']
 
+    downloads = []
     for file_item in upload_files:
         s3_bucket, s3_key = find_s3_bucket_key(file_item)
         _, filename = os.path.split(file_item)
-        LOGGER.info("Downloading filename: %s, s3_key: %s from s3_bucket: %s", filename, s3_key, s3_bucket)
-        s3_client.Bucket(s3_bucket).download_file(s3_key, os.path.join(input_path, filename))
-        LOGGER.info("Downloaded filename: %s, input_path: %s", filename, input_path)
+        downloads.append((s3_bucket, s3_key, os.path.join(input_path, filename)))
+    stats = s3_transfer.download_files(s3_client.meta.client, downloads, get_s3_transfer_config(), S3_TRANSFER_WORKERS)
+    LOGGER.info("Downloaded %d input file(s) to input_path: %s", stats['files'], input_path)
+    return stats
 
 
+@tracing.traced('s3 upload')
 def upload_output_files(s3_client, s3_bucket, job_config, output_path, output_files):
-    uploaded_files_s3_urls = []
+    uploads = []
     for filename in output_files:
         if not os.path.isfile(os.path.join(output_path, filename)):
             raise RuntimeError("Could not upload outputs | file not found: %s", filename)
         s3_key = os.path.join(job_config['user_id'], job_config['job_id'], filename)
-        LOGGER.info("Uploading filename: %s, s3_key: %s to s3_bucket: %s", filename, s3_key, s3_bucket)
-        s3_client.Bucket(s3_bucket).upload_file(os.path.join(output_path, filename), s3_key)
-        uploaded_files_s3_urls.append(f"s3://{s3_bucket}/{s3_key}")
-    return uploaded_files_s3_urls
+        uploads.append((os.path.join(output_path, filename), s3_bucket, s3_key))
+    s3_transfer.upload_files(s3_client.meta.client, uploads, get_s3_transfer_config(), S3_TRANSFER_WORKERS)
+    return [f"s3://{s3_bucket}/{s3_key}" for _, _, s3_key in uploads]
 
 
+@tracing.traced('output archive upload')
 def upload_output_archive(s3_client, s3_bucket, job_config, job_workdir_path, output_path, workflow_name):
     user_id = job_config['user_id']
     job_id = job_config['job_id']
     base_filename = f"{workflow_name}_output.zip"
-    output_archive_path = os.path.join(job_workdir_path, base_filename)
-    shutil.make_archive(os.path.splitext(output_archive_path)[0], "zip", root_dir=job_workdir_path,
-                        base_dir=output_path)
 
     s3_key = os.path.join(user_id, job_id, base_filename)
-    LOGGER.info("Uploading output archive: %s, s3_key: %s to s3_bucket: %s", output_archive_path, s3_key, s3_bucket)
-    s3_client.Bucket(s3_bucket).upload_file(output_archive_path, s3_key)
+    LOGGER.info("Streaming output archive of: %s, s3_key: %s to s3_bucket: %s", output_path, s3_key, s3_bucket)
+    s3_archive.stream_archive(s3_client.meta.client, job_workdir_path, output_path, s3_bucket, s3_key,
+                              ARCHIVE_COMPRESSION_LEVEL, ARCHIVE_COMPRESSION_WORKERS,
+                              S3_MULTIPART_CHUNKSIZE_MB, S3_MAX_CONCURRENCY)
 
 
+@tracing.traced('logs archive upload')
 def upload_logs_archive(s3_client, s3_bucket, job_config, job_workdir_path, logs_path, workflow_name):
     user_id = job_config['user_id']
     job_id = job_config['job_id']
     base_filename = f"{workflow_name}_logs.zip"
-    logs_archive_path = os.path.join(job_workdir_path, base_filename)
-    shutil.make_archive(os.path.splitext(logs_archive_path)[0], "zip", root_dir=job_workdir_path, base_dir=logs_path)
 
     s3_key = os.path.join(user_id, job_id, base_filename)
-    LOGGER.info("Uploading logs archive: %s, s3_key: %s to s3_bucket: %s", logs_archive_path, s3_key, s3_bucket)
-    s3_client.Bucket(s3_bucket).upload_file(logs_archive_path, s3_key)
+    LOGGER.info("Streaming logs archive of: %s, s3_key: %s to s3_bucket: %s", logs_path, s3_key, s3_bucket)
+    s3_archive.stream_archive(s3_client.meta.client, job_workdir_path, logs_path, s3_bucket, s3_key,
+                              ARCHIVE_COMPRESSION_LEVEL, ARCHIVE_COMPRESSION_WORKERS,
+                              S3_MULTIPART_CHUNKSIZE_MB, S3_MAX_CONCURRENCY)
 
 
 def push_to_queue(sqs_client, sqs_queue, job_config):
@@ -0,0 +1,121 @@
+"""Reports, for each job of a trace file, its critical path of Parsl tasks and the time lost waiting at barriers
+
+The critical path starts from the task that returned last and follows, at each step, the dependency that
+returned last. A barrier is a span where the workflow waits on tasks; the part of it during which no task
+runs at all is reported as idle.
+
+Usage: python src/trace_report.py trace.json [--trace-id ID]
+"""
+import sys
+import argparse
+
+from common.tracing import read_trace
+
+
+def span_end(span):
+    return span['ts'] + span['dur']
+
+
+def busy_seconds(start, end, runs):
+    """Seconds of [start, end] during which at least one run span is running"""
+    intervals = sorted((max(run['ts'], start), min(span_end(run), end)) for run in runs)
+    busy = 0
+    busy_start, busy_end = None, None
+    for run_start, run_end in intervals:
+        if run_start >= run_end:
+            continue
+        if busy_end is None or run_start > busy_end:
+            if busy_end is not None:
+                busy += busy_end - busy_start
+            busy_start, busy_end = run_start, run_end
+        else:
+            busy_end = max(busy_end, run_end)
+    if busy_end is not None:
+        busy += busy_end - busy_start
+    return busy / 1e6
+
+
+def critical_path(tasks):
+    """Tasks from the first to the last of the chain of dependencies that finished last"""
+    if not tasks:
+        return []
+    task = max(tasks.values(), key=span_end)
+    path = [task]
+    while task['args'].get('depends'):
+        task = max((tasks[span_id] for span_id in task['args']['depends'] if span_id in tasks), key=span_end, default=None)
+        if task is None:
+            break
+        path.append(task)
+    return path[::-1]
+
+
+def child_seconds(children, span, name):
+    return sum(child['dur'] for child in children.get(span['args']['span_id'], []) if child['name'] == name) / 1e6
+
+
+def format_row(values, name):
+    return ''.join(f'{value:>12}' for value in values) + f'  {name}\n'
+
+
+def report_trace(trace_id, spans):
+    by_id = {span['args']['span_id']: span for span in spans}
+    children = {}
+    for span in spans:
+        children.setdefault(span['args'].get('parent_id'), []).append(span)
+    roots = [span for span in spans if span['args'].get('parent_id') not in by_id]
+    tasks = {span['args']['span_id']: span for span in spans if 'task_id' in span['args']}
+    runs = [span for span in spans if span['name'] == 'run']
+    start = min(span['ts'] for span in spans)
+    end = max(span_end(span) for span in spans)
+
+    res = f'{f" TRACE {trace_id} ".center(72, "=")}\n'
+    res += f"Duration: {(end - start) / 1e6:.2f} s ({', '.join(sorted({root['name'] for root in roots}))})\n"
+
+    path = critical_path(tasks)
+    if path:
+        res += '\nCritical path\n'
+        res += format_row(['Start (s)', 'Deps (s)', 'Queue (s)', 'Run (s)', 'Retries'], 'Task')
+        for task in path:
+            res += format_row([
+                f"{(task['ts'] - start) / 1e6:.2f}", f"{child_seconds(children, task, 'dependency wait'):.2f}",
+                f"{child_seconds(children, task, 'queue wait'):.2f}", f"{child_seconds(children, task, 'run'):.2f}",
+                task['args']['retries'],
+            ], f"{task['name']} ({task['args']['task_id']})")
+        res += f"Before the path: {(path[0]['ts'] - start) / 1e6:.2f} s, after it: {(end - span_end(path[-1])) / 1e6:.2f} s\n"
+
+    barriers = [span for span in spans if span['args'].get('barrier')]
+    if barriers:
+        res += '\nBarriers\n'
+        res += format_row(['Wait (s)', 'Busy (s)', 'Idle (s)'], 'Barrier')
+        for barrier in sorted(barriers, key=lambda span: span['ts']):
+            busy = busy_seconds(barrier['ts'], span_end(barrier), runs)
+            res += format_row([f"{barrier['dur'] / 1e6:.2f}", f'{busy:.2f}', f"{barrier['dur'] / 1e6 - busy:.2f}"], barrier['name'])
+
+    if tasks:
+        res += '\nAll tasks: '
+        res += ', '.join(f"{name} {sum(child_seconds(children, task, name) for task in tasks.values()):.2f} s"
+                         for name in ['dependency wait', 'queue wait', 'run'])
+        res += f", {sum(task['args']['retries'] for task in tasks.values())} retries\n"
+    return res
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Reports each job's critical path and barrier waits from a trace file")
+    parser.add_argument('trace_path')
+    parser.add_argument('--trace-id', help='only this job of the trace')
+    args = parser.parse_args(argv)
+
+    traces = {}
+    for event in read_trace(args.trace_path):
+        if event.get('ph') == 'X':
+            traces.setdefault(event['args']['trace_id'], []).append(event)
+    if args.trace_id:
+        if args.trace_id not in traces:
+            sys.exit(f"No trace {args.trace_id} in {args.trace_path}")
+        traces = {args.trace_id: traces[args.trace_id]}
+    for trace_id, spans in traces.items():
+        print(report_trace(trace_id, spans))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,164 @@
+import os
+import sys
+import json
+import logging
+import shutil
+import argparse
+import subprocess
+
+from common.job_worker import JobWorker, DEFAULT_VISIBILITY_TIMEOUT
+from common.status_writer import JobStatusWriter
+import common.workflow_common as workflow_common
+from common import tracing
+
+LOGGER = logging.getLogger('ensemblefit')
+LOGGER.setLevel(logging.INFO)
+REALPATH = os.path.dirname(os.path.realpath(__file__))
+SIGNATURE_REFERENCE_PATH = os.path.join(os.path.dirname(REALPATH), 'signature_reference')
+DEFAULT_JOB_COMMAND = f"python {os.path.join(REALPATH, 'assignment.py')} {{config_path}}"
+ASSIGNMENT_CONFIG_FILENAME = 'assignment_config.json'
+# Job workdir subdirectories, the output and logs are archived under these names
+INPUT_DIRNAME = 'input'
+OUTPUT_DIRNAME = 'output'
+LOGS_DIRNAME = 'logs'
+# Assignment options a job manifest may set, passed on as they are
+ASSIGNMENT_OPTIONS = [
+    'ensemble_mean_mode', 'intermediate_format', 'shard_size', 'result_cache', 'result_cache_max_entries',
+    'executor', 'warm_workers',
+]
+
+
+def get_signature_reference_path(signature_reference):
+    """Resolves a manifest's signature reference, a file of the repository's signature_reference/ directory"""
+    if os.path.isabs(signature_reference):
+        return signature_reference
+    if not signature_reference.endswith('.txt'):
+        signature_reference += '.txt'
+    return os.path.join(SIGNATURE_REFERENCE_PATH, signature_reference)
+
+
+def get_assignment_config(job_config, input_files, output_path):
+    """Translates a job manifest into the config of assignment.py for its downloaded inputs
+
+    A VCF job's matrix was generated by the matrixgen workflow, so every job is assigned from a matrix.
+    """
+    if len(input_files) != 1:
+        raise ValueError(f"A job needs exactly one input matrix, got {len(input_files)}: {', '.join(input_files)}.")
+    signature_reference = job_config['signature_reference']
+    if isinstance(signature_reference, list):
+        signature_reference_path = [get_signature_reference_path(reference) for reference in signature_reference]
+    else:
+        signature_reference_path = get_signature_reference_path(signature_reference)
+    tools = job_config['tools']
+    assignment_config = {
+        'file_type': 'txt',
+        'genome_reference': job_config.get('reference_build', job_config.get('genome_reference')),
+        'samples': input_files[0],
+        'signature_reference': signature_reference_path,
+        'output': output_path,
+        'strategy': job_config.get('analysis', job_config.get('strategy')),
+        'tools': tools if isinstance(tools, dict) else {tool: True for tool in tools},
+    }
+    assignment_config.update({option: job_config[option] for option in ASSIGNMENT_OPTIONS if option in job_config})
+    return assignment_config
+
+
+def upload_results(s3_client, output_bucket, job_config, job_workdir_path):
+    """Uploads the job's result files, then its output archive"""
+    results_path = os.path.join(job_workdir_path, OUTPUT_DIRNAME, 'results')
+    output_files = [filename for filename in workflow_common.MUTSIG_OUTPUT_FILES if os.path.isfile(os.path.join(results_path, filename))]
+    missing = sorted(set(workflow_common.MUTSIG_OUTPUT_FILES) - set(output_files))
+    if missing:
+        LOGGER.warning("Job %s did not write: %s", job_config['job_id'], ', '.join(missing))
+    workflow_common.upload_output_files(s3_client, output_bucket, job_config, results_path, output_files)
+    workflow_common.upload_output_archive(s3_client, output_bucket, job_config, job_workdir_path, OUTPUT_DIRNAME,
+                                          workflow_common.MUTSIG_WORKFLOW_NAME)
+
+
+def make_job_handler(command, base_workdir_path, status_writer, s3_client, output_bucket, trace_path=None):
+    """Runs a job of each manifest in its own workdir and records the job's status
+
+    The job's inputs are downloaded from S3 and its manifest translated into an assignment config, command
+    runs on that config and the results, the output archive and the logs archive are uploaded to
+    output_bucket. The workdir of a job that failed is kept, a retry of its message reuses the Parsl
+    checkpoints of the tasks that completed.
+
+    With trace_path, each job is a trace of its own: status updates, S3 transfers, the command and the spans
+    the command writes as a child process.
+    """
+    def run_job(job_config, job_workdir_path, tracer):
+        input_path = os.path.join(job_workdir_path, INPUT_DIRNAME)
+        os.makedirs(input_path, exist_ok=True)
+        workflow_common.download_input_files(s3_client, job_config, input_path, workflow_common.MUTSIG_WORKFLOW_NAME)
+        assignment_config = get_assignment_config(
+            job_config, [os.path.join(input_path, filename) for filename in sorted(os.listdir(input_path))],
+            os.path.join(job_workdir_path, OUTPUT_DIRNAME))
+        config_path = os.path.join(job_workdir_path, ASSIGNMENT_CONFIG_FILENAME)
+        with open(config_path, 'w') as f:
+            json.dump(assignment_config, f, indent=4)
+
+        with tracer.span('command'):
+            result = subprocess.run(command.format(config_path=config_path), shell=True, cwd=job_workdir_path,
+                                    env={**os.environ, **tracer.child_env()})
+        if result.returncode != 0:
+            raise RuntimeError(f"Job command exited with {result.returncode}")
+        upload_results(s3_client, output_bucket, job_config, job_workdir_path)
+
+    def handle(job_config, message_id):
+        job_workdir_path = os.path.join(base_workdir_path, job_config['job_id'])
+        os.makedirs(job_workdir_path, exist_ok=True)
+        with open(os.path.join(job_workdir_path, workflow_common.JOB_CONFIG_FILENAME), 'w') as f:
+            json.dump(job_config, f)
+
+        tracer = tracing.Tracer(trace_path)
+        with tracer.span('job', job_id=job_config['job_id'], message_id=message_id):
+            with tracer.span('status update', status='running'):
+                status_writer.update(job_config, message_id, 'running', workflow_common.MUTSIG_WORKFLOW_NAME)
+            try:
+                try:
+                    run_job(job_config, job_workdir_path, tracer)
+                finally:
+                    # Logs of failed jobs too, unless the job failed before the command wrote any
+                    if os.path.isdir(os.path.join(job_workdir_path, LOGS_DIRNAME)):
+                        workflow_common.upload_logs_archive(s3_client, output_bucket, job_config, job_workdir_path,
+                                                            LOGS_DIRNAME, workflow_common.MUTSIG_WORKFLOW_NAME)
+            except Exception as e:
+                with tracer.span('status update', status='failed'):
+                    status_writer.update(job_config, message_id, 'failed', workflow_common.MUTSIG_WORKFLOW_NAME, str(e))
+                raise
+            with tracer.span('status update', status='complete'):
+                status_writer.update(job_config, message_id, 'complete', workflow_common.MUTSIG_WORKFLOW_NAME)
+        shutil.rmtree(job_workdir_path)
+    return handle
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Runs job manifests received from an SQS queue')
+    parser.add_argument('queue_name')
+    parser.add_argument('--concurrency', type=int, default=4, help='jobs run at once')
+    parser.add_argument('--visibility-timeout', type=int, default=DEFAULT_VISIBILITY_TIMEOUT,
+                        help='seconds, extended while a job runs')
+    parser.add_argument('--command', default=DEFAULT_JOB_COMMAND,
+                        help="run for each job, {config_path} is replaced by the job's assignment config")
+    parser.add_argument('--workdir', default=workflow_common.DEFAULT_BASE_WORKDIR_PATH)
+    parser.add_argument('--output-bucket', help='uploads results here, $ENSEMBLEFIT_OUTPUTS_S3_BUCKET by default')
+    parser.add_argument('--trace', default=os.environ.get(tracing.TRACE_PATH_ENV),
+                        help='appends the spans of every job to this Chrome trace file')
+    args = parser.parse_args(argv)
+
+    sqs_client = workflow_common.SQS_CLIENT
+    queue_url = sqs_client.get_queue_url(QueueName=args.queue_name)['QueueUrl']
+    status_writer = JobStatusWriter(workflow_common.DYNAMODB_CLIENT, workflow_common.JOB_STATUS_DDB_TABLE_NAME)
+    handler = make_job_handler(args.command, args.workdir, status_writer, workflow_common.S3_CLIENT,
+                               args.output_bucket or workflow_common.OUTPUT_S3_BUCKET, args.trace)
+    worker = JobWorker(sqs_client, queue_url, handler, args.concurrency, args.visibility_timeout)
+    worker.install_signal_handlers()
+    LOGGER.info("Consuming %s with %d concurrent job(s)", queue_url, args.concurrency)
+    try:
+        worker.run()
+    finally:
+        status_writer.close()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
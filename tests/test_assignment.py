@@ -0,0 +1,59 @@
+"""Tests how assignment.py submits each tool's runs
+
+Usage: python -m pytest tests
+"""
+import os
+import sys
+
+import pytest
+
+REALPATH = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(REALPATH), 'src'))
+
+pytest.importorskip('parsl')
+
+import assignment
+
+
+class Run:
+    def __init__(self, strategy, inputs):
+        self.strategy = strategy
+        self.inputs = inputs
+
+
+def submit(tool, strategies, shard_paths=('shard_0', 'shard_1')):
+    submitted = []
+
+    def tool_app(sample_file, reference_file, shard_path, strategy, inputs=[], outputs=[]):
+        assert outputs[0].filepath == os.path.join(shard_path, tool, f'{tool}_{strategy}.txt')
+        submitted.append(Run(strategy, inputs))
+        return submitted[-1]
+
+    return assignment.submit_tool_runs(tool, tool_app, list(shard_paths), 'reference.txt', strategies), submitted
+
+
+@pytest.mark.parametrize('strategies', [['remove', 'refit'], ['regular', 'remove', 'refit'], ['refit']])
+def test_tools_run_each_strategy_on_its_own(strategies):
+    runs, submitted = submit('Sigminer', strategies)
+    assert sorted(run.strategy for run in submitted) == sorted(strategies * 2)
+    assert all(run.inputs == [] for run in submitted)
+    assert {strategy: [run.strategy for run in runs[strategy]] for strategy in strategies} == {
+        strategy: [strategy] * 2 for strategy in strategies}
+
+
+def test_fastnnls_derives_strategies_from_regular():
+    runs, submitted = submit('FastNNLS', ['remove', 'refit'])
+    # One regular run per shard, which the others wait for
+    regular = [run for run in submitted if run.strategy == 'regular']
+    assert len(regular) == 2 and len(submitted) == 6
+    for strategy in ['remove', 'refit']:
+        assert [run.inputs for run in runs[strategy]] == [[run] for run in regular]
+
+    runs, submitted = submit('FastNNLS', ['regular', 'refit'])
+    assert len(submitted) == 4
+    assert [run.inputs for run in runs['refit']] == [[run] for run in runs['regular']]
+
+
+def test_fastnnls_single_strategy_runs_alone():
+    runs, submitted = submit('FastNNLS', ['refit'])
+    assert [(run.strategy, run.inputs) for run in submitted] == [('refit', []), ('refit', [])]
@@ -0,0 +1,106 @@
+"""Checks the native SBS96 counter against a catalogue it must reproduce, on a tiny synthetic genome
+
+fixtures/sbs96 holds a genome in SigProfilerMatrixGenerator's layout (chromosomes/tsb and chromosomes/transcripts,
+Y has no transcripts so it is not counted) and VCFs with doublets, repeated lines, 'chr' prefixes, N contexts,
+mutations at and past the chromosome ends, a sample split over two files and a malformed line.
+mutsig.SBS96.all is SigProfilerMatrixGenerator 1.2.14's catalogue of these VCFs, as it wrote it. It counts the
+mutations at position 1 with the base at the chromosome's end as their 5' context, these are skipped here.
+
+Usage: python -m pytest tests
+"""
+import os
+import sys
+
+import pytest
+
+REALPATH = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(REALPATH), 'src', 'apps'))
+
+np = pytest.importorskip('numpy')
+
+import count_sbs96
+
+FIXTURE_PATH = os.path.join(REALPATH, 'fixtures', 'sbs96')
+GENOME_PATH = os.path.join(FIXTURE_PATH, 'chromosomes', 'tsb', 'tiny')
+VCF_PATH = os.path.join(FIXTURE_PATH, 'vcf')
+EXPECTED_PATH = os.path.join(FIXTURE_PATH, 'mutsig.SBS96.all')
+# SigProfilerMatrixGenerator's counts of S2's mutations at position 1 (chr1:1 T>C, chr2:1 G>A, chrX:1 T>A),
+# with the 5' base wrapped around from the chromosome's end
+POSITION_1_COUNTS = [('T[T>C]G', 'S2'), ('C[C>T]T', 'S2'), ('T[T>A]C', 'S2')]
+
+
+def read_text(path):
+    with open(path) as f:
+        return f.read()
+
+
+def expected_catalogue():
+    """SigProfilerMatrixGenerator's catalogue without its counts of the mutations at position 1"""
+    lines = [line.split('\t') for line in read_text(EXPECTED_PATH).splitlines()]
+    samples = lines[0][1:]
+    for feature, sample in POSITION_1_COUNTS:
+        [row] = [row for row in lines if row[0] == feature]
+        column = samples.index(sample) + 1
+        assert int(row[column]) > 0
+        row[column] = str(int(row[column]) - 1)
+    return ''.join('\t'.join(row) + '\n' for row in lines)
+
+
+def test_skips_mutations_at_position_1(tmp_path):
+    output_path = tmp_path / 'mutsig.SBS96.all'
+    count_sbs96.main(VCF_PATH, GENOME_PATH, str(output_path), workers=1)
+    output = read_text(output_path)
+    # The only difference with SigProfilerMatrixGenerator
+    assert output != read_text(EXPECTED_PATH)
+    assert output == expected_catalogue()
+
+
+@pytest.mark.parametrize('cached', [False, True])
+def test_count_sbs96_matches_expected_catalogue(tmp_path, cached):
+    cache_path = str(tmp_path / 'catalogues.sqlite') if cached else None
+    output_path = tmp_path / 'mutsig.SBS96.all'
+    count_sbs96.main(VCF_PATH, GENOME_PATH, str(output_path), workers=2, cache_path=cache_path)
+    assert read_text(output_path) == expected_catalogue()
+    if cached:
+        # Counts read back from the cache give the same catalogue
+        output_path.unlink()
+        count_sbs96.main(VCF_PATH, GENOME_PATH, str(output_path), workers=2, cache_path=cache_path)
+        assert read_text(output_path) == expected_catalogue()
+
+
+def test_cache_hit_returns_stored_catalogue(tmp_path):
+    cache = count_sbs96.CatalogueCache(str(tmp_path / 'catalogues.sqlite'))
+    counts = np.arange(len(count_sbs96.FEATURES))
+    key = count_sbs96.CatalogueCache.make_key('digest', 'GRCh37')
+    cache.put_many({key: (counts, 3)})
+    [(cached_counts, skipped)] = cache.get_many([key, key]).values()
+    assert np.array_equal(cached_counts, counts) and skipped == 3
+    # The genome is part of the key
+    assert cache.get_many([count_sbs96.CatalogueCache.make_key('digest', 'GRCh38')]) == {}
+    cache.close()
+
+
+def test_cache_evicts_least_recently_used(tmp_path, monkeypatch):
+    with monkeypatch.context() as patch:
+        # Each use of the cache one second after the last
+        clock = iter(range(10))
+        patch.setattr(count_sbs96.time, 'time', lambda: next(clock))
+        cache = count_sbs96.CatalogueCache(str(tmp_path / 'catalogues.sqlite'), max_entries=2)
+        counts = np.zeros(len(count_sbs96.FEATURES))
+        cache.put_many({'a': (counts, 0)})
+        cache.put_many({'b': (counts, 0)})
+        # Reading a refreshes it, so b is the least recently used when c comes in
+        cache.get_many(['a'])
+        cache.put_many({'c': (counts, 0)})
+        assert sorted(cache.get_many(['a', 'b', 'c'])) == ['a', 'c']
+        cache.close()
+
+    # A cache smaller than the VCF directory still gives the full catalogue
+    cache_path = str(tmp_path / 'small.sqlite')
+    output_path = tmp_path / 'mutsig.SBS96.all'
+    for _ in range(2):
+        count_sbs96.main(VCF_PATH, GENOME_PATH, str(output_path), workers=2, cache_path=cache_path, cache_max_entries=2)
+        assert read_text(output_path) == expected_catalogue()
+    cache = count_sbs96.CatalogueCache(cache_path)
+    assert cache.connection.execute('SELECT COUNT(*) FROM catalogues').fetchone()[0] == 2
+    cache.close()
@@ -0,0 +1,152 @@
+"""Tests the ensembles of EnsembleFit.py against the example's expected outputs, the exact bootstrap distribution
+of Ensemble-Mean and its post-processing
+
+The tools' results in example/expected_output are their activities as frequencies, the ensembles are
+computed from them and normalized per sample as post-processing writes them.
+
+Usage: python -m pytest tests
+"""
+import os
+import sys
+import math
+import shutil
+import itertools
+
+import pytest
+
+REALPATH = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(REALPATH), 'src', 'apps'))
+
+np = pytest.importorskip('numpy')
+pd = pytest.importorskip('pandas')
+
+import EnsembleFit
+import ensemble_postprocess
+from workflow_utils import as_frequency_rowwise, read_table
+
+EXPECTED_PATH = os.path.join(os.path.dirname(REALPATH), 'example', 'expected_output')
+SAMPLE_PATH = os.path.join(os.path.dirname(REALPATH), 'example', 'input', 'SP-synthetic_BRCA_198.txt')
+REFERENCE_PATH = os.path.join(os.path.dirname(REALPATH), 'signature_reference', 'COSMICv3_SP-synthetic_GRCh37.txt')
+TOOLS = ['SigProfilerAssignment', 'Sigminer', 'SignatureToolsLib', 'MutationalPatterns', 'MutSignatures']
+ENSEMBLES = ['Ensemble-Majority', 'Ensemble-Unanimous', 'Ensemble-Mean']
+# Ensemble-Mean is a mean of 500 bootstrap resamples of the tools, the expected outputs come from other draws.
+# Their largest difference over the examples is 0.0107, the Monte Carlo error of either.
+MEAN_TOLERANCE = 0.015
+
+
+def read_example(name):
+    """Returns the tools' activities, the expected ensembles, the signatures and the samples of an example"""
+    results_path = os.path.join(EXPECTED_PATH, name, 'results')
+    fit = {
+        tool: as_frequency_rowwise(pd.read_csv(os.path.join(results_path, tool, f'{tool}_refit.txt'), sep='\t'))
+        for tool in TOOLS
+    }
+    expected = {
+        ensemble: pd.read_csv(os.path.join(results_path, 'EnsembleFit', f'{ensemble}_refit.txt'), sep='\t')
+        for ensemble in ENSEMBLES
+    }
+    all_sigs = expected['Ensemble-Mean'].columns[1:].tolist()
+    all_samples = expected['Ensemble-Mean']['Samples'].tolist()
+    return fit, expected, all_sigs, all_samples
+
+
+@pytest.mark.parametrize('name', sorted(os.listdir(EXPECTED_PATH)))
+def test_run_ensemble_matches_example(name):
+    fit, expected, all_sigs, all_samples = read_example(name)
+    ensembles = EnsembleFit.run_ensemble(fit, all_sigs, all_samples)
+
+    for ensemble in ['Ensemble-Majority', 'Ensemble-Unanimous']:
+        pd.testing.assert_frame_equal(ensembles[ensemble], expected[ensemble], check_dtype=False)
+    mean = as_frequency_rowwise(ensembles['Ensemble-Mean'])
+    assert mean['Samples'].tolist() == all_samples
+    assert np.abs(mean[all_sigs].to_numpy() - expected['Ensemble-Mean'][all_sigs].to_numpy()).max() < MEAN_TOLERANCE
+
+
+def test_bootstrap_is_seeded():
+    fit, _, all_sigs, all_samples = read_example('SP-synthetic_BRCA')
+    first = EnsembleFit.ensemble_quantitative(fit, all_sigs, all_samples, seed=37)
+    pd.testing.assert_frame_equal(first, EnsembleFit.ensemble_quantitative(fit, all_sigs, all_samples, seed=37))
+    assert not first.equals(EnsembleFit.ensemble_quantitative(fit, all_sigs, all_samples, seed=38))
+
+
+def small_fit():
+    """Three tools' activities of two samples over three signatures, the second sample assigned nothing"""
+    all_sigs = ['SBS1', 'SBS2', 'SBS3']
+    all_samples = ['S1', 'S2']
+    activities = {
+        'A': [[0.5, 0.5, 0.0], [0.0, 0.0, 0.0]],
+        'B': [[0.2, 0.3, 0.5], [0.0, 0.0, 0.0]],
+        'C': [[0.9, 0.0, 0.1], [0.0, 0.0, 0.0]],
+    }
+    fit = {}
+    for tool, rows in activities.items():
+        fit[tool] = pd.DataFrame(rows, columns=all_sigs)
+        fit[tool].insert(0, 'Samples', all_samples)
+    return fit, all_sigs, all_samples
+
+
+@pytest.mark.parametrize('n_tools', range(1, 7))
+def test_bootstrap_multisets(n_tools):
+    counts, probs = EnsembleFit.bootstrap_multisets(n_tools)
+    # Every distinct resample of n_tools draws once, with its multinomial probability
+    assert len(counts) == math.comb(2 * n_tools - 1, n_tools)
+    assert (counts.sum(axis=1) == n_tools).all()
+    assert len({tuple(row) for row in counts}) == len(counts)
+    assert probs.sum() == pytest.approx(1)
+
+
+def test_exact_mean_and_bounds():
+    fit, all_sigs, all_samples = small_fit()
+    exact = EnsembleFit.ensemble_exact(fit, all_sigs, all_samples)
+    activities = EnsembleFit.stack_activities(fit, all_sigs, all_samples)
+
+    # The expected value over every resample is the tools' mean
+    assert np.allclose(exact[all_sigs].to_numpy(), activities.mean(axis=-1))
+    assert exact.columns.tolist() == ['Samples'] + all_sigs + [
+        f'{sig}_CI_{bound}' for sig in all_sigs for bound in ('lower', 'upper')]
+
+    # The bounds are the 2.5th and 97.5th percentiles over all 27 equally likely ordered resamples
+    resample_means = np.array([activities[..., list(draws)].mean(axis=-1)
+                               for draws in itertools.product(range(3), repeat=3)])
+    bootstrap = EnsembleFit.ensemble_quantitative(fit, all_sigs, all_samples)
+    for sig_index, sig in enumerate(all_sigs):
+        lower = exact[f'{sig}_CI_lower'].to_numpy()
+        upper = exact[f'{sig}_CI_upper'].to_numpy()
+        means = np.sort(resample_means[..., sig_index], axis=0)
+        assert np.allclose(lower, means[math.ceil(0.025 * 27) - 1])
+        assert np.allclose(upper, means[math.ceil(0.975 * 27) - 1])
+        assert (lower <= bootstrap[sig].to_numpy()).all() and (bootstrap[sig].to_numpy() <= upper).all()
+    # A sample no tool assigned anything has no spread
+    assert (exact.iloc[1, 1:] == 0).all()
+
+
+def check_normalized(df, all_sigs, raw):
+    """Checks that the signature columns sum to 1 and the CI columns are scaled by the same factor, not summed"""
+    assert np.allclose(df[all_sigs].sum(axis=1), 1)
+    factor = raw[all_sigs].sum(axis=1).to_numpy()
+    ci_columns = [column for column in raw.columns if '_CI_' in column]
+    assert ci_columns
+    assert np.allclose(df[ci_columns].to_numpy() * factor[:, None], raw[ci_columns].to_numpy())
+
+
+def write_tool_results(output_path, strategy='refit'):
+    """Writes the example's tool results as the tools' outputs, returns the tools"""
+    results_path = os.path.join(EXPECTED_PATH, 'SP-synthetic_BRCA', 'results')
+    for tool in TOOLS[:3]:
+        os.makedirs(os.path.join(output_path, tool))
+        shutil.copy(os.path.join(results_path, tool, f'{tool}_refit.txt'), os.path.join(output_path, tool, f'{tool}_{strategy}.txt'))
+    return TOOLS[:3]
+
+
+def test_ensemble_postprocess_normalizes_only_signatures(tmp_path):
+    output_path = str(tmp_path / 'work')
+    tools = write_tool_results(output_path)
+    result_path = str(tmp_path / 'results')
+    ensemble_postprocess.main(SAMPLE_PATH, REFERENCE_PATH, output_path, result_path, 'refit', tools, mean_mode='exact')
+
+    fit = {tool: as_frequency_rowwise(read_table(os.path.join(output_path, tool, f'{tool}_refit.txt'))) for tool in tools}
+    all_sigs = [column for column in fit[tools[0]].columns[1:]]
+    raw = EnsembleFit.ensemble_exact(fit, all_sigs, fit[tools[0]]['Samples'].tolist())
+    check_normalized(read_table(os.path.join(result_path, 'EnsembleFit', 'Ensemble-Mean_refit.txt')), all_sigs, raw)
+    # Each tool's results are written too
+    assert all(os.path.exists(os.path.join(result_path, tool, f'{tool}_refit.txt')) for tool in tools)
@@ -0,0 +1,95 @@
+"""Tests the built-in FastNNLS tool against SciPy's NNLS on random samples and signatures
+
+Usage: python -m pytest tests
+"""
+import os
+import sys
+
+import pytest
+
+REALPATH = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(REALPATH), 'src', 'apps'))
+
+np = pytest.importorskip('numpy')
+pd = pytest.importorskip('pandas')
+scipy_optimize = pytest.importorskip('scipy.optimize')
+
+import FastNNLS
+import workflow_utils as utils
+
+SIGNATURES = [f'SBS{i}' for i in range(1, 9)]
+
+
+@pytest.fixture
+def reference_path(tmp_path, monkeypatch):
+    monkeypatch.setattr(utils, 'REFERENCE_REGISTRY_PATH', str(tmp_path / 'registry'))
+    rng = np.random.default_rng(1)
+    reference = pd.DataFrame(rng.gamma(0.5, size=(96, len(SIGNATURES))), index=utils.SBS96_FEATURES, columns=SIGNATURES)
+    reference.index.name = 'Type'
+    path = str(tmp_path / 'reference.txt')
+    reference.to_csv(path, sep='\t')
+    return path
+
+
+def random_counts(reference, n_samples, seed=2):
+    """Samples made of a few signatures each, some of them small, with Poisson noise"""
+    rng = np.random.default_rng(seed)
+    exposures = rng.gamma(0.3, 400, size=(len(reference.signatures), n_samples))
+    return rng.poisson(np.asarray(reference.matrix) @ exposures).astype(float)
+
+
+def nnls_exposures(reference, counts, masks=None):
+    matrix = np.asarray(reference.matrix)
+    exposures = np.zeros((counts.shape[1], matrix.shape[1]))
+    for i in range(counts.shape[1]):
+        mask = np.ones(matrix.shape[1], dtype=bool) if masks is None else masks[i]
+        if mask.any():
+            exposures[i, mask] = scipy_optimize.nnls(matrix[:, mask], counts[:, i])[0]
+    return exposures
+
+
+def test_fit_chunk_matches_nnls(reference_path):
+    reference = utils.load_reference(reference_path)
+    counts = random_counts(reference, 40)
+    upper = np.asarray(reference.upper)
+    projected = FastNNLS.project(upper, reference.matrix, counts)
+    expected = nnls_exposures(reference, counts)
+    assert np.allclose(FastNNLS.fit_chunk(upper, projected), expected, rtol=1e-6, atol=1e-6)
+
+    # Restricted to each sample's own signatures, including none
+    masks = np.random.default_rng(3).random((40, len(SIGNATURES))) < 0.5
+    masks[0] = False
+    assert np.allclose(FastNNLS.fit_chunk(upper, projected, masks), nnls_exposures(reference, counts, masks),
+                       rtol=1e-6, atol=1e-6)
+
+
+def test_chunks_fitted_in_worker_processes(reference_path, monkeypatch):
+    reference = utils.load_reference(reference_path)
+    counts = random_counts(reference, 23)
+    monkeypatch.setattr(FastNNLS, 'CHUNK_SIZE', 5)
+    masks = np.random.default_rng(4).random((23, len(SIGNATURES))) < 0.7
+    # Five chunks over two spawned workers, stacked back in sample order
+    assert np.allclose(FastNNLS.fit(reference, counts, workers=2), nnls_exposures(reference, counts), rtol=1e-6, atol=1e-6)
+    assert np.allclose(FastNNLS.fit(reference, counts, masks, workers=2), nnls_exposures(reference, counts, masks),
+                       rtol=1e-6, atol=1e-6)
+
+
+def test_remove_moves_small_signatures_to_unassigned(reference_path, tmp_path):
+    reference = utils.load_reference(reference_path)
+    counts = random_counts(reference, 30).astype(int)
+    sample_path = str(tmp_path / 'samples.txt')
+    samples = [f'S{i}' for i in range(30)]
+    utils.write_catalogue(reference.features, samples, counts, sample_path)
+    output_path = str(tmp_path / 'FastNNLS')
+    FastNNLS.main(sample_path, reference_path, output_path, 'remove', workers=1)
+
+    regular = pd.read_csv(os.path.join(output_path, 'FastNNLS_regular.txt'), sep='\t', index_col=0)
+    removed = pd.read_csv(os.path.join(output_path, 'FastNNLS_remove.txt'), sep='\t', index_col=0)
+    assert removed.index.tolist() == samples
+    totals = counts.sum(axis=0)
+    small = regular[SIGNATURES].to_numpy() < totals[:, None] * FastNNLS.REMOVE_THRESHOLD
+    # Some but not all of the fitted signatures are small
+    assert (small & (regular[SIGNATURES].to_numpy() > 0)).any() and not small.all()
+    assert (removed[SIGNATURES].to_numpy()[small] == 0).all()
+    assert np.allclose(removed[SIGNATURES].to_numpy()[~small], regular[SIGNATURES].to_numpy()[~small])
+    assert np.allclose(removed['unassigned'], totals - removed[SIGNATURES].sum(axis=1))
@@ -0,0 +1,151 @@
+"""Tests the SQS job worker against a local SQS stand-in (moto)
+
+Usage: python -m pytest tests
+"""
+import os
+import sys
+import json
+import time
+import signal
+import threading
+
+import pytest
+
+REALPATH = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(REALPATH), 'src'))
+
+moto = pytest.importorskip('moto')
+boto3 = pytest.importorskip('boto3')
+
+from botocore.exceptions import ClientError
+from common.job_worker import JobWorker
+
+REGION = 'us-east-1'
+VISIBILITY_TIMEOUT = 2
+
+
+@pytest.fixture
+def sqs(monkeypatch):
+    for name in ['AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY', 'AWS_SESSION_TOKEN']:
+        monkeypatch.setenv(name, 'testing')
+    monkeypatch.setenv('AWS_DEFAULT_REGION', REGION)
+    with moto.mock_aws():
+        yield boto3.client('sqs', region_name=REGION)
+
+
+def send_jobs(sqs, queue_url, job_ids):
+    for job_id in job_ids:
+        sqs.send_message(QueueUrl=queue_url, MessageBody=json.dumps({'job_id': job_id}))
+
+
+def count_visible(sqs, queue_url):
+    attributes = sqs.get_queue_attributes(QueueUrl=queue_url, AttributeNames=['ApproximateNumberOfMessages'])
+    return int(attributes['Attributes']['ApproximateNumberOfMessages'])
+
+
+def record_calls(sqs):
+    calls = []
+    sqs.meta.events.register('before-parameter-build.sqs', lambda model, params, **kwargs: calls.append((model.name, params)))
+    return calls
+
+
+def test_receives_extends_and_deletes_in_batches(sqs):
+    queue_url = sqs.create_queue(QueueName='jobs')['QueueUrl']
+    job_ids = [f'job-{i}' for i in range(12)]
+    send_jobs(sqs, queue_url, job_ids)
+    calls = record_calls(sqs)
+    ran = []
+
+    def handler(job_config, message_id):
+        # Outlives the visibility timeout, the heartbeat keeps the message hidden
+        time.sleep(2 * VISIBILITY_TIMEOUT)
+        ran.append(job_config['job_id'])
+
+    worker = JobWorker(sqs, queue_url, handler, max_concurrency=12, visibility_timeout=VISIBILITY_TIMEOUT, wait_time_seconds=1)
+    metrics = worker.run(max_jobs=12)
+
+    # Every job ran once: none of the messages became visible again while its job ran
+    assert sorted(ran) == sorted(job_ids)
+    assert metrics['received'] == 12 and metrics['succeeded'] == 12
+    receives = [params for name, params in calls if name == 'ReceiveMessage']
+    assert receives[0]['MaxNumberOfMessages'] == 10
+    extends = [params for name, params in calls if name == 'ChangeMessageVisibilityBatch']
+    assert extends and all(len(params['Entries']) <= 10 for params in extends)
+    deletes = [params for name, params in calls if name == 'DeleteMessageBatch']
+    assert sum(len(params['Entries']) for params in deletes) == 12
+    assert all(len(params['Entries']) <= 10 for params in deletes)
+    assert 'DeleteMessage' not in [name for name, _ in calls]
+    assert count_visible(sqs, queue_url) == 0
+
+
+def test_failed_jobs_are_not_deleted(sqs):
+    queue_url = sqs.create_queue(QueueName='jobs')['QueueUrl']
+    send_jobs(sqs, queue_url, ['ok', 'broken'])
+
+    def handler(job_config, message_id):
+        if job_config['job_id'] == 'broken':
+            raise RuntimeError('broken job')
+
+    worker = JobWorker(sqs, queue_url, handler, max_concurrency=2, visibility_timeout=VISIBILITY_TIMEOUT, wait_time_seconds=1)
+    metrics = worker.run(max_jobs=2)
+
+    assert metrics['succeeded'] == 1 and metrics['failed'] == 1
+    time.sleep(VISIBILITY_TIMEOUT + 1)
+    messages = sqs.receive_message(QueueUrl=queue_url, MaxNumberOfMessages=10).get('Messages', [])
+    assert [json.loads(message['Body'])['job_id'] for message in messages] == ['broken']
+
+
+def test_heartbeat_survives_errors(sqs, monkeypatch):
+    queue_url = sqs.create_queue(QueueName='jobs')['QueueUrl']
+    send_jobs(sqs, queue_url, ['slow'])
+    extend = sqs.change_message_visibility_batch
+    attempts = []
+
+    def flaky_extend(**kwargs):
+        attempts.append(kwargs)
+        if len(attempts) == 1:
+            raise ClientError({'Error': {'Code': 'InternalError', 'Message': 'try again'}}, 'ChangeMessageVisibilityBatch')
+        return extend(**kwargs)
+
+    monkeypatch.setattr(sqs, 'change_message_visibility_batch', flaky_extend)
+    ran = []
+    worker = JobWorker(sqs, queue_url, lambda job_config, message_id: (time.sleep(3 * VISIBILITY_TIMEOUT), ran.append(1)),
+                       max_concurrency=1, visibility_timeout=VISIBILITY_TIMEOUT, wait_time_seconds=1)
+    metrics = worker.run(max_jobs=1)
+
+    # The beats after the failed one still ran and kept the message hidden until the job was done
+    assert len(attempts) >= 3
+    assert metrics['succeeded'] == 1 and ran == [1]
+    assert count_visible(sqs, queue_url) == 0
+
+
+def test_sigterm_drains(sqs):
+    queue_url = sqs.create_queue(QueueName='jobs')['QueueUrl']
+    send_jobs(sqs, queue_url, ['first', 'second'])
+    started = threading.Event()
+    ran = []
+
+    def handler(job_config, message_id):
+        started.set()
+        time.sleep(VISIBILITY_TIMEOUT)
+        ran.append(job_config['job_id'])
+
+    worker = JobWorker(sqs, queue_url, handler, max_concurrency=1, visibility_timeout=VISIBILITY_TIMEOUT, wait_time_seconds=1)
+    handlers = {signum: signal.getsignal(signum) for signum in [signal.SIGTERM, signal.SIGINT]}
+    worker.install_signal_handlers()
+    try:
+        thread = threading.Thread(target=worker.run)
+        thread.start()
+        assert started.wait(10)
+        os.kill(os.getpid(), signal.SIGTERM)
+        # Python runs signal handlers in the main thread, between bytecodes
+        thread.join(timeout=30)
+    finally:
+        for signum, handler_ in handlers.items():
+            signal.signal(signum, handler_)
+
+    # The running job finished and its message was deleted, the other one was never received
+    assert not thread.is_alive()
+    assert worker.metrics['received'] == 1 and worker.metrics['succeeded'] == 1
+    assert len(ran) == 1
+    assert count_visible(sqs, queue_url) == 1
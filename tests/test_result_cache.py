@@ -0,0 +1,79 @@
+"""Tests the cross-job cache of per-sample tool results: its keys, counters and LRU eviction
+
+Usage: python -m pytest tests
+"""
+import os
+import sys
+
+import pytest
+
+REALPATH = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(REALPATH), 'src'))
+
+pd = pytest.importorskip('pandas')
+
+import common.result_cache as result_cache
+from common.result_cache import AssignmentCache, find_cache_misses
+
+KEY = ('reference', 'FastNNLS', 'refit', 'FastNNLS (built-in 1) 0123')
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Each use of the cache one second after the last"""
+    ticks = iter(range(1000))
+    monkeypatch.setattr(result_cache.time, 'time', lambda: next(ticks))
+
+
+def test_hits_and_misses(tmp_path):
+    cache = AssignmentCache(str(tmp_path / 'cache.sqlite'))
+    cache.store({'a': {'SBS1': 1.0, 'SBS5': 2}}, *KEY)
+    assert cache.lookup(['a', 'b', 'a'], *KEY) == {'a': {'SBS1': 1.0, 'SBS5': 2}}
+    # Repeated digests are looked up once
+    assert cache.stats() == {'hits': 1, 'misses': 1, 'entries': 1}
+    cache.close()
+
+    # Entries outlive the process that stored them
+    cache = AssignmentCache(str(tmp_path / 'cache.sqlite'))
+    assert cache.lookup(['a'], *KEY) == {'a': {'SBS1': 1.0, 'SBS5': 2}}
+    assert cache.stats() == {'hits': 1, 'misses': 0, 'entries': 1}
+    cache.close()
+
+
+@pytest.mark.parametrize('changed', range(len(KEY)))
+def test_key_invalidation(tmp_path, changed):
+    cache = AssignmentCache(str(tmp_path / 'cache.sqlite'))
+    cache.store({'a': {'SBS1': 1.0}}, *KEY)
+    # Another reference content, tool, strategy or tool version misses
+    key = list(KEY)
+    key[changed] += ' changed'
+    assert cache.lookup(['a'], *key) == {}
+    assert cache.lookup(['a'], *KEY) == {'a': {'SBS1': 1.0}}
+    cache.close()
+
+
+def test_least_recently_used_are_evicted(tmp_path, clock):
+    cache = AssignmentCache(str(tmp_path / 'cache.sqlite'), max_entries=3)
+    cache.store({'a': {'SBS1': 1}, 'b': {'SBS1': 2}}, *KEY)
+    cache.store({'c': {'SBS1': 3}}, *KEY)
+    # Looking a up refreshes it, b is now the least recently used
+    cache.lookup(['a'], *KEY)
+    cache.store({'d': {'SBS1': 4}, 'e': {'SBS1': 5}}, *KEY)
+    assert sorted(cache.lookup(['a', 'b', 'c', 'd', 'e'], *KEY)) == ['a', 'd', 'e']
+    assert cache.stats()['entries'] == 3
+    cache.close()
+
+
+def test_sample_digests_ignore_feature_order():
+    matrix = pd.DataFrame({'MutationType': ['A[C>A]A', 'A[C>A]C', 'A[C>A]G'], 'S1': [1, 2, 3], 'S2': [3, 2, 1], 'S3': [1, 2, 3]})
+    digests = result_cache.sample_digests(matrix)
+    assert digests[0] == digests[2] != digests[1]
+    assert result_cache.sample_digests(matrix.iloc[::-1]) == digests
+
+
+def test_find_cache_misses():
+    digests = ['a', 'b', 'a', 'c', 'b', 'd']
+    # The first sample of each distinct uncached digest, in column order
+    assert find_cache_misses(digests, {'c'}) == ([0, 1, 5], ['a', 'b', 'd'])
+    assert find_cache_misses(digests, set(digests)) == ([], [])
+    assert find_cache_misses(digests, set()) == ([0, 1, 3, 5], ['a', 'b', 'c', 'd'])
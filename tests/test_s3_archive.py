@@ -0,0 +1,85 @@
+"""Tests the zip archive streamed into an S3 multipart upload against a local S3 stand-in (moto)
+
+Usage: python -m pytest tests
+"""
+import io
+import os
+import sys
+import zipfile
+
+import pytest
+
+REALPATH = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(REALPATH), 'src'))
+
+moto = pytest.importorskip('moto')
+boto3 = pytest.importorskip('boto3')
+
+from common import s3_archive
+from common.s3_transfer import MB
+
+REGION = 'us-east-1'
+BUCKET = 'ensemblefit-outputs'
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    for name in ['AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY', 'AWS_SESSION_TOKEN']:
+        monkeypatch.setenv(name, 'testing')
+    monkeypatch.setenv('AWS_DEFAULT_REGION', REGION)
+    with moto.mock_aws():
+        client = boto3.client('s3', region_name=REGION)
+        client.create_bucket(Bucket=BUCKET)
+        yield client
+
+
+def record_parts(s3):
+    sizes = []
+    s3.meta.events.register('before-parameter-build.s3.UploadPart', lambda params, **kwargs: sizes.append(len(params['Body'])))
+    return sizes
+
+
+def test_streamed_archive_with_zip64_entry(s3, tmp_path):
+    output_path = tmp_path / 'job' / 'output'
+    (output_path / 'results' / 'empty').mkdir(parents=True)
+    (output_path / 'results' / 'activities.txt').write_text('Samples\tSBS1\nS1\t0.5\n' * 1000)
+    random_bytes = os.urandom(MB)
+    (output_path / 'results' / 'matrix.gz').write_bytes(random_bytes)
+    # Sparse, over the 2 GiB zip64 limit
+    large_size = s3_archive.ZIP64_LIMIT + MB
+    with open(output_path / 'large.bin', 'wb') as f:
+        f.truncate(large_size)
+    sizes = record_parts(s3)
+
+    # Raised to the 5 MB minimum, the deflated zeros of the large entry alone span two parts
+    size = s3_archive.stream_archive(s3, str(tmp_path / 'job'), 'output', BUCKET, 'job/output.zip', compresslevel=1,
+                                     max_workers=2, part_size_mb=1)
+
+    assert len(sizes) > 1 and sum(sizes) == size
+    assert all(part_size == s3_archive.MIN_PART_SIZE_MB * MB for part_size in sizes[:-1])
+    body = s3.get_object(Bucket=BUCKET, Key='job/output.zip')['Body'].read()
+    assert len(body) == size
+    with zipfile.ZipFile(io.BytesIO(body)) as archive:
+        assert archive.testzip() is None
+        assert archive.namelist() == ['output/', 'output/large.bin', 'output/results/', 'output/results/activities.txt',
+                                      'output/results/matrix.gz', 'output/results/empty/']
+        assert archive.getinfo('output/large.bin').file_size == large_size
+        assert archive.getinfo('output/results/matrix.gz').compress_type == zipfile.ZIP_STORED
+        assert archive.read('output/results/matrix.gz') == random_bytes
+        assert archive.read('output/results/activities.txt') == (output_path / 'results' / 'activities.txt').read_bytes()
+
+
+def test_failed_archive_aborts_upload(s3, tmp_path, monkeypatch):
+    (tmp_path / 'output').mkdir()
+    (tmp_path / 'output' / 'activities.txt').write_text('Samples\tSBS1\n')
+
+    def failing_read(path, compresslevel, info):
+        yield b'partial'
+        raise OSError('read failed')
+
+    monkeypatch.setattr(s3_archive, 'iter_compressed', failing_read)
+    with pytest.raises(OSError):
+        s3_archive.stream_archive(s3, str(tmp_path), 'output', BUCKET, 'job/output.zip')
+    # Neither the archive nor its parts are left behind
+    assert s3.list_multipart_uploads(Bucket=BUCKET).get('Uploads', []) == []
+    assert s3.list_objects_v2(Bucket=BUCKET)['KeyCount'] == 0
@@ -0,0 +1,86 @@
+"""Tests the parallel S3 file transfers against a local S3 stand-in (moto)
+
+Usage: python -m pytest tests
+"""
+import os
+import sys
+import logging
+
+import pytest
+
+REALPATH = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(REALPATH), 'src'))
+
+moto = pytest.importorskip('moto')
+boto3 = pytest.importorskip('boto3')
+
+from botocore.exceptions import ClientError
+from common import s3_transfer
+from common.s3_transfer import MB
+
+REGION = 'us-east-1'
+BUCKET = 'ensemblefit-inputs'
+# The smallest part size S3 accepts, so the large file is uploaded in a few parts
+CHUNKSIZE_MB = 5
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    for name in ['AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY', 'AWS_SESSION_TOKEN']:
+        monkeypatch.setenv(name, 'testing')
+    monkeypatch.setenv('AWS_DEFAULT_REGION', REGION)
+    with moto.mock_aws():
+        client = boto3.client('s3', region_name=REGION, config=s3_transfer.get_client_config(8, 2))
+        client.create_bucket(Bucket=BUCKET)
+        yield client
+
+
+@pytest.fixture
+def files(tmp_path):
+    """Many small files and one large enough to be sent in parts, by name"""
+    contents = {f'sample_{i}.vcf': f'##fileformat=VCFv4.2\n{i}\n'.encode() for i in range(40)}
+    contents['large.bin'] = os.urandom(3 * CHUNKSIZE_MB * MB + 1)
+    (tmp_path / 'upload').mkdir()
+    for name, content in contents.items():
+        (tmp_path / 'upload' / name).write_bytes(content)
+    return contents
+
+
+def test_upload_and_download(s3, tmp_path, files):
+    config = s3_transfer.get_transfer_config(CHUNKSIZE_MB, 2)
+    parts = []
+    s3.meta.events.register('before-parameter-build.s3.UploadPart', lambda params, **kwargs: parts.append(params['PartNumber']))
+    uploads = [(str(tmp_path / 'upload' / name), BUCKET, f'job/{name}') for name in files]
+    stats = s3_transfer.upload_files(s3, uploads, config, max_workers=8)
+    total = sum(len(content) for content in files.values())
+    assert stats['files'] == len(files) and stats['bytes'] == total
+    # Only the large file went in parts
+    assert sorted(parts) == [1, 2, 3, 4]
+
+    (tmp_path / 'download').mkdir()
+    downloads = [(BUCKET, f'job/{name}', str(tmp_path / 'download' / name)) for name in files]
+    stats = s3_transfer.download_files(s3, downloads, config, max_workers=8)
+    assert stats['files'] == len(files) and stats['bytes'] == total
+    for name, content in files.items():
+        assert (tmp_path / 'download' / name).read_bytes() == content
+
+
+def test_failed_transfer_is_reported(s3, tmp_path, files, caplog):
+    config = s3_transfer.get_transfer_config(CHUNKSIZE_MB, 2)
+    uploads = [(str(tmp_path / 'upload' / name), BUCKET, f'job/{name}') for name in files]
+    s3_transfer.upload_files(s3, uploads, config, max_workers=8)
+
+    (tmp_path / 'download').mkdir()
+    downloads = [(BUCKET, f'job/{name}', str(tmp_path / 'download' / name)) for name in files]
+    downloads.insert(3, (BUCKET, 'job/missing.vcf', str(tmp_path / 'download' / 'missing.vcf')))
+    with caplog.at_level(logging.ERROR, logger=s3_transfer.LOGGER.name):
+        with pytest.raises(ClientError):
+            s3_transfer.download_files(s3, downloads, config, max_workers=8)
+
+    # The other transfers ran to the end, the failed one is named in the log
+    for name, content in files.items():
+        assert (tmp_path / 'download' / name).read_bytes() == content
+    errors = [record.getMessage() for record in caplog.records if record.levelno == logging.ERROR]
+    assert len(errors) == 2
+    assert 'job/missing.vcf' in errors[0] and 'job/sample_' not in errors[0]
+    assert f'1 of {len(downloads)} file(s) failed' in errors[1]
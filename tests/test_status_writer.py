@@ -0,0 +1,133 @@
+"""Tests the batched job status writer against a local DynamoDB stand-in (moto)
+
+Usage: python -m pytest tests
+"""
+import os
+import sys
+import contextlib
+
+import pytest
+
+REALPATH = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(REALPATH), 'src'))
+
+moto = pytest.importorskip('moto')
+boto3 = pytest.importorskip('boto3')
+
+from botocore.exceptions import ClientError
+from common.status_writer import JobStatusWriter
+
+REGION = 'us-east-1'
+STATUS_TABLE = 'ensemblefit-job-status'
+# Long enough that only the tests flush
+FLUSH_INTERVAL = 3600
+
+
+@pytest.fixture
+def dynamodb(monkeypatch):
+    for name in ['AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY', 'AWS_SESSION_TOKEN']:
+        monkeypatch.setenv(name, 'testing')
+    monkeypatch.setenv('AWS_DEFAULT_REGION', REGION)
+    with moto.mock_aws():
+        dynamodb = boto3.resource('dynamodb', region_name=REGION)
+        dynamodb.create_table(TableName=STATUS_TABLE, KeySchema=[{'AttributeName': 'job_id', 'KeyType': 'HASH'}],
+                              AttributeDefinitions=[{'AttributeName': 'job_id', 'AttributeType': 'S'}],
+                              BillingMode='PAY_PER_REQUEST')
+        yield dynamodb
+
+
+def read_statuses(dynamodb):
+    """(job, workflow, status) of every written item"""
+    return sorted((item['job_id'].rsplit('_', 1)[0], item['workflow'], item['job_status'])
+                  for item in dynamodb.Table(STATUS_TABLE).scan()['Items'])
+
+
+def job(job_id):
+    return {'job_id': job_id, 'user_id': 'user'}
+
+
+def failing_put_item(code):
+    def put_item(**kwargs):
+        raise ClientError({'Error': {'Code': code, 'Message': 'failed'}}, 'PutItem')
+    return put_item
+
+
+def failing_batch_writer(code):
+    @contextlib.contextmanager
+    def batch_writer():
+        class Batch:
+            put_item = staticmethod(failing_put_item(code))
+        yield Batch()
+    return batch_writer
+
+
+def test_coalesces_per_job_and_workflow(dynamodb):
+    writer = JobStatusWriter(dynamodb, STATUS_TABLE, flush_interval=FLUSH_INTERVAL)
+    writer.update(job('a'), 'm1', 'queued', 'mutsig')
+    writer.update(job('a'), 'm1', 'running', 'mutsig')
+    writer.update(job('a'), 'm1', 'running', 'matrixgen')
+    writer.update(job('b'), 'm2', 'running', 'mutsig')
+    assert read_statuses(dynamodb) == []
+    writer.flush()
+
+    assert read_statuses(dynamodb) == [('a', 'matrixgen', 'running'), ('a', 'mutsig', 'running'), ('b', 'mutsig', 'running')]
+    stats = writer.stats()
+    assert stats['coalesced'] == 1 and stats['batches'] == 1 and stats['writes'] == 3
+    writer.close()
+
+
+def test_terminal_statuses_are_written_synchronously(dynamodb):
+    writer = JobStatusWriter(dynamodb, STATUS_TABLE, flush_interval=FLUSH_INTERVAL)
+    writer.update(job('a'), 'm1', 'running', 'mutsig')
+    writer.update(job('a'), 'm1', 'complete', 'mutsig')
+
+    # Written before any flush, and the pending running status it replaced is never written
+    assert read_statuses(dynamodb) == [('a', 'mutsig', 'complete')]
+    writer.close()
+    assert read_statuses(dynamodb) == [('a', 'mutsig', 'complete')]
+    stats = writer.stats()
+    assert stats['sync_writes'] == 1 and stats['coalesced'] == 1 and stats['batches'] == 0
+
+
+def test_failed_batch_is_retried_unless_superseded(dynamodb, monkeypatch):
+    # Short enough for the backoff to double under its cap, long enough that only the test flushes
+    flush_interval = 10
+    writer = JobStatusWriter(dynamodb, STATUS_TABLE, flush_interval=flush_interval)
+    writer.update(job('a'), 'm1', 'running', 'mutsig')
+    writer.update(job('b'), 'm2', 'running', 'mutsig')
+    writer.update(job('c'), 'm3', 'running', 'mutsig')
+    with monkeypatch.context() as patch:
+        patch.setattr(writer.table, 'batch_writer', failing_batch_writer('ProvisionedThroughputExceededException'))
+        writer.flush()
+        stats = writer.stats()
+        assert stats['errors'] == 1 and stats['throttle_errors'] == 1 and stats['retried_items'] == 3
+        assert writer.retry_delay == flush_interval
+        # Meanwhile job b moves on and job c completes
+        writer.update(job('b'), 'm2', 'uploading', 'mutsig')
+        writer.update(job('c'), 'm3', 'complete', 'mutsig')
+        writer.flush()
+        assert writer.stats()['errors'] == 2 and writer.retry_delay == flush_interval * 2
+    assert read_statuses(dynamodb) == [('c', 'mutsig', 'complete')]
+
+    writer.flush()
+    # The failed statuses came back unless a newer one had arrived for their job
+    assert read_statuses(dynamodb) == [('a', 'mutsig', 'running'), ('b', 'mutsig', 'uploading'), ('c', 'mutsig', 'complete')]
+    assert writer.retry_delay == 0
+    assert writer.latest == {}
+    writer.close()
+
+
+def test_errors_other_than_throttling(dynamodb, monkeypatch):
+    writer = JobStatusWriter(dynamodb, STATUS_TABLE, flush_interval=FLUSH_INTERVAL)
+    writer.update(job('a'), 'm1', 'running', 'mutsig')
+    monkeypatch.setattr(writer.table, 'batch_writer', failing_batch_writer('ValidationException'))
+    writer.flush()
+    stats = writer.stats()
+    assert stats['errors'] == 1 and stats['throttle_errors'] == 0
+
+    # A failed terminal write reaches the caller
+    monkeypatch.setattr(writer.table, 'put_item', failing_put_item('ValidationException'))
+    with pytest.raises(ClientError):
+        writer.update(job('a'), 'm1', 'failed', 'mutsig')
+    assert writer.stats()['errors'] == 2
+    writer.close()
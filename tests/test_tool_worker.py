@@ -0,0 +1,81 @@
+"""Tests warm tool workers: their private socket directory and the resource usage they report per run
+
+Usage: python -m pytest tests
+"""
+import os
+import sys
+import time
+import shlex
+import signal
+import subprocess
+
+import pytest
+
+REALPATH = os.path.dirname(os.path.realpath(__file__))
+APPS_PATH = os.path.join(os.path.dirname(REALPATH), 'src', 'apps')
+sys.path.insert(0, APPS_PATH)
+
+import tool_worker
+import task_metrics
+
+# Burns CPU in the worker's tool process, not in the client
+TOOL_SCRIPT = '''
+import time
+
+
+def main(output_path, seconds):
+    end = time.process_time() + float(seconds)
+    while time.process_time() < end:
+        pass
+    with open(output_path, 'w') as f:
+        f.write('done')
+'''
+
+
+@pytest.fixture
+def worker_dir(tmp_path, monkeypatch):
+    path = str(tmp_path / 'workers')
+    monkeypatch.setattr(tool_worker, 'WORKER_DIR', path)
+    monkeypatch.setenv('ENSEMBLEFIT_WORKER_DIR', path)
+    return path
+
+
+def test_worker_dir_is_private(worker_dir, tmp_path):
+    tool_worker.make_worker_dir()
+    assert os.stat(worker_dir).st_mode & 0o777 == 0o700
+
+    # A directory others can reach is neither served on nor connected to
+    os.chmod(worker_dir, 0o777)
+    with pytest.raises(PermissionError):
+        tool_worker.make_worker_dir()
+    with pytest.raises(PermissionError):
+        tool_worker.connect(str(tmp_path / 'tool.py'))
+    assert tool_worker.dispatch(str(tmp_path / 'tool.py'), []) is None
+
+
+def test_warm_run_reports_worker_usage(worker_dir, tmp_path):
+    tool_path = tmp_path / 'busy_tool.py'
+    tool_path.write_text(TOOL_SCRIPT)
+    server = subprocess.Popen([sys.executable, os.path.join(APPS_PATH, 'tool_worker.py'), 'serve', str(tool_path)])
+    try:
+        deadline = time.time() + 10
+        while not tool_worker.is_worker_up(str(tool_path)) and time.time() < deadline:
+            time.sleep(0.1)
+        assert tool_worker.is_worker_up(str(tool_path))
+
+        metrics_dir = str(tmp_path / 'metrics')
+        output_path = tmp_path / 'output.txt'
+        command = ' '.join(shlex.quote(arg) for arg in [
+            sys.executable, os.path.join(APPS_PATH, 'tool_worker.py'), 'run', str(tool_path), str(output_path), '0.5'])
+        assert task_metrics.run(metrics_dir, 'busy_tool_warm', 'busy_tool_warm', command) == 0
+    finally:
+        server.send_signal(signal.SIGTERM)
+        server.wait(timeout=10)
+
+    assert output_path.read_text() == 'done'
+    [record] = task_metrics.read_metrics(metrics_dir)
+    # The tool's CPU was spent in the worker, and is counted in the task's totals
+    assert record['worker_usage']['user_seconds'] + record['worker_usage']['sys_seconds'] >= 0.4
+    assert record['user_seconds'] >= record['worker_usage']['user_seconds']
+    assert record['peak_rss_mb'] >= record['worker_usage']['peak_rss_mb'] > 0
+    assert not [name for name in os.listdir(metrics_dir) if name.endswith('.usage')]
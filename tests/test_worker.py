@@ -0,0 +1,138 @@
+"""End-to-end test of the job worker against local S3, SQS and DynamoDB stand-ins (moto)
+
+Jobs are received from the queue and run by the worker's real job handler: inputs are downloaded, the
+manifest is translated and assignment.py runs on the built-in FastNNLS tool, then results and archives are
+uploaded. Meanwhile the worker extends the visibility of running jobs, drains and deletes messages in batches.
+
+Usage: python -m pytest tests
+"""
+import io
+import os
+import sys
+import json
+import time
+import zipfile
+import threading
+
+import pytest
+
+REALPATH = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(REALPATH), 'src'))
+
+moto = pytest.importorskip('moto')
+boto3 = pytest.importorskip('boto3')
+
+import worker
+from common.job_worker import JobWorker
+from common.status_writer import JobStatusWriter
+from common.tracing import read_trace
+
+REGION = 'us-east-1'
+MATRIX_PATH = os.path.join(os.path.dirname(REALPATH), 'example', 'input', 'SP-synthetic_BRCA_198.txt')
+UPLOADS_BUCKET = 'ensemblefit-uploads'
+OUTPUTS_BUCKET = 'ensemblefit-outputs'
+STATUS_TABLE = 'ensemblefit-job-status'
+# Short enough for the heartbeat to extend every running job's message several times
+VISIBILITY_TIMEOUT = 2
+JOB_SECONDS = 2 * VISIBILITY_TIMEOUT
+
+
+def make_manifest(job_id):
+    return {
+        'job_id': job_id,
+        'user_id': 'user',
+        'file_type': 'txt',
+        'upload_files': [f's3://{UPLOADS_BUCKET}/user/{job_id}/samples.txt'],
+        'reference_build': 'GRCh37',
+        'signature_reference': 'COSMICv3_SP-synthetic_GRCh37',
+        'analysis': 'refit',
+        'tools': ['FastNNLS'],
+    }
+
+
+@pytest.fixture
+def aws(monkeypatch):
+    for name in ['AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY', 'AWS_SESSION_TOKEN']:
+        monkeypatch.setenv(name, 'testing')
+    monkeypatch.setenv('AWS_DEFAULT_REGION', REGION)
+    with moto.mock_aws():
+        yield
+
+
+def test_worker_runs_jobs_end_to_end(aws, tmp_path):
+    s3 = boto3.resource('s3', region_name=REGION)
+    s3.create_bucket(Bucket=UPLOADS_BUCKET)
+    s3.create_bucket(Bucket=OUTPUTS_BUCKET)
+    s3.Bucket(UPLOADS_BUCKET).upload_file(MATRIX_PATH, 'user/job-ok/samples.txt')
+    dynamodb = boto3.resource('dynamodb', region_name=REGION)
+    dynamodb.create_table(TableName=STATUS_TABLE, KeySchema=[{'AttributeName': 'job_id', 'KeyType': 'HASH'}],
+                          AttributeDefinitions=[{'AttributeName': 'job_id', 'AttributeType': 'S'}],
+                          BillingMode='PAY_PER_REQUEST')
+    sqs = boto3.client('sqs', region_name=REGION)
+    queue_url = sqs.create_queue(QueueName='ensemblefit-jobs')['QueueUrl']
+    # The input of job-missing-input was never uploaded, its job fails
+    for job_id in ['job-ok', 'job-missing-input']:
+        sqs.send_message(QueueUrl=queue_url, MessageBody=json.dumps(make_manifest(job_id)))
+
+    operations = []
+    sqs.meta.events.register('before-call.sqs', lambda model, **kwargs: operations.append(model.name))
+
+    workdir_path = tmp_path / 'jobs'
+    trace_path = tmp_path / 'trace.json'
+    status_writer = JobStatusWriter(dynamodb, STATUS_TABLE, flush_interval=0.1)
+    handler = worker.make_job_handler(f'sleep {JOB_SECONDS} && {worker.DEFAULT_JOB_COMMAND}', str(workdir_path),
+                                      status_writer, s3, OUTPUTS_BUCKET, str(trace_path))
+    job_worker = JobWorker(sqs, queue_url, handler, max_concurrency=2, visibility_timeout=VISIBILITY_TIMEOUT,
+                           wait_time_seconds=1)
+    thread = threading.Thread(target=job_worker.run)
+    thread.start()
+    deadline = time.time() + 30
+    while job_worker.metrics['received'] < 2 and time.time() < deadline:
+        time.sleep(0.1)
+    # As on SIGTERM: no more receives, running jobs finish and their messages are deleted
+    job_worker.drain()
+    thread.join(timeout=300)
+    status_writer.close()
+
+    assert not thread.is_alive()
+    assert job_worker.metrics['received'] == 2
+    assert job_worker.metrics['succeeded'] == 1
+    assert job_worker.metrics['failed'] == 1
+    assert 'ChangeMessageVisibilityBatch' in operations
+    assert 'DeleteMessageBatch' in operations
+    assert 'DeleteMessage' not in operations
+
+    # Results, the output archive and the logs archive of the job that succeeded
+    output_keys = {item.key for item in s3.Bucket(OUTPUTS_BUCKET).objects.all()}
+    assert {'user/job-ok/assignment_metrics.json', 'user/job-ok/assignment_metrics.txt', 'user/job-ok/job_metadata.txt',
+            'user/job-ok/mutsig_output.zip', 'user/job-ok/mutsig_logs.zip'} <= output_keys
+    assert not any(key.startswith('user/job-missing-input/') for key in output_keys)
+    archive = zipfile.ZipFile(io.BytesIO(s3.Object(OUTPUTS_BUCKET, 'user/job-ok/mutsig_output.zip').get()['Body'].read()))
+    assert 'output/results/FastNNLS/FastNNLS_refit.txt' in archive.namelist()
+    assert not any(name.startswith('output/temp/') for name in archive.namelist())
+
+    # The in-process FastNNLS runs are recorded like the bash apps
+    metrics = json.loads(s3.Object(OUTPUTS_BUCKET, 'user/job-ok/assignment_metrics.json').get()['Body'].read())
+    assert metrics['apps']['FastNNLS']['tasks'] >= 1 and metrics['apps']['FastNNLS']['failed'] == 0
+
+    # The translated config names the downloaded matrix and the repository's reference
+    metadata = s3.Object(OUTPUTS_BUCKET, 'user/job-ok/job_metadata.txt').get()['Body'].read().decode()
+    assert 'Number of samples: 198' in metadata
+    assert 'COSMICv3_SP-synthetic_GRCh37.txt' in metadata
+
+    # Only the failed job's message is left, it becomes visible again for a retry
+    time.sleep(VISIBILITY_TIMEOUT + 1)
+    messages = sqs.receive_message(QueueUrl=queue_url, MaxNumberOfMessages=10, WaitTimeSeconds=1).get('Messages', [])
+    assert [json.loads(message['Body'])['job_id'] for message in messages] == ['job-missing-input']
+
+    # The failed job's workdir is kept for its retry, the other one is removed
+    assert sorted(os.listdir(workdir_path)) == ['job-missing-input']
+
+    statuses = {}
+    for item in dynamodb.Table(STATUS_TABLE).scan()['Items']:
+        statuses.setdefault(item['job_id'].rsplit('_', 1)[0], set()).add(item['job_status'])
+    assert 'complete' in statuses['job-ok'] and 'failed' not in statuses['job-ok']
+    assert 'failed' in statuses['job-missing-input'] and 'complete' not in statuses['job-missing-input']
+
+    span_names = {event['name'] for event in read_trace(str(trace_path)) if event.get('ph') == 'X'}
+    assert {'job', 's3 download', 'command', 's3 upload', 'output archive upload', 'logs archive upload'} <= span_names
@@ -0,0 +1,268 @@
+"""Tests the shared helpers of the workflow's stages in workflow_utils.py
+
+Usage: python -m pytest tests
+"""
+import os
+import sys
+
+import pytest
+
+REALPATH = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(REALPATH), 'src', 'apps'))
+
+np = pytest.importorskip('numpy')
+pd = pytest.importorskip('pandas')
+
+import workflow_utils as utils
+
+ALL_SIGS = ['SBS1', 'SBS2', 'SBS3', 'SBS5', 'SBS13']
+
+
+def random_catalogue(n_samples, seed=0):
+    rng = np.random.default_rng(seed)
+    return list(utils.SBS96_FEATURES), [f'S{i}' for i in range(n_samples)], rng.integers(0, 50, (96, n_samples))
+
+
+def fake_tool(sample_path, output_path, tool, strategy, intermediate_format):
+    """Fits like a tool that leaves out the signatures it assigned to none of its samples, then an unassigned column"""
+    features, samples, counts = utils.load_catalogue(sample_path)
+    # A sample is assigned the i-th signature when its count of the i-th feature is a nonzero multiple of 3
+    activities = np.asarray(counts[:len(ALL_SIGS)], dtype=float).T * (np.asarray(counts[:len(ALL_SIGS)]).T % 3 == 0)
+    df = pd.DataFrame(activities, columns=ALL_SIGS)
+    df = df.loc[:, df.sum() > 0]
+    df.insert(0, 'Samples', samples)
+    df['unassigned'] = np.asarray(counts).sum(axis=0) - activities.sum(axis=1)
+    os.makedirs(os.path.join(output_path, tool), exist_ok=True)
+    utils.write_table(df, os.path.join(output_path, tool, f'{tool}_{strategy}.txt'), intermediate_format)
+
+
+@pytest.mark.parametrize('intermediate_format', utils.INTERMEDIATE_FORMATS)
+def test_sharded_activities_equal_unsharded(tmp_path, intermediate_format):
+    features, samples, counts = random_catalogue(7)
+    # A signature only the first shard's samples have, and one only the last shard's have
+    counts[:len(ALL_SIGS)] = 1
+    counts[1, 0] = 3
+    counts[4, 6] = 6
+    matrix_path = str(tmp_path / 'samples.txt')
+    utils.write_catalogue(features, samples, counts, matrix_path, intermediate_format)
+    fake_tool(matrix_path, str(tmp_path), 'tool', 'refit', intermediate_format)
+    expected = utils.read_table(str(tmp_path / 'tool' / 'tool_refit.txt'))
+    assert expected.columns.tolist() == ['Samples', 'SBS2', 'SBS13', 'unassigned']
+
+    shard_paths = utils.split_matrix(matrix_path, 3, str(tmp_path / 'shards'), intermediate_format)
+    assert [utils.load_catalogue(os.path.join(shard_path, 'samples.txt'))[1] for shard_path in shard_paths] == [
+        ['S0', 'S1', 'S2'], ['S3', 'S4', 'S5'], ['S6']]
+    for shard_path in shard_paths:
+        fake_tool(os.path.join(shard_path, 'samples.txt'), shard_path, 'tool', 'refit', intermediate_format)
+    # The shards each lack a signature column the others have
+    assert [utils.read_table(os.path.join(shard_path, 'tool', 'tool_refit.txt')).columns.tolist()
+            for shard_path in shard_paths] == [['Samples', 'SBS2', 'unassigned'], ['Samples', 'unassigned'],
+                                               ['Samples', 'SBS13', 'unassigned']]
+
+    merged_path = str(tmp_path / 'merged')
+    utils.merge_activities(shard_paths, 'tool', 'refit', merged_path, ALL_SIGS, intermediate_format)
+    merged = utils.read_table(os.path.join(merged_path, 'tool', 'tool_refit.txt'))
+    pd.testing.assert_frame_equal(merged, expected)
+
+
+@pytest.fixture
+def reference_path(tmp_path):
+    rng = np.random.default_rng(1)
+    reference = pd.DataFrame(rng.random((96, len(ALL_SIGS))), index=utils.SBS96_FEATURES, columns=ALL_SIGS)
+    reference.index.name = 'Type'
+    path = str(tmp_path / 'reference.txt')
+    reference.to_csv(path, sep='\t')
+    # Every test loads it anew
+    utils.load_registered_reference.cache_clear()
+    yield path
+    utils.load_registered_reference.cache_clear()
+
+
+def test_reference_registry_hit(tmp_path, reference_path, monkeypatch):
+    registry_path = str(tmp_path / 'registry')
+    built = utils.load_reference(reference_path, registry_path)
+    assert os.stat(registry_path).st_mode & 0o777 == 0o700
+    [entry] = os.listdir(registry_path)
+    assert os.stat(os.path.join(registry_path, entry)).st_mode & 0o777 == 0o700
+
+    # Another process finds the entry and memory-maps it without parsing the file
+    utils.load_registered_reference.cache_clear()
+    monkeypatch.setattr(utils, 'build_reference', lambda *args: pytest.fail('the registry entry was rebuilt'))
+    reference = utils.load_reference(reference_path, registry_path)
+    assert isinstance(reference.matrix, np.memmap)
+    assert reference.signatures == ALL_SIGS and reference.features == built.features
+    for name in ['matrix', 'gram', 'upper']:
+        assert np.array_equal(getattr(reference, name), getattr(built, name))
+
+
+def test_reference_kept_in_memory_without_registry(tmp_path, reference_path, capsys):
+    # A registry that cannot be created, as under a file
+    (tmp_path / 'file').write_text('')
+    reference = utils.load_reference(reference_path, str(tmp_path / 'file' / 'registry'))
+    assert not isinstance(reference.matrix, np.memmap)
+    assert reference.signatures == ALL_SIGS
+    assert np.allclose(reference.matrix.sum(axis=0), 1)
+    assert 'keeping' in capsys.readouterr().err
+
+
+def test_reference_build_race(tmp_path, reference_path, monkeypatch):
+    registry_path = str(tmp_path / 'registry')
+    save = utils.SignatureReference.save
+
+    def save_and_lose_race(reference, build_path):
+        # Another builder renames its entry in place while this one is saving
+        save(reference, build_path)
+        save(reference, os.path.join(registry_path, '.other-build'))
+        os.rename(os.path.join(registry_path, '.other-build'),
+                  os.path.join(registry_path, f'{reference.digest}-v{utils.REFERENCE_REGISTRY_VERSION}'))
+
+    monkeypatch.setattr(utils.SignatureReference, 'save', save_and_lose_race)
+    reference = utils.load_reference(reference_path, registry_path)
+    # The lost build is dropped and the winner's entry is used
+    assert isinstance(reference.matrix, np.memmap)
+    assert os.listdir(registry_path) == [f'{reference.digest}-v{utils.REFERENCE_REGISTRY_VERSION}']
+
+
+def write_matrix(path, samples, rows):
+    """Writes a matrix of {feature: [fields]} rows as given, fields as strings"""
+    with open(path, 'w') as f:
+        f.write('\t'.join(['MutationType'] + samples) + '\n')
+        for feature, fields in rows.items():
+            f.write('\t'.join([feature] + [str(field) for field in fields]) + '\n')
+    return str(path)
+
+
+def valid_rows(n_samples):
+    return {feature: [i + j for j in range(n_samples)] for i, feature in enumerate(reversed(utils.SBS96_FEATURES))}
+
+
+def test_read_catalogue(tmp_path):
+    rows = valid_rows(3)
+    rows['A[C>A]A'] = [0, 0, 0]
+    path = write_matrix(tmp_path / 'samples.txt', ['S1', 'S2', 'S3'], rows)
+    # Blank lines are skipped
+    with open(path, 'a') as f:
+        f.write('\n')
+    features, samples, counts, diagnostics = utils.read_catalogue(path)
+
+    # In the file's feature order
+    assert features == list(rows) and samples == ['S1', 'S2', 'S3']
+    assert counts.dtype == np.int64 and counts.tolist() == list(rows.values())
+    assert diagnostics.index.tolist() == samples
+    assert diagnostics['total_mutations'].tolist() == counts.sum(axis=0).tolist()
+    assert diagnostics['min_count'].tolist() == [0, 0, 0]
+    assert diagnostics['is_integer'].all() and diagnostics['is_valid'].all()
+
+
+@pytest.mark.parametrize('value', ['1.5', 'x', '', '1e3'])
+def test_read_catalogue_non_integer(tmp_path, value):
+    rows = valid_rows(3)
+    rows['T[T>G]T'][1] = value
+    path = write_matrix(tmp_path / 'samples.txt', ['S1', 'S2', 'S3'], rows)
+    with pytest.raises(ValueError, match=r'^Invalid sample\(s\): S2\. All samples must have non-negative integers'):
+        utils.read_catalogue(path)
+
+
+def test_read_catalogue_negative_and_zero_samples(tmp_path):
+    rows = valid_rows(4)
+    rows['C[C>T]G'][0] = -1
+    for fields in rows.values():
+        fields[2] = 0
+    path = write_matrix(tmp_path / 'samples.txt', ['S1', 'S2', 'S3', 'S4'], rows)
+    with pytest.raises(ValueError, match=r'^Invalid sample\(s\): S1, S3\.'):
+        utils.read_catalogue(path)
+
+
+def test_read_catalogue_duplicate_samples(tmp_path):
+    path = write_matrix(tmp_path / 'samples.txt', ['S1', 'S2', 'S1'], valid_rows(3))
+    with pytest.raises(ValueError, match=r'^Duplicate sample\(s\): S1\.'):
+        utils.read_catalogue(path)
+
+
+@pytest.mark.parametrize('change', ['renamed', 'repeated'])
+def test_read_catalogue_wrong_features(tmp_path, change):
+    rows = valid_rows(2)
+    fields = rows.pop('A[C>A]A')
+    path = write_matrix(tmp_path / 'samples.txt', ['S1', 'S2'], rows)
+    # Still 96 rows, one of them not an SBS96 feature or one feature twice
+    with open(path, 'a') as f:
+        f.write('\t'.join(['A[C>A]N' if change == 'renamed' else 'A[C>A]C'] + [str(field) for field in fields]) + '\n')
+    with pytest.raises(ValueError, match='^Matrix does not contain all 96 SBS96 features'):
+        utils.read_catalogue(path)
+
+
+@pytest.mark.parametrize('change', ['missing row', 'extra row', 'short row', 'no samples'])
+def test_read_catalogue_wrong_shape(tmp_path, change):
+    rows = valid_rows(2)
+    samples = ['S1', 'S2']
+    if change == 'missing row':
+        del rows['A[C>A]A']
+    elif change == 'extra row':
+        rows['extra'] = [1, 1]
+    elif change == 'short row':
+        rows['A[C>A]A'] = [1]
+    else:
+        samples = []
+        rows = {feature: [] for feature in rows}
+    path = write_matrix(tmp_path / 'samples.txt', samples, rows)
+    with pytest.raises(ValueError, match=r'^Matrix shape \(\d+, \d+\) is invalid'):
+        utils.read_catalogue(path)
+
+
+def activities_frame():
+    """A tool's activities, float signature columns with an integer column among them"""
+    return pd.DataFrame({
+        'Samples': ['S1', 'S2', 'S3'],
+        'SBS1': [0.25, 0.0, 1.5],
+        'SBS5': [3.0, 2.5, 0.0],
+        'mutations': [10, 20, 30],
+    })
+
+
+@pytest.mark.parametrize('df', [
+    activities_frame(),
+    activities_frame()[['Samples', 'mutations']],
+    activities_frame()[['Samples']],
+], ids=['mixed', 'integers', 'labels only'])
+def test_table_round_trip(tmp_path, df):
+    tsv_path = str(tmp_path / 'tsv' / 'activities.txt')
+    npy_path = str(tmp_path / 'npy' / 'activities.txt')
+    os.makedirs(os.path.dirname(tsv_path))
+    os.makedirs(os.path.dirname(npy_path))
+    utils.write_table(df, tsv_path, 'tsv')
+    utils.write_table(df, npy_path, 'npy')
+
+    assert not os.path.exists(npy_path)
+    assert sorted(os.listdir(os.path.dirname(npy_path))) == ['activities.labels.json', 'activities.npy']
+    from_npy = utils.read_table(npy_path)
+    # Integer columns stored among floats are cast back
+    pd.testing.assert_frame_equal(from_npy, df)
+    pd.testing.assert_frame_equal(from_npy, utils.read_table(tsv_path))
+
+    # Writing the other format removes the stale copy
+    utils.write_table(df, npy_path, 'tsv')
+    assert os.listdir(os.path.dirname(npy_path)) == ['activities.txt']
+    with pytest.raises(ValueError, match='Unknown intermediate format'):
+        utils.write_table(df, npy_path, 'parquet')
+
+
+def test_catalogue_round_trip(tmp_path):
+    features, samples, counts = random_catalogue(4)
+    tsv_path = str(tmp_path / 'samples.txt')
+    utils.write_catalogue(features, samples, counts, tsv_path, 'npy')
+
+    # The TSV the tools read is written either way, the Python stages memory-map the npy copy
+    npy_features, npy_samples, npy_counts = utils.load_catalogue(tsv_path)
+    assert isinstance(npy_counts, np.memmap)
+    tsv_features, tsv_samples, tsv_counts, _ = utils.read_catalogue(tsv_path)
+    assert npy_features == tsv_features == features and npy_samples == tsv_samples == samples
+    assert np.array_equal(npy_counts, tsv_counts) and np.array_equal(tsv_counts, counts)
+    # Its frame as pandas reads the TSV
+    pd.testing.assert_frame_equal(utils.catalogue_frame(npy_features, npy_samples, npy_counts),
+                                  pd.read_csv(tsv_path, sep='\t'))
+    assert utils.read_column_names(tsv_path) == samples
+
+    # Rewritten as TSV only, the npy copy is removed
+    utils.write_catalogue(features, samples, counts, tsv_path)
+    assert os.listdir(tmp_path) == ['samples.txt']
+    assert not isinstance(utils.load_catalogue(tsv_path)[2], np.memmap)